@@ -0,0 +1,390 @@
+"""
+Benchmarks for the stretch hot path.
+
+    $ python bench.py                          # time the suite
+    $ python bench.py --save before.json       # keep the results
+    $ python bench.py --compare before.json    # flag regressions
+
+The suite times each case in <suite> and reports the best time per call.
+Saved results record the git commit they were measured at, so results
+from two commits can be compared. --compare exits with status 1 if any
+case got slower by more than the threshold, so it can gate a release.
+
+--post-fft and --shared run the older single purpose benchmarks below.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from concurrent_ring import ConcurrentRing
+from ring import Ring, AnnotatedRing
+from storage import SharedStorage
+from stretcher import Stretcher, StretchGroup, get_strech
+
+# A clock that reads the same in every process
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def reference_overlap_add(buffer, sw, audio_phased):
+    """ The post-FFT stage as it was before the window tables were combined.
+    Kept to measure the fused Stretcher.overlap_add against.
+    """
+    audio_phased *= sw.double_hinv_buf
+    audio_phased *= sw.open_window
+    previous = buffer.recent(sw.half) * sw.close_window
+    audio_phased[:sw.half] += previous
+    buffer.rewind(sw.half)
+    buffer.append(audio_phased)
+    buffer.append(audio_phased)
+    return audio_phased[:sw.half]
+
+
+def estimate_post_fft_bytes(sw):
+    """ Estimate the bytes read and written per hop by the post-FFT stage,
+    counting each element of every array operand once per numpy operation.
+    This is worked out from the code, not measured: it ignores caches and
+    numpy's temporaries.
+
+    Returns a (reference, fused) pair. The reference stage makes two passes
+    over the frame for the two window tables, allocates and fills a new array
+    for the closed tail, and appends the frame to the output ring twice. The
+    fused stage closes the tail and adds the new audio in place in the ring,
+    and appends only the new half.
+    """
+    n, h = sw.size, sw.half
+    reference = (
+        3 * n +      # audio_phased *= double_hinv_buf (read two, write one)
+        3 * n +      # audio_phased *= open_window
+        2 * h +      # buffer.recent(half), when the read wraps
+        3 * h +      # recent * close_window, in to a new array
+        3 * h +      # audio_phased[:half] += previous
+        2 * n +      # buffer.append(audio_phased)
+        2 * n)       # the second buffer.append(audio_phased)
+    fused = (
+        3 * n +      # audio_phased *= open_hinv
+        3 * h +      # tail *= close_window, in the ring
+        3 * h +      # tail += audio_phased[:half], in the ring
+        2 * h +      # audio_phased[:half] = tail, for the caller
+        2 * h)       # buffer.append(audio_phased[half:])
+    return reference * sw.dtype.itemsize, fused * sw.dtype.itemsize
+
+
+def bench_post_fft(exponent=14, dtype='float32', number=200):
+    """ Time one hop of the reference and the fused post-FFT stage """
+    sw = get_strech(2 ** exponent, dtype)
+    frame = np.random.randn(sw.size).astype(dtype)
+    work = frame.copy()
+
+    ring = Ring(2 ** 16, dtype)
+    tap = ring.create_tap()
+    stretcher = Stretcher(tap)
+    buffer = Ring(2 ** 16, dtype)
+
+    def reference():
+        work[:] = frame
+        reference_overlap_add(buffer, sw, work)
+
+    def fused():
+        work[:] = frame
+        stretcher.overlap_add(sw, work)
+
+    # Copying the frame in to the work array is common to both, subtract it
+    def copy():
+        work[:] = frame
+
+    baseline = min(timeit.repeat(copy, number=number, repeat=5)) / number
+    reference_time = min(timeit.repeat(reference, number=number, repeat=5)) / number - baseline
+    fused_time = min(timeit.repeat(fused, number=number, repeat=5)) / number - baseline
+    reference_bytes, fused_bytes = estimate_post_fft_bytes(sw)
+    return {
+        'reference': {'seconds': reference_time, 'estimated_bytes': reference_bytes},
+        'fused': {'seconds': fused_time, 'estimated_bytes': fused_bytes},
+    }
+
+
+def shared_reader(name, length, slot, block, count, results):
+    """ Attach to a shared ConcurrentRing, and measure how long each block
+    took to arrive. The first sample of each block is the time it was
+    published.
+    """
+    storage = SharedStorage(name, create=False)
+    ring = ConcurrentRing(length, 'float64', storage)
+    tap = ring.open_tap(slot)
+    frame = np.empty(block)
+    latencies = np.empty(count)
+    for i in range(count):
+        # Yield while we wait, so the benchmark also means something when
+        # both processes share a core
+        while tap.available < block:
+            time.sleep(0)
+        tap.read(block, out=frame)
+        latencies[i] = clock() - frame[0]
+    results.put(latencies)
+    del ring, tap
+    storage.close()
+
+
+def bench_shared_latency(block=512, count=2000, length=2**16):
+    """ Seconds from publishing a block in one process to reading it in
+    another, as (median, 99th percentile, max)
+    """
+    name = 'bench-{0}'.format(os.getpid())
+    storage = SharedStorage(name)
+    ring = ConcurrentRing(length, 'float64', storage)
+    tap = ring.create_tap()
+    results = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=shared_reader,
+                                     args=(name, length, tap.slot, block, count, results))
+    reader.start()
+    try:
+        frame = np.zeros(block)
+        for i in range(count):
+            # one block in flight at a time, so we time the hand off alone
+            while tap.available > 0:
+                time.sleep(0)
+            frame[0] = clock()
+            ring.append(frame)
+        latencies = results.get()
+        reader.join()
+    finally:
+        del ring, tap
+        storage.close()
+        storage.unlink()
+    return np.median(latencies), np.percentile(latencies, 99), np.max(latencies)
+
+
+class BenchIO(object):
+    """ Stand in for StretchIO, with every fader at the same stretch """
+    def __init__(self, stretch=4):
+        self.stretch = stretch
+
+    def fader_state(self, i):
+        return self.stretch
+
+    def led(self, led_num, value):
+        pass
+
+
+def ring_append_cases():
+    """ Ring.append of one 512 sample block, in the middle of the ring and
+    across the end of the ring. rewind keeps the ring where it was.
+    """
+    block = np.random.randn(512).astype('float32')
+    for name, position in [('unwrapped', 2**19), ('wrapped', 2**20 - 256)]:
+        ring = Ring(2**20, 'float32')
+        ring.append(np.zeros(position, 'float32'))
+
+        def append(ring=ring):
+            ring.append(block)
+            ring.rewind(len(block))
+        yield 'ring.append/' + name, append
+
+
+def tap_get_samples_cases():
+    """ RingTap.get_samples of a 2**14 window, in to a preallocated array """
+    out = np.empty(2**14, 'float32')
+    for name, position in [('unwrapped', 2**19), ('wrapped', 2**20 - 2**13)]:
+        ring = Ring(2**20, 'float32')
+        ring.append(np.random.randn(2**20).astype('float32'))
+        # The newest samples are just past the start of the raw buffer
+        ring.append(np.random.randn(2**16).astype('float32'))
+        tap = ring.create_tap()
+        tap.index = position
+        yield 'tap.get_samples/' + name, lambda tap=tap: tap.get_samples(len(out), out=out)
+
+
+def annotated_append_cases():
+    """ AnnotatedRing.append of one callback (as run.py sets it up) """
+    block = np.random.randn(2**13).astype('float32')
+    for name, bands in [('energy', 0), ('spectral', 24)]:
+        ring = AnnotatedRing(2**13, 512, 'float32', spectral_bands=bands)
+        yield 'annotated.append/' + name, lambda ring=ring: ring.append(block)
+
+
+def stretch_cases():
+    """ One Stretcher.stretch hop at each power of two window size """
+    ring = Ring(2**20, 'float32')
+    ring.append(np.random.randn(2**20).astype('float32'))
+    for exponent in range(10, 17):
+        stretcher = Stretcher(ring.create_tap(), seed=0)
+
+        def stretch(stretcher=stretcher, windowsize=2 ** exponent):
+            # Keep the tap far from the end of the ring
+            stretcher.tap.index = 0
+            stretcher.stretch(windowsize)
+        yield 'stretcher.stretch/{0}'.format(2 ** exponent), stretch
+
+
+def group_step_cases():
+    """ A whole audio callback: append the input, then step a StretchGroup
+    with every voice playing
+    """
+    blocksize = 2**13
+    block = np.random.randn(blocksize).astype('float32')
+    for voices in [1, 4, 8]:
+        ring = AnnotatedRing(2**13, 512, 'float32')
+        ring.append(np.random.randn(len(ring)).astype('float32'))
+        group = StretchGroup(ring, BenchIO(), voices, seed=0)
+
+        def callback(ring=ring, group=group):
+            # Start every voice a little behind the input, so that no voice
+            # is overrun however many times we are called
+            for stretcher in group.stretches_list:
+                stretcher.tap.index = ring.index - 2**16
+                stretcher.tap.activate()
+            ring.append(block)
+            group.step(blocksize)
+        yield 'group.step/{0}'.format(voices), callback
+
+
+suite = [ring_append_cases, tap_get_samples_cases, annotated_append_cases,
+         stretch_cases, group_step_cases]
+
+
+def time_case(fn, min_seconds=0.05, repeat=5):
+    """ The best time per call of <fn>, calling it enough times per repeat
+    that each repeat takes at least <min_seconds>
+    """
+    fn()
+    number = 1
+    while True:
+        seconds = timeit.timeit(fn, number=number)
+        if seconds >= min_seconds:
+            break
+        number *= 2
+    best = min([seconds] + timeit.repeat(fn, number=number, repeat=repeat - 1))
+    return {'seconds': best / number, 'number': number}
+
+
+def run_suite(match=None):
+    """ Time every case whose name contains <match>. Returns {name: result}. """
+    results = {}
+    for cases in suite:
+        for name, fn in cases():
+            if match is None or match in name:
+                results[name] = time_case(fn)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe(results):
+    """ The results, with what we need to know to compare them later """
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def case_order(name):
+    """ Sort window sizes and voice counts by number, not alphabetically """
+    group, _, case = name.partition('/')
+    return (group, int(case)) if case.isdigit() else (group, case)
+
+
+def compare(old, new, threshold=0.1):
+    """ Print each case of the <new> run next to the same case of the <old>
+    run. Returns the names of the cases that got slower by more than
+    <threshold>.
+    """
+    regressions = []
+    print('{0:<28} {1:>12} {2:>12} {3:>8}'.format(
+        'case', old['commit'] or 'old', new['commit'] or 'new', 'ratio'))
+    for name in sorted(new['results'], key=case_order):
+        if name not in old['results']:
+            print('{0:<28} {1:>12}'.format(name, 'new case'))
+            continue
+        before = old['results'][name]['seconds']
+        after = new['results'][name]['seconds']
+        ratio = after / before
+        flag = ''
+        if ratio > 1. + threshold:
+            regressions.append(name)
+            flag = '  slower'
+        print('{0:<28} {1:>10.1f}us {2:>10.1f}us {3:>8.2f}{4}'.format(
+            name, before * 1e6, after * 1e6, ratio, flag))
+    return regressions
+
+
+def print_results(run):
+    print('commit {0}, python {1}, numpy {2}'.format(run['commit'], run['python'], run['numpy']))
+    for name in sorted(run['results'], key=case_order):
+        print('{0:<28} {1:>10.1f}us'.format(name, run['results'][name]['seconds'] * 1e6))
+
+
+def print_post_fft():
+
+    print('post-FFT stage, per hop (float32)')
+    print('{0:>8} {1:>10} {2:>10} {3:>12} {4:>12}'.format(
+        'window', 'ref KiB*', 'fused KiB*', 'ref us', 'fused us'))
+    for exponent in range(10, 17):
+        result = bench_post_fft(exponent)
+        print('{0:>8} {1:>10.1f} {2:>10.1f} {3:>12.1f} {4:>12.1f}'.format(
+            2 ** exponent,
+            result['reference']['estimated_bytes'] / 1024., result['fused']['estimated_bytes'] / 1024.,
+            result['reference']['seconds'] * 1e6, result['fused']['seconds'] * 1e6))
+    print('* estimated memory traffic, counted from the array operations; the times are measured')
+
+
+def print_shared():
+    median, p99, worst = bench_shared_latency()
+    print('shared memory ring, cross-process latency per 512 sample block')
+    print('median {0:.1f} us, 99% {1:.1f} us, max {2:.1f} us'.format(
+        median * 1e6, p99 * 1e6, worst * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stretch hot path')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='compare with the results saved in this json file')
+    parser.add_argument('--against', help='with --compare, compare with these saved results '
+                                          'instead of running the suite')
+    parser.add_argument('--match', help='only run the cases whose name contains this')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='with --compare, how much slower (0.1 is 10%%) counts as a regression')
+    parser.add_argument('--post-fft', action='store_true', help='time the post-FFT stage')
+    parser.add_argument('--shared', action='store_true', help='time the shared memory ring')
+    args = parser.parse_args()
+
+    if args.post_fft:
+        print_post_fft()
+    if args.shared:
+        print_shared()
+    if args.post_fft or args.shared:
+        sys.exit(0)
+
+    if args.against:
+        with open(args.against) as f:
+            run = json.load(f)
+    else:
+        run = describe(run_suite(args.match))
+        print_results(run)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('')
+        if compare(old, run, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,330 @@
+"""
+A ring buffer for one producer thread and any number of consumer threads.
+
+Ring assumes that one thread both appends and reads. Its append checks the
+taps and deactivates them, changing the tap dictionaries that the readers
+may be iterating at the same time. ConcurrentRing never touches its taps
+when it appends. Positions are sequence numbers instead: the absolute count
+of samples appended since the ring was created. Sample s lives at raw
+index s % length.
+
+The producer keeps two counters in a small array from the ring's storage:
+
+    claimed:   the end of the samples the producer is writing now
+    published: the end of the samples that are completely written
+
+append raises claimed before it writes and raises published after, so each
+is a single int64 store that a reader sees either before or after, and
+no lock is needed. A reader may use the samples before published. Once its
+copy is made, it checks claimed again. If the producer has claimed past the
+start of the read by more than the length of the ring, the samples may have
+been overwritten during the copy, and the read raises RingOverrun instead
+of returning torn audio.
+
+The cursor of every tap is kept in another storage array, so the producer
+(or a meter) can see how far behind the slowest consumer is. With a
+SharedStorage, the counters and cursors are shared between processes: a
+reader process attaches to the storage and opens the tap it was given with
+open_tap. Taps should be created by one process, because the lock that
+guards the tap slots is not shared.
+
+Engine publishes its input to a ConcurrentRing when it is given one as
+<capture>. A TapReader then hands the input to sinks on its own thread,
+for example to record it:
+
+    capture = ConcurrentRing(2**20, 'float32')
+    reader = TapReader(capture.create_tap(), [WavSink('in.wav', 44100, 1)])
+    reader.start()
+    engine = Engine(..., capture=capture)
+"""
+import threading
+import time
+
+import numpy as np
+
+from ring import RingPointerWarning
+from storage import MemoryStorage
+
+CLAIMED, PUBLISHED = 0, 1
+
+
+class ConcurrentRing(object):
+    def __init__(self, length, dtype=None, storage=None, max_taps=16):
+        if storage is None:
+            storage = MemoryStorage()
+        self.__storage  = storage
+        self.__length   = length
+        self.__content  = storage.allocate('content', length, dtype)
+        self.__sequence = storage.allocate('sequence', 2, 'int64')
+        # cursors[i] is the sequence number of the next sample tap i reads.
+        # Only slots marked in taps are in use.
+        self.__cursors  = storage.allocate('cursors', max_taps, 'int64')
+        self.__taps     = storage.allocate('taps', max_taps, 'bool')
+        # Only guards creating and closing taps, never reads or appends
+        self.__lock     = threading.Lock()
+
+    def __len__(self):
+        return self.__length
+
+    def append(self, items):
+        """ Write <items> after the last published sample, then publish
+        them. Only one thread may append.
+        """
+        count = len(items)
+        if count > self.__length:
+            raise IndexError('Cannot append buffer longer than the ring length')
+
+        start = int(self.__sequence[PUBLISHED])
+        self.__sequence[CLAIMED] = start + count
+
+        index = start % self.__length
+        if index + count <= self.__length:
+            self.__content[index:index + count] = items
+        else:
+            # space remaining before end of the raw buffer
+            len1 = self.__length - index
+            self.__content[index:] = items[:len1]
+            self.__content[:count - len1] = items[len1:]
+
+        self.__sequence[PUBLISHED] = start + count
+
+    def copy(self, sequence, out):
+        """ Copy the samples from <sequence> onward in to <out>, without
+        checking that they are published or still intact (see ConcurrentTap)
+        """
+        number = len(out)
+        index = sequence % self.__length
+        len1 = min(number, self.__length - index)
+        out[:len1] = self.__content[index:index + len1]
+        out[len1:] = self.__content[:number - len1]
+        return out
+
+    def recent(self, size, out=None):
+        """ Copy the <size> most recently published samples. Only the
+        producer can be certain that they are not overwritten during the
+        copy.
+        """
+        if size > self.__length:
+            raise IndexError('larger than current buffer size')
+        if out is None:
+            out = np.empty(size, self.__content.dtype)
+        return self.copy(self.published - size, out)
+
+    def create_tap(self, sequence=None):
+        """ A tap reading from <sequence>, which defaults to the next sample
+        to be published
+        """
+        with self.__lock:
+            free = np.nonzero(~self.__taps)[0]
+            if len(free) == 0:
+                raise IndexError('no free tap slots, increase max_taps')
+            slot = int(free[0])
+            self.__cursors[slot] = self.published if sequence is None else sequence
+            self.__taps[slot] = True
+        return ConcurrentTap(self, slot, self.__cursors)
+
+    def open_tap(self, slot):
+        """ The tap in <slot>, for example one created by another process
+        sharing our storage
+        """
+        if not self.__taps[slot]:
+            raise IndexError('tap slot {0} is not open'.format(slot))
+        return ConcurrentTap(self, slot, self.__cursors)
+
+    def close_tap(self, slot):
+        with self.__lock:
+            self.__taps[slot] = False
+
+    @property
+    def published(self):
+        """ The sequence number of the next sample to be published """
+        return int(self.__sequence[PUBLISHED])
+
+    @property
+    def claimed(self):
+        return int(self.__sequence[CLAIMED])
+
+    @property
+    def oldest(self):
+        """ The oldest sequence number that is certainly intact """
+        return self.claimed - self.__length
+
+    @property
+    def cursors(self):
+        """ The cursors of the open taps """
+        return self.__cursors[self.__taps]
+
+    @property
+    def slowest_cursor(self):
+        """ The cursor of the tap that is furthest behind, or None """
+        cursors = self.cursors
+        if len(cursors) == 0:
+            return None
+        return int(cursors.min())
+
+    @property
+    def raw(self):
+        return self.__content
+
+    @property
+    def storage(self):
+        return self.__storage
+
+
+class ConcurrentTap(object):
+    """ One consumer's position in a ConcurrentRing. A tap belongs to one
+    thread, but different taps may be used from different threads.
+    """
+    def __init__(self, ring, slot, cursors):
+        """
+        cursors: the ring's array of cursors, where we keep our position in
+                 cursors[slot]
+        """
+        self.ring      = ring
+        self.slot      = slot
+        self.__cursors = cursors
+        self.valid     = True
+
+    @property
+    def sequence(self):
+        """ The sequence number of the next sample we will read """
+        return int(self.__cursors[self.slot])
+
+    @sequence.setter
+    def sequence(self, sequence):
+        self.__cursors[self.slot] = sequence
+        self.valid = True
+
+    @property
+    def available(self):
+        """ How many published samples we have not read yet """
+        return self.ring.published - self.sequence
+
+    @property
+    def lag(self):
+        """ How many samples the producer may still write before we lose the
+        next sample we would read
+        """
+        return self.sequence - self.ring.oldest
+
+    def peek(self, number, out=None):
+        """ Copy <number> samples from our position without moving. Raises
+        BufferError if they are not all published yet, and RingOverrun if
+        the producer overwrote them before or during the copy.
+        """
+        sequence = self.sequence
+        if number < 0 or sequence + number > self.ring.published:
+            raise BufferError('only {0} samples are available'.format(self.available))
+        if out is None:
+            out = np.empty(number, self.ring.raw.dtype)
+        self.ring.copy(sequence, out)
+        # Check after the copy, because the producer may have lapped us
+        # while we were copying
+        if sequence < self.ring.oldest:
+            self.valid = False
+            raise RingOverrun('tap at {0} was overwritten, the oldest intact sample is {1}'.format(
+                sequence, self.ring.oldest))
+        return out
+
+    def read(self, number, out=None):
+        """ Like peek, and then advance past the samples """
+        out = self.peek(number, out)
+        self.__cursors[self.slot] += number
+        return out
+
+    def advance(self, amount):
+        self.__cursors[self.slot] += amount
+
+    def close(self):
+        self.ring.close_tap(self.slot)
+
+
+class TapReader(object):
+    """ Read a ConcurrentTap on a background thread, and write what it
+    reads to <sinks> (see sinks.py) <block> samples at a time, as
+    (frames, channels) arrays.
+
+    The producer never waits for us. If we fall so far behind that it
+    overwrites samples we have not read, we skip to the newest sample and
+    count what we lost in dropped.
+    """
+    def __init__(self, tap, sinks, channels=1, block=2**12, interval=0.01):
+        """
+        interval (float): how long the thread sleeps when there is less
+                          than a block to read
+        """
+        self.tap      = tap
+        self.sinks    = list(sinks)
+        self.channels = channels
+        self.block    = block - block % channels
+        self.interval = interval
+        self.errors   = []
+        self.read     = 0
+        self.dropped  = 0
+
+        self.__frame   = np.empty(self.block, tap.ring.raw.dtype)
+        self.__thread  = None
+        self.__running = False
+
+    def start(self):
+        """ Begin reading on a background thread """
+        if self.__thread is not None:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__serve, name='TapReader')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __serve(self):
+        while self.__running:
+            if not self.__drain(self.block):
+                time.sleep(self.interval)
+
+    def __drain(self, least):
+        """ Write blocks while at least <least> samples are available.
+        Returns False if there were not.
+        """
+        tap = self.tap
+        if tap.available < least:
+            return False
+        while tap.available >= least:
+            number = min(tap.available, self.block)
+            number -= number % self.channels
+            if number == 0:
+                break
+            try:
+                frames = tap.read(number, out=self.__frame[:number])
+            except RingOverrun:
+                # Whole frames only, so the channels stay in order
+                published = tap.ring.published
+                skipped = published - tap.sequence
+                skipped -= skipped % self.channels
+                self.dropped += skipped
+                tap.sequence += skipped
+                continue
+            self.read += number
+            for sink in list(self.sinks):
+                try:
+                    sink.write(frames.reshape(-1, self.channels))
+                except Exception as e:
+                    # Keep the other sinks going
+                    self.errors.append((sink, e))
+                    self.sinks.remove(sink)
+        return True
+
+    def close(self):
+        """ Write everything published so far, stop the thread, close the
+        sinks and the tap. Call this after the producer has stopped.
+        """
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.__drain(1)
+        for sink in self.sinks:
+            sink.close()
+        self.tap.close()
+
+
+class RingOverrun(RingPointerWarning):
+    pass
@@ -0,0 +1,124 @@
+"""
+The audio callback, without the sound card.
+
+run.py opens a sounddevice stream and passes Engine.audio_callback to it.
+simulate.py calls the same method from a fake device, so the code that runs
+in a simulation is the code that runs live.
+"""
+import numpy as np
+
+
+class Engine(object):
+    """ Append the input to the ring, run the OSC handlers, and fill the
+    output with the voices of a StretchGroup. Times each part of the
+    callback in <callback_stats> (a CallbackStats with the sections 'osc',
+    'append' and 'stretch').
+    """
+    def __init__(self, input_buffer, stretch_group, osc_io, blocksize,
+                 callback_stats, status=None, verbose=True, output_writer=None,
+                 stem_writer=None, capture=None):
+        """
+        status: the flags we start from when we combine the status of every
+                callback (an sd.CallbackFlags, or anything that supports |)
+        verbose (bool): print a line when a voice is activated or fades out
+        output_writer (SinkWriter): also hand the output to these sinks
+        stem_writer (SinkWriter): hand the output of each voice, before
+                                  mixing, to these sinks, one channel per
+                                  voice
+        capture (ConcurrentRing): also publish the input here, for readers
+                                  on other threads or processes
+        """
+        self.input_buffer   = input_buffer
+        self.stretch_group  = stretch_group
+        self.osc_io         = osc_io
+        self.blocksize      = blocksize
+        self.callback_stats = callback_stats
+        self.verbose        = verbose
+        self.output_writer  = output_writer
+        self.stem_writer    = stem_writer
+        self.capture        = capture
+
+        self.cumulated_status = status
+        self.shape            = (0, 0)
+        self.frames_elapsed   = 0
+        self.samples_elapsed  = 0
+        self.previous_energy  = 0
+        # The voice each toggle turned on, by toggle number
+        self.voices           = {}
+
+        osc_io.set_toggle_handler(self.button_callback)
+
+    def button_callback(self, button, state):
+        """ Turning a toggle on takes a voice from the pool (stealing the
+        oldest when every voice is playing) and gives it the toggle's fader
+        and LED. Turning it off fades out that voice, unless it was stolen
+        by another toggle in the meantime.
+        """
+        # touchOSC buttons index at one
+        group = self.stretch_group
+        if state == 0:
+            s = self.voices.pop(button, None)
+            if s is None:
+                return
+            if self.verbose:
+                print('fade out: {0}'.format(s.tap.name))
+            s.fade_out()
+        else:
+            s = self.voices.get(button)
+            if s is None:
+                s = group.get_inactive_stretcher()
+                # A stolen voice no longer belongs to its old toggle
+                for other in [b for b, voice in self.voices.items() if voice is s]:
+                    del self.voices[other]
+                self.voices[button] = s
+                group.assign(s, button)
+            if self.verbose:
+                print('ACTIVATE: {0}'.format(s.tap.name))
+            # Start one window behind the input, so the first hop has a
+            # whole window to read
+            s.tap.index = self.input_buffer.index - 2 ** group.exponent
+            s.activate()
+
+    def audio_callback(self, indata, outdata, frames, time, status):
+        callback_stats = self.callback_stats
+        input_buffer   = self.input_buffer
+        callback_stats.begin()
+        if self.cumulated_status is None:
+            self.cumulated_status = status
+        else:
+            self.cumulated_status |= status
+
+        # np.shape(indata) will equal (frames, in_channels) where frames is the
+        # number of samples provided by sounddevice, and in_channels is the
+        # number of input channels.
+
+        # run the handlers for OSC events received by the network thread
+        self.osc_io.step()
+        callback_stats.mark('osc')
+
+        if self.shape != np.shape(indata):
+            self.shape = np.shape(indata)
+            if self.verbose:
+                print('input shape: {0}'.format(np.shape(indata)))
+
+        audio_input = indata.flatten()
+        input_buffer.append(audio_input)
+        # Never waits, the readers keep up or lose samples
+        if self.capture is not None:
+            self.capture.append(audio_input)
+        callback_stats.mark('append')
+
+        results = self.stretch_group.step(self.blocksize)
+        outdata[:] = results
+        # Only copies, the writing happens on the writers' threads
+        if self.output_writer is not None:
+            self.output_writer.write(outdata)
+        if self.stem_writer is not None:
+            self.stem_writer.write(self.stretch_group.voice_output.T)
+        callback_stats.mark('stretch')
+
+        # How many frames have we processed
+        self.samples_elapsed += self.shape[0]
+        self.frames_elapsed += 1
+        self.previous_energy = np.sum(outdata ** 2)
+        callback_stats.end(status)
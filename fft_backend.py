@@ -0,0 +1,211 @@
+"""
+Real FFT backends for the stretcher.
+
+A plan is created for a particular (rows, size) shape and dtype, and owns
+preallocated spectrum and output buffers, so repeated transforms of the same
+shape do not allocate new arrays (numpy.fft is the exception, see NumpyFFT).
+Each thread gets its own plans, so workers never share buffers.
+
+Planning can be slow (pyfftw measures several algorithms), so code that
+transforms on the audio thread makes all of its plans up front, in a Plans.
+
+numpy's pocketfft is always available. scipy.fft and pyfftw are used when
+they are installed. select_fastest times every available backend for each
+window size, and get_plan then uses the winner for that size.
+"""
+import importlib
+import threading
+import timeit
+
+import numpy as np
+
+
+def complex_dtype(dtype):
+    return np.result_type(np.dtype(dtype), np.complex64)
+
+
+class NumpyFFT(object):
+    """ numpy.fft computes in double precision and returns new arrays. The
+    results are copied in to our buffers, in the precision of the audio.
+    """
+    name = 'numpy'
+
+    @staticmethod
+    def available():
+        return True
+
+    def __init__(self, shape, dtype):
+        self.size     = shape[-1]
+        self.spectrum = np.zeros(shape[:-1] + (self.size // 2 + 1,), complex_dtype(dtype))
+        self.output   = np.zeros(shape, dtype)
+
+    def rfft(self, x):
+        self.spectrum[...] = np.fft.rfft(x, axis=-1)
+        return self.spectrum
+
+    def irfft(self, spectrum):
+        self.output[...] = np.fft.irfft(spectrum, n=self.size, axis=-1)
+        return self.output
+
+
+class ScipyFFT(NumpyFFT):
+    """ scipy.fft keeps single precision input in single precision, and can
+    split a batch of rows across threads.
+    """
+    name = 'scipy'
+    workers = None
+
+    @staticmethod
+    def available():
+        try:
+            importlib.import_module('scipy.fft')
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self, shape, dtype):
+        super(ScipyFFT, self).__init__(shape, dtype)
+        import scipy.fft
+        self.__fft = scipy.fft
+
+    def rfft(self, x):
+        self.spectrum[...] = self.__fft.rfft(x, axis=-1, workers=self.workers)
+        return self.spectrum
+
+    def irfft(self, spectrum):
+        self.output[...] = self.__fft.irfft(spectrum, n=self.size, axis=-1,
+                                            overwrite_x=True, workers=self.workers)
+        return self.output
+
+
+class FFTWFFT(object):
+    """ pyfftw plans each shape once. The transforms write directly in to
+    the plan's aligned buffers, so nothing is allocated per call.
+    """
+    name = 'fftw'
+    threads = 1
+
+    @staticmethod
+    def available():
+        try:
+            importlib.import_module('pyfftw')
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self, shape, dtype):
+        import pyfftw
+        import pyfftw.builders
+        self.size = shape[-1]
+        real = pyfftw.empty_aligned(shape, dtype=dtype)
+        spectrum = pyfftw.empty_aligned(shape[:-1] + (self.size // 2 + 1,), dtype=complex_dtype(dtype))
+        self.__forward = pyfftw.builders.rfft(real, axis=-1, threads=self.threads,
+                                              planner_effort='FFTW_MEASURE')
+        self.__inverse = pyfftw.builders.irfft(spectrum, n=self.size, axis=-1, threads=self.threads,
+                                               planner_effort='FFTW_MEASURE')
+        self.spectrum = self.__forward.output_array
+        self.output   = self.__inverse.output_array
+
+    def rfft(self, x):
+        return self.__forward(x)
+
+    def irfft(self, spectrum):
+        return self.__inverse(spectrum)
+
+
+backends = [NumpyFFT, ScipyFFT, FFTWFFT]
+
+# The backend to use for each window size. Sizes that are not listed use
+# default_backend.
+default_backend = NumpyFFT
+preferred = {}
+
+local = threading.local()
+
+
+def available_backends():
+    return [backend for backend in backends if backend.available()]
+
+
+def get_plan(shape, dtype):
+    """ Get this thread's plan for transforming real arrays of <shape> """
+    if not hasattr(local, 'plans'):
+        local.plans = {}
+    key = (tuple(shape), np.dtype(dtype))
+    if key not in local.plans:
+        backend = preferred.get(shape[-1], default_backend)
+        local.plans[key] = backend(tuple(shape), dtype)
+    return local.plans[key]
+
+
+class Plans(object):
+    """ Plans for every window size in <sizes>, made up front. Batches of
+    1, 2, 4 .. rows are planned, up to the first power of two that holds
+    <max_rows>. Any number of rows is transformed in batches of those sizes
+    (see batches), so nothing is planned or allocated when the number of
+    rows changes.
+
+    A Plans must only be used by one thread at a time.
+    """
+    def __init__(self, sizes, dtype, max_rows=1):
+        self.dtype    = np.dtype(dtype)
+        self.max_rows = 1
+        while self.max_rows < max_rows:
+            self.max_rows *= 2
+        self.__plans = {}
+        for size in sizes:
+            backend = preferred.get(size, default_backend)
+            rows = 1
+            while rows <= self.max_rows:
+                self.__plans[(rows, size)] = backend((rows, size), self.dtype)
+                rows *= 2
+
+    def batches(self, rows):
+        """ Split <rows> rows in to (first row, number of rows) batches that
+        we have plans for, largest first
+        """
+        result = []
+        first = 0
+        count = self.max_rows
+        while first < rows:
+            while count > rows - first:
+                count //= 2
+            result.append((first, count))
+            first += count
+        return result
+
+    def get_plan(self, shape, dtype):
+        """ The plan for transforming real arrays of <shape>, which must be
+        one we made up front
+        """
+        if np.dtype(dtype) != self.dtype:
+            raise TypeError('planned for {0}, not {1}'.format(self.dtype, np.dtype(dtype)))
+        return self.__plans[tuple(shape)]
+
+
+def benchmark(backend, size, dtype, rows=1, number=20):
+    """ Seconds per forward and inverse transform pair """
+    plan = backend((rows, size), dtype)
+    x = np.random.randn(rows, size).astype(dtype)
+
+    def pair():
+        plan.irfft(plan.rfft(x))
+    pair()
+    return min(timeit.repeat(pair, number=number, repeat=3)) / number
+
+
+def select_fastest(sizes, dtype=None, rows=1):
+    """ Time every available backend at each window size, and use the
+    fastest from now on. Returns a {size: (backend name, seconds)} dict.
+    """
+    results = {}
+    for size in sizes:
+        timings = [(benchmark(backend, size, dtype, rows), backend)
+                   for backend in available_backends()]
+        seconds, backend = min(timings, key=lambda t: t[0])
+        preferred[size] = backend
+        results[size] = (backend.name, seconds)
+    # Plans made before the selection may use the wrong backend
+    if hasattr(local, 'plans'):
+        local.plans.clear()
+    return results
@@ -0,0 +1,90 @@
+"""
+Random phases for paulstretch.
+
+Every hop of every voice needs one random unit phasor per frequency bin.
+A PhaseGenerator owns its own random generator, so a voice can be seeded for
+reproducible renders without touching numpy's global random state, and
+voices rendered on different threads do not share a generator.
+
+Computing e^(i * uniform(0, 2pi)) for every bin of every hop is a full pass
+of transcendental functions. With <tables> > 0, a generator instead copies a
+randomly chosen row of a precomputed table of phasors, rotated by a random
+number of bins. The tables are shared by every generator.
+"""
+import numpy as np
+
+# Precomputed phasor tables keyed by (bins, count, dtype)
+phasor_tables = {}
+# The tables are the same for every run, so seeded renders stay reproducible
+table_seed = 0x5eed
+
+
+def make_rng(seed=None):
+    """ A np.random.Generator, or a RandomState on numpy older than 1.17 """
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(seed)
+    return np.random.RandomState(seed)
+
+
+def random_integers(rng, high, size):
+    """ <size> random integers in [0, high) from either kind of generator """
+    if hasattr(rng, 'integers'):
+        return rng.integers(0, high, size)
+    return rng.randint(0, high, size)
+
+
+def random_angles(rng, out):
+    """ Fill <out> with random angles in [0, 2pi) from either kind of
+    generator. A Generator draws straight in to <out>. A RandomState cannot,
+    so it draws in to a temporary array first.
+    """
+    if hasattr(rng, 'integers'):
+        rng.random(out=out, dtype=out.dtype)
+    else:
+        out[...] = rng.random_sample(out.shape)
+    out *= 2 * np.pi
+    return out
+
+
+def get_phasor_table(bins, count, dtype):
+    key = (bins, count, np.dtype(dtype))
+    if key not in phasor_tables:
+        angles = make_rng(table_seed).uniform(0, 2 * np.pi, (count, bins))
+        phasor_tables[key] = np.exp(angles * 1j).astype(dtype)
+    return phasor_tables[key]
+
+
+class PhaseGenerator(object):
+    def __init__(self, seed=None, tables=0):
+        """
+        seed (int): seed for a reproducible sequence of phases
+        tables (int): if greater than 0, draw phases from this many
+                      precomputed tables instead of calculating new ones
+        """
+        self.rng    = make_rng(seed)
+        self.tables = int(tables)
+        # Scratch space for the angles of one fill, grown when a fill needs
+        # more than it holds
+        self.__angles = np.empty(0)
+
+    def fill(self, out):
+        """ Fill the complex (rows, bins) array <out> with random unit phasors,
+        independent for every row and bin
+        """
+        rows, bins = out.shape
+        if self.tables <= 0:
+            dtype = out.real.dtype
+            if self.__angles.size < out.size or self.__angles.dtype != dtype:
+                self.__angles = np.empty(out.size, dtype)
+            angles = random_angles(self.rng, self.__angles[:out.size].reshape(out.shape))
+            np.cos(angles, out=out.real)
+            np.sin(angles, out=out.imag)
+            return out
+
+        table = get_phasor_table(bins, self.tables, out.dtype)
+        choices = random_integers(self.rng, self.tables, rows)
+        rotations = random_integers(self.rng, bins, rows)
+        for row, t, r in zip(out, choices, rotations):
+            row[:bins - r] = table[t, r:]
+            row[bins - r:] = table[t, :r]
+        return out
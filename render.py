@@ -0,0 +1,140 @@
+"""
+Render a stretched copy of an audio file, without a sound card or OSC.
+
+    $ python render.py input.wav output.wav --stretch 8
+
+Long inputs are split in to segments of whole hops. Each segment is
+stretched independently on a process pool, and the segments are joined with
+the same open/close overlap-add windows that Stretcher uses between hops, so
+the joins are indistinguishable from the rest of the output.
+"""
+import argparse
+import multiprocessing
+
+import numpy as np
+from scipy.io import wavfile
+
+from ring import Ring
+from fft_backend import complex_dtype
+from sinks import read_wav
+from stretcher import Stretcher, get_strech, stretch_frames
+
+# How many hops we send through stretch_frames at once
+batch_hops = 32
+
+
+def hop_count(num_samples, sw, stretch_amount):
+    """ How many complete windows fit in <num_samples> of input """
+    if num_samples < sw.size:
+        return 0
+    return (num_samples - sw.size) // sw.hopsize(stretch_amount) + 1
+
+
+def render_segment(job):
+    """ Stretch one segment of one channel.
+
+    <job> is a (samples, windowsize, stretch_amount, seed) tuple, where
+    <samples> holds exactly the input needed for the segment's hops.
+
+    Returns (body, tail). body holds sw.half samples for each hop. tail is
+    the closed end of the last hop, which must be overlap-added to the
+    beginning of the next segment's body.
+    """
+    samples, windowsize, stretch_amount, seed = job
+
+    sw = get_strech(windowsize, samples.dtype)
+    num_hops = hop_count(len(samples), sw, stretch_amount)
+
+    # The ring is one sample larger than the input, so that the whole input
+    # is valid for a tap at index 0
+    ring = Ring(len(samples) + 1, samples.dtype)
+    ring.append(samples)
+    tap = ring.create_tap()
+    tap.index = 0
+    stretcher = Stretcher(tap, seed=seed)
+
+    body = np.empty(num_hops * sw.half, samples.dtype)
+    frames = np.empty((batch_hops, sw.size), samples.dtype)
+    phasors = np.empty((batch_hops, sw.half + 1), complex_dtype(samples.dtype))
+    for first in range(0, num_hops, batch_hops):
+        rows = slice(0, min(batch_hops, num_hops - first))
+        stretcher.read_frames(sw, stretch_amount, frames[rows], phasors[rows])
+        for i, row in enumerate(stretch_frames(sw, frames[rows], phasors[rows])):
+            start = (first + i) * sw.half
+            body[start:start + sw.half] = stretcher.overlap_add(sw, row)
+
+    return body, stretcher.close(sw)
+
+
+def segment_jobs(audio, windowsize, stretch_amount, segment_hops, seed=None):
+    """ Split a (num_samples, channels) array in to jobs for render_segment.
+
+    Returns a list of (channel, job) pairs in output order.
+    """
+    sw = get_strech(windowsize, audio.dtype)
+    hop = sw.hopsize(stretch_amount)
+    num_hops = hop_count(len(audio), sw, stretch_amount)
+
+    jobs = []
+    for channel in range(audio.shape[1]):
+        for first in range(0, num_hops, segment_hops):
+            last = min(first + segment_hops, num_hops)
+            samples = audio[first * hop:(last - 1) * hop + sw.size, channel]
+            job_seed = None if seed is None else seed + len(jobs)
+            jobs.append((channel, (np.ascontiguousarray(samples), windowsize, stretch_amount, job_seed)))
+    return jobs
+
+
+def stitch(results, half):
+    """ Overlap-add the (body, tail) results of consecutive segments """
+    output = np.concatenate([body for body, tail in results] + [results[-1][1]])
+    position = 0
+    for body, tail in results[:-1]:
+        position += len(body)
+        output[position:position + half] += tail
+    return output
+
+
+def render(audio, windowsize=2**14, stretch_amount=8, segment_hops=64, processes=None, seed=None):
+    """ Stretch a (num_samples, channels) array, using all available cores """
+    sw = get_strech(windowsize, audio.dtype)
+    if len(audio) < sw.size:
+        # Pad short inputs, so that we get at least one window
+        audio = np.concatenate([audio, np.zeros((sw.size - len(audio), audio.shape[1]), audio.dtype)])
+
+    jobs = segment_jobs(audio, windowsize, stretch_amount, segment_hops, seed)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(render_segment, [job for channel, job in jobs])
+    finally:
+        pool.close()
+        pool.join()
+
+    channels = []
+    for channel in range(audio.shape[1]):
+        mine = [r for (c, job), r in zip(jobs, results) if c == channel]
+        channels.append(stitch(mine, sw.half))
+    return np.column_stack(channels)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stretch an audio file offline')
+    parser.add_argument('input', help='wav file to stretch')
+    parser.add_argument('output', help='where to write the stretched wav file')
+    parser.add_argument('--stretch', type=float, default=8., help='stretch amount')
+    parser.add_argument('--exponent', type=int, default=14, help='window size is 2 ** exponent')
+    parser.add_argument('--segment', type=float, default=30.,
+                        help='seconds of input per segment sent to each process')
+    parser.add_argument('--processes', type=int, default=None, help='defaults to the number of cores')
+    parser.add_argument('--seed', type=int, default=None, help='seed for a reproducible render')
+    args = parser.parse_args()
+
+    samplerate, audio = read_wav(args.input)
+    windowsize = 2 ** args.exponent
+    hop = get_strech(windowsize).hopsize(args.stretch)
+    segment_hops = max(1, int(args.segment * samplerate / hop))
+
+    print('input:  {0:.1f} seconds, {1} channels'.format(len(audio) / float(samplerate), audio.shape[1]))
+    output = render(audio, windowsize, args.stretch, segment_hops, args.processes, args.seed)
+    print('output: {0:.1f} seconds'.format(len(output) / float(samplerate)))
+    wavfile.write(args.output, samplerate, output)
@@ -3,20 +3,44 @@ import weakref
 import random
 import string
 import sys
+
+from ring_index import MaxTree, BlockPositions, EnergyPyramid
+from spectral import SpectralAnnotator
+from storage import MemoryStorage
+
 eps = np.finfo(float).eps
 
 
 class Ring(object):
     """
+    A fixed length circular buffer of audio samples.
 
+    The arrays of a ring are created by its <storage> (see storage.py). By
+    default they live in memory. A FileStorage keeps them in a file, so the
+    ring can be reopened after a restart.
     """
-    def __init__(self, length, dtype=None):
-        self.__index         = 0 # where we will place the next sample (not the last sample placed)
-        self.__content       = np.zeros(length, dtype)
+    def __init__(self, length, dtype=None, storage=None):
+        if storage is None:
+            storage = MemoryStorage()
+        self.__storage       = storage
+        self.__content       = storage.allocate('content', length, dtype)
+        # The index is mirrored in to storage, so that a stored ring resumes
+        # where it left off
+        self.__stored_index  = storage.allocate('index', 1, 'int64')
+        self.__index         = int(self.__stored_index[0]) # where we will place the next sample (not the last sample placed)
         self.__length        = length
         self.__active_taps   = {}
         self.__inactive_taps = {}
 
+        # Every tap added to the ring also has a slot in these parallel
+        # arrays, so that append can check all of them at once. They grow
+        # as taps are added.
+        self.__taps          = []
+        self.__tap_positions = np.zeros(8, 'int64')  # each tap's raw index
+        self.__tap_active    = np.zeros(8, 'bool')
+        self.__tap_distance  = np.zeros(8, 'int64')  # scratch for append
+        self.__tap_at_risk   = np.zeros(8, 'bool')   # scratch for append
+
     def __setitem__(self, key, value):
         raise TypeError('Ring only supports assignment through the .append method')
 
@@ -40,31 +64,68 @@ class Ring(object):
         """
         return (self.__index + i - 1)  % self.__length
 
-    def recent(self, size):
+    def recent(self, size, out=None):
         """
         Get the <size> most recently appended samples
+
+        If <out> is supplied the samples are copied in to it and <out> is
+        returned. <out> must be <size> samples long. This never allocates,
+        even when the read wraps around the end of the ring, which makes it
+        safe to call from the audio callback.
         """
         if size <= self.__index:
-            return self.__content[self.__index - size:self.__index]
+            if out is None:
+                return self.__content[self.__index - size:self.__index]
+            out[:] = self.__content[self.__index - size:self.__index]
+            return out
 
         # we need to wrap
         if size > self.__length:
             raise IndexError('larger than current buffer size')
 
-        last_part = self.__content[:self.__index]
-        first_part = self.__content[-(size - len(last_part)):]
-        return np.concatenate([first_part, last_part])
+        if out is None:
+            out = np.empty(size, self.__content.dtype)
+
+        # number of samples that come from the end of the raw buffer
+        len1 = size - self.__index
+        out[:len1] = self.__content[self.__length - len1:]
+        out[len1:] = self.__content[:self.__index]
+        return out
+
+    def recent_views(self, size):
+        """
+        Views of the <size> most recently appended samples, oldest first:
+        one view, or two when they wrap around the end of the ring. Writing
+        to the views changes the ring in place.
+        """
+        if size <= self.__index:
+            return (self.__content[self.__index - size:self.__index],)
+        if size > self.__length:
+            raise IndexError('larger than current buffer size')
+        len1 = size - self.__index
+        return (self.__content[self.__length - len1:], self.__content[:self.__index])
 
     def append(self, items):
         count = len(items)
 
-        # We cannot use iteritems because deactivate() modifies __active_taps.
-        # We must use items instead.
-        for name, tap in self.__active_taps.items():
-            if tap.valid_ring_space < count:
-                print 'Tap deactivated: {0}'.format(name)
-                tap.valid = False
-                tap.deactivate()
+        # A tap is overrun when its valid_ring_space is less than <count>.
+        # valid_ring_space is length - 1 - distance, where distance is how
+        # far the tap is behind the last sample. We find the distance of
+        # every tap at once, and only visit the taps that are overrun.
+        taps = len(self.__taps)
+        if taps:
+            distance = self.__tap_distance[:taps]
+            at_risk  = self.__tap_at_risk[:taps]
+            np.subtract(self.index_of(0), self.__tap_positions[:taps], out=distance)
+            np.remainder(distance, self.__length, out=distance)
+            np.greater_equal(distance, self.__length - count, out=at_risk)
+            at_risk &= self.__tap_active[:taps]
+            if at_risk.any():
+                for slot in np.nonzero(at_risk)[0]:
+                    tap = self.__taps[slot]
+                    print 'Tap deactivated: {0}'.format(tap.name)
+                    tap.valid = False
+                    tap.deactivate()
 
         # In the most common case, we don't have to loop around
         if self.__index + count <= self.__length:
@@ -84,9 +145,11 @@ class Ring(object):
 
         self.__index += count
         self.__index %= self.__length
+        self.__stored_index[0] = self.__index
 
     def rewind(self, amount):
         self.__index = (self.__index - amount) % len(self)
+        self.__stored_index[0] = self.__index
 
     def create_tap(self):
         tap = RingTap(self)
@@ -98,10 +161,34 @@ class Ring(object):
             raise NameError('a tap named {0} already exists'.format(tap.name))
         self.__active_taps[tap.name] = tap
 
+        slot = len(self.__taps)
+        if slot == len(self.__tap_positions):
+            self.__tap_positions = grow(self.__tap_positions)
+            self.__tap_active    = grow(self.__tap_active)
+            self.__tap_distance  = grow(self.__tap_distance)
+            self.__tap_at_risk   = grow(self.__tap_at_risk)
+        self.__taps.append(tap)
+        tap.slot = slot
+        self.__tap_positions[slot] = tap.index
+        self.__tap_active[slot] = True
+
+    def move_tap(self, tap):
+        """ Record the new index of <tap>. Taps call this when they move. """
+        if tap.slot is not None:
+            self.__tap_positions[tap.slot] = tap.index
+
+    def set_tap_active(self, tap, active):
+        if tap.slot is not None:
+            self.__tap_active[tap.slot] = active
+
     @property
     def raw(self):
         return self.__content
 
+    @property
+    def storage(self):
+        return self.__storage
+
     @property
     def index(self):
         return self.__index
@@ -133,6 +220,9 @@ class RingTap(object):
         # Are all the samples between here and the ring[0] valid?
         self.valid = True
 
+        # Our position in the ring's tap arrays, set by ring.add_tap
+        self.slot = None
+
         # note that the __ring_index is a index OF the ring.__content
         self.index = self.get_ring().index_of(0)
 
@@ -143,12 +233,14 @@ class RingTap(object):
         if self.name in ring.inactive_taps:
             del ring.inactive_taps[self.name]
         ring.active_taps[self.name] = self
+        ring.set_tap_active(self, True)
 
     def deactivate(self):
         ring = self.get_ring()
         if self.name in ring.active_taps:
             del ring.active_taps[self.name]
         ring.inactive_taps[self.name] = self
+        ring.set_tap_active(self, False)
 
     def advance(self, amount):
         """ advance the index by <amount> samples """
@@ -162,8 +254,15 @@ class RingTap(object):
         self.__samples_elapsed += amount
         self.__ring_index += amount
         self.__ring_index %= len(ring)
+        ring.move_tap(self)
 
-    def get_samples(self, number):
+    def get_samples(self, number, out=None):
+        """ Get <number> samples starting at our index.
+
+        If <out> is supplied, the samples are copied in to it and <out> is
+        returned. <out> must be <number> samples long. Without <out>, a read
+        that wraps around the end of the ring allocates a new array.
+        """
         if number > self.valid_buffer_length or number < 0:
             print('get_sample argument out of range')
             raise BufferError('get_sample agrument out of range')
@@ -171,10 +270,14 @@ class RingTap(object):
         ring = self.get_ring()
         first_part = ring.raw[self.index:self.index + number]
         missing_sample_count = number - len(first_part)
-        if missing_sample_count == 0:
-            return first_part
-        else:
-            return np.concatenate((first_part, ring.raw[:missing_sample_count]))
+        if out is None:
+            if missing_sample_count == 0:
+                return first_part
+            out = np.empty(number, ring.raw.dtype)
+
+        out[:len(first_part)] = first_part
+        out[len(first_part):] = ring.raw[:missing_sample_count]
+        return out
 
     @property
     def valid_buffer_length(self):
@@ -208,9 +311,11 @@ class RingTap(object):
     def index(self, i):
         """ set the index of ring.__content[index]. Assume i is a valid index
         """
-        self.__ring_index = i % len(self.get_ring())
+        ring = self.get_ring()
+        self.__ring_index = i % len(ring)
         self.valid = True
         self.__samples_elapsed = 0
+        ring.move_tap(self)
 
     @property
     def samples_elapsed(self):
@@ -229,22 +334,63 @@ class AnnotatedRing(Ring):
     Metadata is stored in arrays of size <num_blocks>. A block_index refers to
     the index of one of these lower resolution arrays that are in parallel
     to the audio arrays.
+
+    The metadata arrays are created by the same <storage> as the audio, so
+    with a FileStorage the audio and its metadata share one file.
+
+    With <spectral_bands> greater than 0, each block is also summarised in
+    that many spectral bands, and spectral flux onsets are found (see
+    spectral.py). At most <spectral_budget> blocks are analysed per append.
     """
-    def __init__(self, num_blocks, blocksize=512, dtype=None):
-        super(AnnotatedRing, self).__init__(num_blocks * blocksize, dtype=dtype)
+    def __init__(self, num_blocks, blocksize=512, dtype=None, storage=None,
+                 spectral_bands=0, spectral_budget=32):
+        super(AnnotatedRing, self).__init__(num_blocks * blocksize, dtype=dtype, storage=storage)
         self.__num_blocks = num_blocks
         self.__blocksize  = int(blocksize)
-        self.__energy     = np.zeros(num_blocks)
-        self.__transients = np.zeros(num_blocks, dtype='bool')
+        self.__energy     = self.storage.allocate('energy', num_blocks)
+        self.__transients = self.storage.allocate('transients', num_blocks, dtype='bool')
 
         if num_blocks <= 1:
             raise Exception('Annotated Ring requires two or more blocks')
 
-        # Space to store rfft of each block
-        # self.__spectrum  = np.zeros((num_blocks, blocksize), dtype='complex128')
-
         # Difference in db between this block and the one before it
-        self.__diff_db = np.zeros(num_blocks)
+        self.__diff_db = self.storage.allocate('diff_db', num_blocks)
+
+        # The largest absolute sample in each block
+        self.__peak = self.storage.allocate('peak', num_blocks, 'float32')
+
+        # A (num_blocks, blocksize) view of the raw content. Row i holds the
+        # samples of block_index i.
+        self.__blocks = self.raw.reshape(num_blocks, self.__blocksize)
+
+        # How many blocks have been annotated. This is the absolute block
+        # number of the next block we will annotate. Absolute block number a
+        # is stored at block_index a % num_blocks. It is mirrored in to
+        # storage like the index, because it cannot be recovered from the
+        # index once the ring has wrapped. Files written before it was stored
+        # hold 0, and fall back to the index.
+        self.__stored_blocks_done = self.storage.allocate('blocks_done', 1, 'int64')
+        self.__blocks_done = int(self.__stored_blocks_done[0]) or self.index // self.__blocksize
+
+        # Indexes over the metadata (see ring_index.py). These are kept in
+        # memory and rebuilt from the metadata arrays, which matters when the
+        # arrays come from an existing file.
+        self.__energy_tree = MaxTree(self.__energy)
+        # Energy, peak and RMS at coarser resolutions. The levels above the
+        # blocks are stored next to the other metadata.
+        self.__pyramid = EnergyPyramid(self.__energy, self.__peak, self.__blocksize, self.storage)
+        self.__transient_positions = BlockPositions(num_blocks)
+        self.__transient_positions.extend(
+            sorted(self.block_position(i) for i in np.nonzero(self.__transients)[0]
+                   if self.block_position(i) >= 0),
+            self.__blocks_done)
+
+        # Band levels, flux and onsets of each block
+        self.__spectral = None
+        if spectral_bands > 0:
+            self.__spectral = SpectralAnnotator(num_blocks, self.__blocksize, self.storage,
+                                                spectral_bands, spectral_budget)
+            self.__spectral.resume(self.block_position, self.__blocks_done)
 
     def append(self, items):
         # How far in to the most recent boundary is the index
@@ -259,62 +405,81 @@ class AnnotatedRing(Ring):
         # Now we can actually append the items
         super(AnnotatedRing, self).append(items)
 
-        # Create a python list of of the indicies of self.__energy that we will
-        # update. For example if num_blocks==4, this might be [3, 0, 1]
-        block_indices = [
-            ((first_boundary_index + i) % len(self.__energy))
-            for i in range(boundaries_crossed)]
-
-        if len(block_indices) == 0:
-            return 0
+        if boundaries_crossed > 0:
+            self.__annotate(first_boundary_index, boundaries_crossed)
 
-        self.__annotate(block_indices)
+        # Blocks that did not fit in an earlier append's budget are analysed
+        # first, and even appends that complete no blocks work through the
+        # backlog, so this may briefly lag behind the broadband annotations
+        if self.__spectral is not None:
+            self.__spectral.analyse(self.__blocks, self.__blocks_done)
 
         return boundaries_crossed
 
-    def __annotate(self, block_indices):
-        """ Add annotations to block indices supplied by the <indices> array
+    def __annotate(self, first_block_index, count):
+        """ Add annotations to <count> blocks, beginning with first_block_index
 
         Used only internally to analyze recently added blocks.
 
-        block_indices refers to the indices of blocks where we store our metadata
+        block indices refer to the indices of blocks where we store our metadata
 
         Two examples:
 
         1. if our blocksize is 512, block_index 0 would refer to the
         first 512 samples in the self.raw array
 
-        2. For example if num_blocks==4, this might be [3, 0, 1]
+        2. For example if num_blocks==4, first_block_index==3 and count==3 we
+        would update blocks [3, 0, 1]
 
-        __annotate assumes that the samples for block_indices are written to
+        __annotate assumes that the samples for the blocks are written to
         self.raw when it is called
         """
+        n = self.__num_blocks
+        stop = first_block_index + count
 
-        # The indices in our raw content where our bondaries start
-        raw_indices = [i * self.__blocksize for i in block_indices]
-
-        # A python array of the numpy arrays, each containing a region of the
-        # raw content. Note that indexing numpy arrays in this way creates a
-        # reference (not a copy).
-        regions = [self.raw[i:i+self.__blocksize] for i in raw_indices]
-
-        # Convert the arrays to linear (not dB) energy
-        energy = [np.sum(np.abs(r) ** 2) for r in regions]
-        self.__energy[block_indices] = energy
-
-        # We will compare each block with the block before it.
-        # CAREFUL: iterator indexes self.__energy, not local energy variable
-        iterator = [(self.__energy[i], self.__energy[i-1]) for i in block_indices]
-        diffs =[10. * np.log10((eps + i) / (eps + p)) for i, p in iterator]
-
-        self.__diff_db[block_indices] = diffs
-
-        # Are there any transients?
-        transients = np.array(diffs) > 20.
-        self.__transients[block_indices] = transients
-
-        # sys.stdout.write("{: >9.3f} {: >9.3f} \r".format(np.max(diffs), np.min(diffs)))
-        # sys.stdout.flush()
+        # The blocks we update are contiguous, unless they wrap around the
+        # end of the ring. Each span is a (start, stop) pair of block indices.
+        if stop <= n:
+            spans = [(first_block_index, stop)]
+        else:
+            spans = [(first_block_index, n), (0, stop - n)]
+
+        # self.__blocks is a (num_blocks, blocksize) view of self.raw, so each
+        # span of rows references the raw content without copying it. The
+        # energy of every block in a span is a row-wise dot product.
+        for start, stop in spans:
+            blocks = self.__blocks[start:stop]
+            np.einsum('ij,ij->i', blocks, blocks, out=self.__energy[start:stop])
+            self.__peak[start:stop] = np.max(np.abs(blocks), axis=1)
+
+        # We will compare each block with the block before it. All the energy
+        # must be updated first, because the block before a span may be one
+        # we just updated (when the span begins at block 0).
+        for start, stop in spans:
+            energy   = self.__energy[start:stop]
+            previous = np.empty(stop - start)
+            previous[0]  = self.__energy[start - 1]
+            previous[1:] = self.__energy[start:stop - 1]
+
+            diffs = self.__diff_db[start:stop]
+            diffs[:] = 10. * np.log10((eps + energy) / (eps + previous))
+
+            # Are there any transients?
+            self.__transients[start:stop] = diffs > 20.
+
+        # Update the indexes. Blocks are annotated in order, so the absolute
+        # block numbers of new transients are always increasing.
+        positions = []
+        position = self.__blocks_done
+        for start, stop in spans:
+            self.__energy_tree.update(start, self.__energy[start:stop])
+            self.__pyramid.update(start, stop)
+            found = np.nonzero(self.__transients[start:stop])[0]
+            positions.extend((found + position).tolist())
+            position += stop - start
+        self.__blocks_done += count
+        self.__stored_blocks_done[0] = self.__blocks_done
+        self.__transient_positions.extend(positions, self.__blocks_done)
 
     def create_tap(self):
         tap = AnnotatedRingTap(self)
@@ -355,17 +520,92 @@ class AnnotatedRing(Ring):
         return self.__transients[indices]
 
     def last_transient_block_index(self, number_to_check=None):
-        """ Get the block index of the most recent transient. What we probably
-        actually want is the distance of the last transient from the index.
+        """ Of the <number_to_check> most recently updated blocks, how many
+        blocks back from the most recent is the oldest transient? This is
+        the last transient we reach while looking back through the blocks.
         """
         if number_to_check is None:
             number_to_check = self.num_blocks
-        transients = self.recent_transients(number_to_check)
-        transient_indices = np.nonzero(transients)[0]
-        if len(transient_indices) is 0:
+        latest = self.__blocks_done - 1
+        found = self.__transient_positions.first_at_or_after(latest - number_to_check + 1)
+        if found is None:
             return None
+        return latest - found
+
+    def block_position(self, block_index):
+        """ The absolute block number of the most recent block written at
+        <block_index>. The most recently updated block is blocks_done - 1.
+        """
+        latest = self.__blocks_done - 1
+        return latest - ((self.previous_updated_block_index - block_index) % self.__num_blocks)
+
+    def next_transient_position(self, position):
+        """ The absolute block number of the first transient at or after the
+        absolute block number <position>, or None
+        """
+        return self.__transient_positions.first_at_or_after(position)
+
+    def next_onset_position(self, position):
+        """ The absolute block number of the first spectral onset at or after
+        the absolute block number <position>, or None
+        """
+        if self.__spectral is None:
+            raise ValueError('AnnotatedRing was created without spectral_bands')
+        return self.__spectral.next_onset_position(position)
+
+    def blocks_back_to_energy(self, block_index, count, value):
+        """ Look back from <block_index> through <count> blocks (including
+        <block_index>, and wrapping around the ring). Return how many blocks
+        back the first block with energy >= <value> is, or None if every
+        block is below <value>.
+        """
+        lo = block_index - count + 1
+        found = self.__energy_tree.last_at_least(max(lo, 0), block_index, value)
+        if found is not None:
+            return block_index - found
+        if lo < 0:
+            found = self.__energy_tree.last_at_least(lo + self.__num_blocks, self.__num_blocks - 1, value)
+            if found is not None:
+                return block_index + self.__num_blocks - found
+        return None
+
+    def summarize(self, block_index, count):
+        """ Summarise <count> blocks, looking back from <block_index> (and
+        wrapping around the ring), using the coarsest cells of the energy
+        pyramid that fit. Returns (energy, peak, rms_db).
+        """
+        lo = block_index - count + 1
+        if lo >= 0:
+            energy, peak = self.__pyramid.summarize(lo, block_index + 1)
         else:
-            return transient_indices[-1]
+            energy, peak = self.__pyramid.summarize(0, block_index + 1)
+            wrapped_energy, wrapped_peak = self.__pyramid.summarize(lo + self.__num_blocks, self.__num_blocks)
+            energy += wrapped_energy
+            peak = max(peak, wrapped_peak)
+        rms_db = 10. * np.log10(eps + energy / (count * self.__blocksize))
+        return energy, peak, rms_db
+
+    def recent_summary(self, number):
+        """ Summarise the <number> most recently updated blocks """
+        return self.summarize(self.previous_updated_block_index, number)
+
+    @property
+    def pyramid(self):
+        return self.__pyramid
+
+    @property
+    def spectral(self):
+        """ The SpectralAnnotator, or None without spectral_bands """
+        return self.__spectral
+
+    @property
+    def peak(self):
+        return self.__peak
+
+    @property
+    def blocks_done(self):
+        """ How many blocks have been annotated since the ring was created """
+        return self.__blocks_done
 
     @property
     def transients(self):
@@ -380,22 +620,65 @@ class AnnotatedRingTap(RingTap):
 
     @property
     def samples_to_next_transient(self):
-        annotated_ring    = self.get_ring()
-        blocksize         = int(annotated_ring.blocksize)
-        valid_indices     = self.valid_indices
-        valid_transients  = annotated_ring.transients[valid_indices]
-        samples_to_border = blocksize - self.position_in_block
+        """ How many samples until the block with the next transient? 0 if
+        there is a transient in our current block, and None if there are no
+        transients between here and the most recently updated block.
+        """
+        if not self.valid:
+            return None
+
+        annotated_ring = self.get_ring()
+        position = annotated_ring.block_position(self.block_index)
+        found = annotated_ring.next_transient_position(position)
+        return self.__samples_to_position(position, found)
+
+    def samples_to_transient_after(self, offset):
+        """ How many samples from <offset> samples after the tap until the
+        block with the next transient? 0 if that block has a transient, and
+        None if no transient has been found between there and the most
+        recently updated block.
+        """
+        if not self.valid:
+            return None
 
-        if len(valid_transients) == 0:
+        annotated_ring = self.get_ring()
+        blocksize = int(annotated_ring.blocksize)
+        sample = annotated_ring.block_position(self.block_index) * blocksize + self.position_in_block + offset
+        position = sample // blocksize
+        found = annotated_ring.next_transient_position(position)
+        if found is None:
             return None
-        elif valid_transients[0]:
+        elif found == position:
             return 0
         else:
-            transient_indices = np.nonzero(valid_transients)[0]
-            if len(transient_indices) == 0:
-                return None
-            else:
-                return samples_to_border + ((transient_indices[0]-1) * blocksize)
+            return found * blocksize - sample
+
+    @property
+    def samples_to_next_onset(self):
+        """ Like samples_to_next_transient, for the spectral onsets of a ring
+        created with spectral_bands. Onsets are only known for the blocks
+        that have been analysed.
+        """
+        if not self.valid:
+            return None
+
+        annotated_ring = self.get_ring()
+        position = annotated_ring.block_position(self.block_index)
+        found = annotated_ring.next_onset_position(position)
+        return self.__samples_to_position(position, found)
+
+    def __samples_to_position(self, position, found):
+        """ Samples from the tap to the absolute block number <found>, where
+        <position> is the absolute block number of the tap's block
+        """
+        blocksize         = int(self.get_ring().blocksize)
+        samples_to_border = blocksize - self.position_in_block
+        if found is None:
+            return None
+        elif found == position:
+            return 0
+        else:
+            return samples_to_border + ((found - position - 1) * blocksize)
 
     @property
     def position_in_block(self):
@@ -480,16 +763,20 @@ class AnnotatedRingTap(RingTap):
         energy = ring.energy[self.previous_valid_indices[:number]]
         return energy
 
-    def energy_db(self):
-        """ Get the most recently upddated energy at this tap. 
+    def energy_db(self, number=1):
+        """ Get the most recently upddated energy at this tap. With <number>
+        greater than 1, get the RMS level of <number> blocks ending at the
+        tap, summarised from the ring's energy pyramid.
         """
         ring = self.get_ring()
+        if number > 1:
+            return ring.summarize(self.block_index, number)[2]
         en = float(ring.energy[self.block_index])
         return 10 * np.log10((en / ring.blocksize))
 
-    def energy_unit(self):
+    def energy_unit(self, number=1):
         """ Get an energy level roughly scaled from 0. to 1. """
-        db = self.energy_db()
+        db = self.energy_db(number)
         db += 80. # approx between 0 and 70
         if db < eps: db = eps
         if db > 70.: db = 70.
@@ -510,15 +797,27 @@ class AnnotatedRingTap(RingTap):
             return is_increasing[0]
 
     def number_below(self, value):
-        """ How many of the previous samples are below <value>?
+        """ How many of the previous blocks are below <value>? We count back
+        from our current block through the blocks in previous_valid_indices.
         """
-        en = self.previous_energy_blocks()
-        is_above = np.array(en) >= float(value)
-        if np.any(is_above):
-            return np.argmax(is_above)
-        else:
-            return len(is_above)
+        if not self.valid:
+            return 0
+        annotated_ring = self.get_ring()
+        count = (self.block_index - annotated_ring.previous_updated_block_index) % annotated_ring.num_blocks
+        # If both indices are in the same block, only our block is valid
+        count = count or 1
+        found = annotated_ring.blocks_back_to_energy(self.block_index, count, float(value))
+        if found is None:
+            return count
+        return found
+
+
 
+def grow(array):
+    """ A copy of <array> with twice the length, padded with zeros """
+    grown = np.zeros(2 * len(array), array.dtype)
+    grown[:len(array)] = array
+    return grown
 
 
 class RingPointerWarning(UserWarning):
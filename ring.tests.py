@@ -1,6 +1,16 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
 import numpy as np
 
-from ring import Ring, RingPointerWarning, AnnotatedRing
+from ring import Ring, RingPointerWarning, AnnotatedRing, eps
+from concurrent_ring import ConcurrentRing, RingOverrun, TapReader
+from storage import FileStorage, SharedStorage
 
 
 def test_tap_activation():
@@ -18,6 +28,33 @@ def test_tap_activation():
     assert s[0] == 99
 
 
+def test_out_arrays():
+    a = Ring(4)
+    a.append([1, 2, 3])
+    out = np.zeros(2)
+    assert a.recent(2, out=out) is out
+    assert np.all(out == [2, 3])
+    a.append([4, 5])
+    # wrapped reads fill the supplied array instead of concatenating
+    out = np.zeros(3)
+    assert a.recent(3, out=out) is out
+    assert np.all(out == [3, 4, 5])
+    # views of wrapped samples write through to the ring
+    views = a.recent_views(3)
+    assert [list(view) for view in views] == [[3, 4], [5]]
+    for view in views:
+        view *= 10
+    assert np.all(a.recent(3) == [30, 40, 50])
+
+    a = Ring(4)
+    a.append([0, 1, 2])
+    p = a.create_tap()
+    a.append([3, 4])
+    out = np.zeros(3)
+    assert p.get_samples(3, out=out) is out
+    assert np.all(out == [2, 3, 4])
+
+
 def test_annotated_ring():
     a = AnnotatedRing(2, 4)
     assert len(a) == 8
@@ -45,6 +82,13 @@ def test_annotated_ring():
     a.append([2, 2])
     assert np.all(a.recent_energy(2) == [16, 100])
 
+    # transients are detected when the annotated blocks wrap around
+    a = AnnotatedRing(3, 4)
+    a.append(np.zeros(8))
+    a.append(np.ones(8) * 10)
+    assert np.all(a.recent_energy(2) == [400, 400])
+    assert np.all(a.recent_transients(2) == [False, True])
+
     # AnnotatedRingTap
     a = AnnotatedRing(3, 4)
     t = a.create_tap()
@@ -56,6 +100,331 @@ def test_annotated_ring():
 
 
 
+def test_file_storage():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'capture.ring')
+        a = AnnotatedRing(3, 4, storage=FileStorage(path))
+        a.append([2, 2, 2, 2])
+        a.append([3, 3, 3, 3, 1])
+        a.storage.flush()
+        del a
+
+        # reopening the file restores the audio, metadata and index
+        a = AnnotatedRing(3, 4, storage=FileStorage(path))
+        assert a.index == 9
+        assert np.all(a.recent(5) == [3, 3, 3, 3, 1])
+        assert np.all(a.recent_energy(2) == [36, 16])
+        a.append([1, 1, 1])
+        assert np.all(a.recent_energy(3) == [4, 36, 16])
+
+        # a ring that has wrapped keeps the transients in the older part of
+        # its history
+        a = AnnotatedRing(8, 4, storage=FileStorage(os.path.join(directory, 'wrapped.ring')))
+        a.append(np.full(4 * 6, 0.01))
+        a.append(np.full(4 * 6, 0.01))
+        a.append(np.ones(4))
+        a.append(np.full(4 * 4 + 2, 0.01))
+        tap = a.create_tap()
+        tap.index = (a.index - 4 * 6) % len(a)
+        before = (a.blocks_done, a.last_transient_block_index(), tap.samples_to_next_transient)
+        assert before == (17, 4, 2)
+        a.storage.flush()
+        del a, tap
+        a = AnnotatedRing(8, 4, storage=FileStorage(os.path.join(directory, 'wrapped.ring')))
+        tap = a.create_tap()
+        tap.index = (a.index - 4 * 6) % len(a)
+        assert (a.blocks_done, a.last_transient_block_index(), tap.samples_to_next_transient) == before
+
+        # the stored layout must match the ring we are creating
+        try:
+            AnnotatedRing(4, 4, storage=FileStorage(path))
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_annotated_index():
+    """ The indexed queries should match a linear scan of the metadata """
+    def scan_next_transient(tap):
+        ring = tap.get_ring()
+        transients = ring.transients[tap.valid_indices]
+        if transients[0]:
+            return 0
+        found = np.nonzero(transients)[0]
+        if len(found) == 0:
+            return None
+        return ring.blocksize - tap.position_in_block + (found[0] - 1) * ring.blocksize
+
+    def scan_number_below(tap, value):
+        is_above = tap.previous_energy_blocks() >= value
+        return np.argmax(is_above) if np.any(is_above) else len(is_above)
+
+    def scan_last_transient(ring, number):
+        found = np.nonzero(ring.recent_transients(number))[0]
+        return found[-1] if len(found) else None
+
+    rs = np.random.RandomState(4)
+    a = AnnotatedRing(8, 4)
+    t = a.create_tap()
+    for i in range(300):
+        a.append(rs.randn(rs.randint(1, 20)) * rs.choice([0.01, 1., 100.]))
+        t.index = (a.index - 1 - rs.randint(0, len(a) - 1)) % len(a)
+        assert t.samples_to_next_transient == scan_next_transient(t)
+        for value in [0.01, 1., 100., 1e4]:
+            assert t.number_below(value) == scan_number_below(t, value)
+        for number in [1, 3, 8]:
+            assert a.last_transient_block_index(number) == scan_last_transient(a, number)
+
+
+def test_energy_pyramid():
+    rs = np.random.RandomState(5)
+    a = AnnotatedRing(100, 4)
+    # 100 blocks gives levels of 100, 13 and 2 cells
+    assert [len(e) for e in a.pyramid.energy] == [100, 13, 2]
+
+    for i in range(50):
+        a.append(rs.randn(rs.randint(1, 300)) * rs.choice([0.01, 1., 100.]))
+        block = a.previous_updated_block_index
+        assert np.isclose(a.peak[block], np.max(np.abs(a.raw[block * 4:block * 4 + 4])))
+        energy, peak, rms_db = a.pyramid.level(1)
+        assert np.allclose(energy, [np.sum(a.energy[j:j + 8]) for j in range(0, 100, 8)])
+        assert np.all(peak == [np.max(a.peak[j:j + 8]) for j in range(0, 100, 8)])
+
+        block_index = rs.randint(0, 100)
+        count = rs.randint(1, 101)
+        indices = np.arange(block_index - count + 1, block_index + 1) % 100
+        energy, peak, rms_db = a.summarize(block_index, count)
+        assert np.isclose(energy, np.sum(a.energy[indices]))
+        assert peak == np.max(a.peak[indices])
+        assert np.isclose(rms_db, 10 * np.log10(eps + np.sum(a.energy[indices]) / (count * 4)))
+
+
+def test_spectral_onsets():
+    """ A new note at the same level is a spectral onset, not a transient """
+    t = np.arange(512 * 40) / 44100.
+    x = 0.5 * np.sin(2 * np.pi * 440 * t)
+    x[512 * 20 + 100:] = 0.5 * np.sin(2 * np.pi * 3000 * t[512 * 20 + 100:])
+
+    # The budget of 4 blocks per append leaves a backlog
+    a = AnnotatedRing(64, 512, spectral_bands=24, spectral_budget=4)
+    a.append(x[:512 * 30])
+    assert a.spectral.done == 4
+    for i in range(7):
+        a.append(x[512 * 30 + i:512 * 30 + i + 1])
+    assert a.spectral.done == a.blocks_done == 30
+    assert list(np.nonzero(a.spectral.onsets[:30])[0]) == [20]
+    assert not np.any(a.transients[1:30])
+    assert a.spectral.bands.dtype == np.float16
+
+    tap = a.create_tap()
+    tap.index = 512 * 2 + 10
+    assert tap.samples_to_next_onset == 512 * 18 - 10
+
+    # Reopening a ring that has wrapped keeps the onsets, and the analysis
+    # carries on from where it stopped
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'spectral.ring')
+        a = AnnotatedRing(24, 512, storage=FileStorage(path), spectral_bands=24)
+        for start in range(0, 512 * 30, 512 * 10):
+            a.append(x[start:start + 512 * 10])
+        assert a.spectral.done == 30 and a.next_onset_position(0) == 20
+        a.storage.flush()
+        del a
+        a = AnnotatedRing(24, 512, storage=FileStorage(path), spectral_bands=24)
+        assert a.spectral.done == a.blocks_done == 30
+        assert a.next_onset_position(0) == 20
+        a.append(x[512 * 30:512 * 32])
+        assert a.spectral.done == 32
+    finally:
+        shutil.rmtree(directory)
+
+    # Blocks overwritten before they were analysed are skipped
+    a = AnnotatedRing(8, 512, spectral_bands=8, spectral_budget=2)
+    a.append(x[:512 * 6])
+    a.append(x[512 * 6:512 * 14])
+    assert a.spectral.done == 14 - 8 + 1 + 2
+    assert a.next_onset_position(0) is None
+
+
+def test_concurrent_ring():
+    a = ConcurrentRing(8)
+    t = a.create_tap()
+    a.append(np.arange(6))
+    assert t.available == 6
+    assert np.all(t.read(4) == [0, 1, 2, 3])
+    a.append(np.arange(6, 12))
+    # wraps around the end of the raw buffer
+    assert np.all(t.read(5, out=np.zeros(5)) == [4, 5, 6, 7, 8])
+    assert a.slowest_cursor == 9
+    try:
+        t.read(4)
+    except BufferError:
+        pass
+    else:
+        assert False
+
+    # the producer never waits for a tap, it laps it
+    a.append(np.arange(12, 20))
+    try:
+        t.read(3)
+    except RingOverrun:
+        assert not t.valid
+    else:
+        assert False
+    t.sequence = a.oldest
+    assert np.all(t.read(3) == [12, 13, 14])
+    t.close()
+    assert a.slowest_cursor is None
+
+    # one producer thread, and consumers reading on other threads
+    a = ConcurrentRing(4096, 'int64')
+    taps = [a.create_tap() for i in range(3)]
+    total = 200000
+    results = [[] for tap in taps]
+
+    def consume(tap, result):
+        while tap.sequence < total:
+            number = min(tap.available, 100)
+            if number:
+                result.append(tap.read(number))
+
+    threads = [threading.Thread(target=consume, args=(tap, result))
+               for tap, result in zip(taps, results)]
+    for thread in threads:
+        thread.start()
+    for start in range(0, total, 50):
+        # wait for the slowest reader, so that none are overrun
+        while start + 50 - a.slowest_cursor > len(a):
+            pass
+        a.append(np.arange(start, start + 50))
+    for thread in threads:
+        thread.join()
+    for result in results:
+        assert np.all(np.concatenate(result) == np.arange(total))
+
+
+def test_tap_reader():
+    class ListSink(object):
+        def __init__(self):
+            self.frames = []
+            self.closed = False
+
+        def write(self, frames):
+            self.frames.append(frames.copy())
+
+        def close(self):
+            self.closed = True
+
+    a = ConcurrentRing(16, 'int64')
+    sink = ListSink()
+    reader = TapReader(a.create_tap(), [sink], channels=2, block=6)
+    a.append(np.arange(10))
+    reader.start()
+    while reader.read < 6:
+        time.sleep(0.001)
+    # Less than a block waits for close
+    reader.close()
+    assert sink.closed and len(a.cursors) == 0
+    assert [f.shape for f in sink.frames] == [(3, 2), (2, 2)]
+    assert np.all(np.concatenate(sink.frames).ravel() == np.arange(10))
+
+    # A reader that falls behind skips whole frames to the newest sample
+    sink = ListSink()
+    reader = TapReader(a.create_tap(), [sink], channels=2, block=6)
+    for start in range(10, 50, 10):
+        a.append(np.arange(start, start + 10))
+    reader.close()
+    assert reader.dropped == 40 and reader.read == 0 and sink.frames == []
+
+
+def test_shared_storage():
+    storage = SharedStorage('ring-test-{0}'.format(os.getpid()))
+    try:
+        a = ConcurrentRing(8, 'float32', storage)
+        t = a.create_tap()
+        a.append(np.arange(5))
+
+        # attaching by name sees the same samples, counters and taps
+        attached = SharedStorage(storage.name, create=False)
+        b = ConcurrentRing(8, 'float32', attached)
+        u = b.open_tap(t.slot)
+        assert np.all(u.read(5) == np.arange(5))
+        assert t.sequence == 5
+        del b, u
+        attached.close()
+
+        # and so does another process, which reads while we write
+        results = multiprocessing.Queue()
+        reader = multiprocessing.Process(target=read_shared, args=(storage.name, t.slot, 20, results))
+        reader.start()
+        for start in range(5, 25, 4):
+            while t.sequence < start:
+                time.sleep(0.001)
+            a.append(np.arange(start, start + 4))
+        assert np.all(results.get(timeout=10) == np.arange(5, 25))
+        reader.join()
+        del a, t
+        storage.close()
+    finally:
+        storage.unlink()
+    try:
+        SharedStorage(storage.name, create=False)
+    except IOError:
+        pass
+    else:
+        assert False
+
+
+def read_shared(name, slot, count, results):
+    """ Read <count> samples from the tap in <slot> of a shared ring """
+    ring = ConcurrentRing(8, 'float32', SharedStorage(name, create=False))
+    tap = ring.open_tap(slot)
+    samples = []
+    while len(samples) < count:
+        number = tap.available
+        if number:
+            samples.extend(tap.read(number))
+        else:
+            time.sleep(0.001)
+    results.put(np.array(samples))
+
+
+def test_tap_bookkeeping():
+    """ append should deactivate exactly the taps a per-tap check would """
+    rs = np.random.RandomState(6)
+    a = Ring(64)
+    taps = [a.create_tap() for i in range(40)]
+    # append prints the name of every tap it deactivates
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        append_random_taps(rs, a, taps)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def append_random_taps(rs, a, taps):
+    for i in range(200):
+        for tap in taps:
+            if rs.rand() < 0.3:
+                tap.index = a.index - 1 - rs.randint(0, 64)
+                tap.activate()
+            elif tap.valid and tap.valid_buffer_length > 2 and rs.rand() < 0.5:
+                tap.advance(rs.randint(0, tap.valid_buffer_length - 1))
+        count = rs.randint(1, 30)
+        overrun = set(name for name, tap in a.active_taps.items()
+                      if tap.valid_ring_space < count)
+        active = set(a.active_taps)
+        a.append(np.zeros(count))
+        assert set(a.active_taps) == active - overrun
+        assert all(not a.inactive_taps[name].valid for name in overrun)
+
+
 def test():
     a = Ring(4)
     a.append([1, 2])
@@ -145,6 +514,15 @@ def test():
 
 if __name__ == '__main__':
     test()
+    test_out_arrays()
     test_annotated_ring()
+    test_file_storage()
+    test_annotated_index()
+    test_energy_pyramid()
+    test_spectral_onsets()
+    test_concurrent_ring()
+    test_tap_reader()
+    test_shared_storage()
     test_tap_activation()
+    test_tap_bookkeeping()
 
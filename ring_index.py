@@ -0,0 +1,191 @@
+"""
+Indexes over the block metadata of an AnnotatedRing.
+
+Both are updated from AnnotatedRing.append as blocks are annotated, so
+questions about the whole history of the ring do not have to scan it.
+"""
+import bisect
+
+import numpy as np
+
+eps = np.finfo(float).eps
+
+
+class MaxTree(object):
+    """ A segment tree over an array of block values, that finds the
+    nearest value at or above a threshold in O(log n).
+
+    Leaves are stored from __tree[size] onward, and __tree[i] holds the max
+    of __tree[2i] and __tree[2i+1].
+    """
+    def __init__(self, values):
+        length = len(values)
+        self.__length = length
+        self.__size = 1
+        while self.__size < length:
+            self.__size *= 2
+        self.__tree = np.full(2 * self.__size, -np.inf)
+        self.update(0, values)
+
+    def update(self, start, values):
+        """ Set the leaves beginning at <start> to <values>, then recompute
+        every parent of the changed leaves, one level at a time
+        """
+        tree = self.__tree
+        lo = start + self.__size
+        hi = lo + len(values)
+        tree[lo:hi] = values
+        while lo > 1:
+            lo //= 2
+            hi = (hi - 1) // 2 + 1
+            np.maximum(tree[2 * lo:2 * hi:2], tree[2 * lo + 1:2 * hi:2], out=tree[lo:hi])
+
+    def last_at_least(self, lo, hi, value):
+        """ The largest index in [lo, hi] whose value is >= <value>, or None """
+        if lo > hi:
+            return None
+        return self.__last_at_least(1, 0, self.__size - 1, lo, hi, value)
+
+    def __last_at_least(self, node, node_lo, node_hi, lo, hi, value):
+        if node_hi < lo or node_lo > hi or self.__tree[node] < value:
+            return None
+        if node_lo == node_hi:
+            return node_lo
+        middle = (node_lo + node_hi) // 2
+        found = self.__last_at_least(2 * node + 1, middle + 1, node_hi, lo, hi, value)
+        if found is None:
+            found = self.__last_at_least(2 * node, node_lo, middle, lo, hi, value)
+        return found
+
+    def __len__(self):
+        return self.__length
+
+
+class BlockPositions(object):
+    """ A sorted list of absolute block numbers where something (like a
+    transient) was found.
+
+    Absolute block numbers count every block ever annotated, so they keep
+    increasing when the ring wraps. Block number a lives at block_index
+    a % num_blocks. Positions that have been overwritten are dropped as the
+    ring moves on.
+    """
+    def __init__(self, num_blocks):
+        self.__num_blocks = num_blocks
+        self.__positions  = []
+        # Positions before __head have been overwritten. Dropping them from
+        # the front of a list is O(n), so we only compact occasionally.
+        self.__head       = 0
+
+    def extend(self, positions, blocks_done):
+        """ Add the (increasing) <positions>, and forget the positions that
+        are no longer in a ring that has annotated <blocks_done> blocks
+        """
+        self.__positions.extend(positions)
+        oldest = blocks_done - self.__num_blocks
+        self.__head = bisect.bisect_left(self.__positions, oldest, self.__head)
+        if self.__head > len(self.__positions) // 2:
+            del self.__positions[:self.__head]
+            self.__head = 0
+
+    def first_at_or_after(self, position):
+        """ The first stored position >= <position>, or None """
+        i = bisect.bisect_left(self.__positions, position, self.__head)
+        if i == len(self.__positions):
+            return None
+        return self.__positions[i]
+
+    def __len__(self):
+        return len(self.__positions) - self.__head
+
+
+class EnergyPyramid(object):
+    """ Block energy and peak summarised at several resolutions.
+
+    Level 0 has one cell per block. Each cell of level L + 1 summarises
+    <factor> cells of level L, so with 512 sample blocks and a factor of 8
+    the levels cover 512, 4k, 32k, 256k ... samples per cell. Levels are
+    added until the top level has at most <factor> cells.
+
+    Each level stores the total energy, the peak absolute sample and the RMS
+    level in dB of its cells. Any range of blocks can then be summarised
+    from at most 2 * (factor - 1) cells per level, instead of every block.
+
+    Cells cover ranges of block_index, not of time, so a range of time that
+    wraps around the ring is summarised as two ranges.
+    """
+    def __init__(self, energy, peak, blocksize, storage, factor=8):
+        """
+        energy, peak: the per block arrays of the ring, used as level 0
+        storage: creates the arrays of the other levels, next to the ring's
+        """
+        self.factor    = int(factor)
+        self.blocksize = int(blocksize)
+        self.energy    = [energy]
+        self.peak      = [peak]
+        self.rms_db    = [storage.allocate('rms_db', len(energy), 'float32')]
+        # Number of samples summarised by one cell of each level
+        self.cell_size = [self.blocksize]
+
+        while len(self.energy[-1]) > self.factor:
+            level = len(self.energy)
+            cells = -(-len(self.energy[-1]) // self.factor)
+            self.energy.append(storage.allocate('energy_{0}'.format(level), cells))
+            self.peak.append(storage.allocate('peak_{0}'.format(level), cells, peak.dtype))
+            self.rms_db.append(storage.allocate('rms_db_{0}'.format(level), cells, 'float32'))
+            self.cell_size.append(self.cell_size[-1] * self.factor)
+
+        self.update(0, len(energy))
+
+    def update(self, start, stop):
+        """ Recompute every cell above the blocks in [start, stop), after
+        the level 0 energy and peak of those blocks have changed
+        """
+        f = self.factor
+        self.__db(0, start, stop)
+        for level in range(1, len(self.energy)):
+            # the children we read must start on a cell boundary
+            child_start = (start // f) * f
+            child_stop  = min(-(-stop // f) * f, len(self.energy[level - 1]))
+            start = child_start // f
+            stop  = -(-child_stop // f)
+            offsets = np.arange(0, child_stop - child_start, f)
+            np.add.reduceat(self.energy[level - 1][child_start:child_stop], offsets,
+                            out=self.energy[level][start:stop])
+            np.maximum.reduceat(self.peak[level - 1][child_start:child_stop], offsets,
+                                out=self.peak[level][start:stop])
+            self.__db(level, start, stop)
+
+    def __db(self, level, start, stop):
+        energy = self.energy[level][start:stop]
+        self.rms_db[level][start:stop] = 10. * np.log10(eps + energy / self.cell_size[level])
+
+    def summarize(self, lo, hi):
+        """ The total energy and the peak of the blocks in [lo, hi) """
+        f = self.factor
+        energy = 0.
+        peak = 0.
+        for level in range(len(self.energy)):
+            if lo >= hi:
+                break
+            if level == len(self.energy) - 1:
+                lead = trail = hi
+            else:
+                # the cells before the first, and after the last, whole cell
+                # of the next level are summarised at this level
+                lead  = min(hi, -(-lo // f) * f)
+                trail = max(lead, (hi // f) * f)
+            for a, b in [(lo, lead), (trail, hi)]:
+                if a < b:
+                    energy += float(np.sum(self.energy[level][a:b]))
+                    peak = max(peak, float(np.max(self.peak[level][a:b])))
+            lo, hi = lead // f, trail // f
+        return energy, peak
+
+    def level(self, level):
+        """ The (energy, peak, rms_db) arrays of one level """
+        return self.energy[level], self.peak[level], self.rms_db[level]
+
+    def __len__(self):
+        return len(self.energy)
+
@@ -1,13 +1,17 @@
 import sys
 import sounddevice as sd
-import numpy as np
 # import matplotlib.pyplot as plt
-from scipy.fftpack import fft, ifft, fftshift
 import logging
 
-from ring import Ring, AnnotatedRing
-from stretcher import Stretcher, StretchGroup
+import fft_backend
+from ring import AnnotatedRing
+from storage import FileStorage, SharedStorage
+from concurrent_ring import ConcurrentRing, TapReader
+from stretcher import StretchGroup
 from stretch_io import StretchIO
+from telemetry import CallbackStats
+from engine import Engine
+from sinks import SinkWriter, WavSink, SocketSink, stem_sinks
 
 print('\nProtip: use "$ python sounddevice -m" do see available audio devices')
 
@@ -23,13 +27,56 @@ output_device = 2 if len(devices) == 3 else None
 in_channels = 1
 out_channels = 2
 # dtype: audio data type: float32, int32, int16, int8, uint8
-dtype = None
+# This one setting also decides the precision of the rings, window tables
+# and mixing buffers. float32 halves the memory traffic of float64.
+dtype = 'float32'
 # samplerate (float): sampleing rate. I'm not sure why this is float and not int
 samplerate = 44100
-# blocksize (int): block size
-blocksize = 2**13
+# blocksize (int): block size. Voices queue their output, so this no longer
+# depends on the window size. Smaller blocks mean lower latency.
+blocksize = 512
 # latency (float): latency in seconds
 latency = None
+# voices (int): number of simultaneous stretches. Each toggle on the TouchOSC
+# layout turns on a free voice (or steals the oldest), and its fader and LED
+# follow that voice
+voices = 4
+# threads (int): render voices on this many worker threads (0 to render on
+# the audio thread). Workers are only used when three or more voices play.
+threads = 0
+# exponent (int): voices stretch with windows of 2 ** exponent samples
+exponent = 14
+# min_exponent (int): if set, voices shrink their windows down to
+# 2 ** min_exponent samples around transients. None keeps every window at
+# 2 ** exponent.
+min_exponent = None
+# lead (int): voices render up to this many samples ahead, one hop per
+# callback, so that hops are spread over callbacks instead of all voices
+# needing a hop in the same callback
+lead = 2**13
+# stagger (bool): voices activated together start a callback apart, so their
+# hops never land in the same callback
+stagger = True
+# ring_path (str): keep the input history in this file instead of in RAM.
+# Reopening the same file resumes with the previous history intact.
+ring_path = None
+# record_path (str): also write the output to this wav file
+record_path = None
+# stems_path (str): write each voice to its own wav file, named by
+# stems_path.format(voice number), for example 'voice{0}.wav'
+stems_path = None
+# stream_address ((str, int) or str): stream the output as raw float
+# samples to this TCP address or UNIX socket path
+stream_address = None
+# input_record_path (str): write the input to this wav file. A TapReader
+# thread reads it from a ConcurrentRing that the callback publishes to.
+input_record_path = None
+# share_input (str): publish the input in shared memory under this name, so
+# other processes can read it with
+# ConcurrentRing(capture_length, dtype, SharedStorage(share_input, create=False))
+share_input = None
+# capture_length (int): samples of input kept for those readers
+capture_length = 2**20
 
 
 sendIp=("18.85.25.231", 12341)
@@ -44,75 +91,42 @@ print('input:  '+ devices[input_device]['name'])
 print('output: '+ devices[output_device]['name'])
 
 try:
-    cumulated_status = sd.CallbackFlags()
     size = 128 * 1024 * 120 * 16
     print('duration in minutes: {0}'.format(float(size) / samplerate / 60))
     osc_io          = StretchIO(sendIp)
-    input_buffer    = AnnotatedRing(size / 512, 512)
-    stretch_group   = StretchGroup(input_buffer, osc_io)
-    shape           = (0,0)
-    frames_elapsed  = 0
-    samples_elapsed = 0
-    previous_energy = 0
-    last_activation = -99999999999
-
-    def button_callback(button, state):
-        # touchOSC buttons index at one
-        if button > len(stretch_group.stretches_list):
-            return
-
-        s = stretch_group.stretches_list[button-1]
-        if state == 0:
-            print('fade out: {0}'.format(s.tap.name))
-            s.fade_out()
-        else:
-            print('ACTIVATE: {0}'.format(s.tap.name))
-            s.tap.index = input_buffer.index - blocksize
-            s.activate()
-
-
-    osc_io.set_toggle_handler(button_callback)
-
-
-    def audio_callback(indata, outdata, frames, time, status):
-        global cumulated_status
-        global shape
-        global frames_elapsed
-        global samples_elapsed
-        global previous_energy
-        global last_activation
-        cumulated_status |= status
-
-        # np.shape(indata) will equal (frames, in_channels) where frames is the
-        # number of samples provided by sounddevice, and in_channels is the
-        # number of input channels.
-
-        osc_io.step()
-
-        if shape != np.shape(indata):
-            shape = np.shape(indata)
-            print('input shape: {0}'.format(np.shape(indata)))
-
-        audio_input        = indata.flatten()
-        boundaries_crossed = input_buffer.append(audio_input)
-        new_transients     = input_buffer.recent_transients(boundaries_crossed)
-
-        if np.any(new_transients) and frames_elapsed > 0:
-            boundary_indices   = np.array(input_buffer.recent_block_indices(boundaries_crossed))
-            # these are block_indices of transients in the last .append call
-            transient_block_indices = boundary_indices[np.nonzero(new_transients)[0]]
-            raw_transient_indices   = transient_block_indices * input_buffer.blocksize
-            transient_index         = raw_transient_indices[0]
-
-        results = stretch_group.step(blocksize)
-        outdata[:] = results
-        # sys.stdout.write(' {0:.3f}\r'.format(previous_energy)); sys.stdout.flush()
-
-        # How many frames have we processed
-        samples_elapsed += shape[0]
-        seconds_elapsed = float(samples_elapsed) / samplerate
-        frames_elapsed += 1
-        previous_energy = np.sum(outdata ** 2)
+    # Pick the fastest installed fft library for each of our window sizes
+    window_sizes    = [2 ** e for e in range(exponent if min_exponent is None else min_exponent, exponent + 1)]
+    for windowsize, (name, seconds) in sorted(fft_backend.select_fastest(window_sizes, dtype).items()):
+        print('fft: {0} for {1} ({2:.3f} ms per pair)'.format(name, windowsize, seconds * 1000.))
+    storage         = FileStorage(ring_path) if ring_path else None
+    input_buffer    = AnnotatedRing(size / 512, 512, dtype=dtype, storage=storage)
+    stretch_group   = StretchGroup(input_buffer, osc_io, voices, threads=threads,
+                                   exponent=exponent, min_exponent=min_exponent, lead=lead,
+                                   stagger=stagger)
+    # Time spent in each part of the audio callback, and xrun counts
+    callback_stats  = CallbackStats(['osc', 'append', 'stretch'],
+                                    budget=float(blocksize) / samplerate)
+    # Recording and streaming happen on a background thread (see sinks.py)
+    output_sinks    = ([WavSink(record_path, samplerate, out_channels, dtype)] if record_path else []) + \
+                      ([SocketSink(stream_address, dtype)] if stream_address else [])
+    output_writer   = SinkWriter(output_sinks, out_channels, dtype=dtype) if output_sinks else None
+    stem_writer     = SinkWriter([stem_sinks(stems_path, samplerate, voices, dtype)], voices,
+                                 dtype=dtype) if stems_path else None
+    # The input, for readers on other threads and processes (see concurrent_ring.py)
+    capture_storage = SharedStorage(share_input) if share_input else None
+    capture         = ConcurrentRing(capture_length, dtype, capture_storage) \
+                      if input_record_path or share_input else None
+    input_reader    = TapReader(capture.create_tap(),
+                                [WavSink(input_record_path, samplerate, in_channels, dtype)],
+                                channels=in_channels) if input_record_path else None
+    engine          = Engine(input_buffer, stretch_group, osc_io, blocksize,
+                             callback_stats, status=sd.CallbackFlags(),
+                             output_writer=output_writer, stem_writer=stem_writer,
+                             capture=capture)
+    for writer in [output_writer, stem_writer, input_reader]:
+        if writer is not None:
+            writer.start()
+    osc_io.start()
 
 
     with sd.Stream(device=(input_device, output_device),
@@ -121,12 +135,28 @@ try:
                    blocksize=blocksize,
                    dtype=dtype,
                    latency=latency,
-                   callback=audio_callback):
+                   callback=engine.audio_callback):
         print("\npress Return to quit")
         raw_input()
 
-    if cumulated_status:
-        logging.warning(str(cumulated_status))
+    osc_io.close()
+    stretch_group.close()
+    print(callback_stats.format())
+    for writer in [output_writer, stem_writer]:
+        if writer is not None:
+            writer.close()
+            print(writer.format(samplerate))
+    if input_reader is not None:
+        input_reader.close()
+        print('input: {0} samples recorded, {1} dropped'.format(input_reader.read, input_reader.dropped))
+    if capture_storage is not None:
+        capture_storage.unlink()
+    load = stretch_group.load
+    print('hops per callback: worst {0} ({1:.2f} of a full window), mean {2:.3f}'.format(
+        load['worst'], load['worst_work'], load['mean']))
+
+    if engine.cumulated_status:
+        logging.warning(str(engine.cumulated_status))
 
 except KeyboardInterrupt:
     print('KeyboardInterrupt')
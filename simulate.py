@@ -0,0 +1,266 @@
+"""
+Run the live audio path without a sound card or a TouchOSC controller.
+
+    $ python simulate.py --input in.wav --output out.wav
+    $ python simulate.py --signal clicks --seconds 60 --voices 8 --storm 200
+
+A fake device feeds the input to Engine.audio_callback one block at a time,
+as fast as the callback returns, and collects the output. A scripted peer
+plays the part of the controller: it passes its toggle and fader messages
+to an offline StretchIO when the simulated clock reaches them, so they go
+through the same event queue and handlers as messages from the network.
+
+By default the peer activates one voice per second. --script replays a
+JSON list of [seconds, path, value] messages instead, and --storm adds that
+many random fader messages per second on top. Afterwards the callback
+timings and the FFT load per callback are printed, as run.py does.
+"""
+import argparse
+import collections
+import json
+import sys
+import timeit
+
+import numpy as np
+
+from concurrent_ring import ConcurrentRing, TapReader
+from engine import Engine
+from ring import AnnotatedRing
+from sinks import SinkWriter, WavSink, read_wav, stem_sinks
+from stretch_io import StretchIO
+from stretcher import StretchGroup
+from telemetry import CallbackStats, xrun_flags
+
+timer = timeit.default_timer
+
+# Stands in for the time info struct that sounddevice passes to the callback
+DeviceTime = collections.namedtuple('DeviceTime', 'inputBufferAdcTime outputBufferDacTime currentTime')
+
+
+class DeviceStatus(object):
+    """ Stands in for sd.CallbackFlags """
+    def __init__(self, **flags):
+        for flag in xrun_flags:
+            setattr(self, flag, bool(flags.get(flag, False)))
+
+    def __or__(self, other):
+        return DeviceStatus(**dict((flag, getattr(self, flag) or getattr(other, flag))
+                                   for flag in xrun_flags))
+
+    def __bool__(self):
+        return any(getattr(self, flag) for flag in xrun_flags)
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return ', '.join(flag for flag in xrun_flags if getattr(self, flag)) or 'no xruns'
+
+
+class FakeDevice(object):
+    """ Play <source> through a callback in blocks of <blocksize>, like a
+    sounddevice stream with one input channel.
+
+    The device does not wait between callbacks. A callback that takes
+    longer than a block lasts would have made a real device run out of
+    output, so the next callback is told about an output underflow.
+    """
+    def __init__(self, source, blocksize, out_channels=2, samplerate=44100):
+        self.source       = np.asarray(source)
+        self.blocksize    = blocksize
+        self.out_channels = out_channels
+        self.samplerate   = float(samplerate)
+
+    @property
+    def blocks(self):
+        return len(self.source) // self.blocksize
+
+    def run(self, callback, before=None):
+        """ Call <callback> for every whole block of the source, and
+        <before>(seconds) before each one. Returns the output, with one
+        column per output channel.
+        """
+        budget = self.blocksize / self.samplerate
+        output = np.zeros((self.blocks * self.blocksize, self.out_channels), self.source.dtype)
+        status = DeviceStatus()
+        for b in range(self.blocks):
+            start = b * self.blocksize
+            seconds = start / self.samplerate
+            if before is not None:
+                before(seconds)
+            indata = self.source[start:start + self.blocksize].reshape(-1, 1)
+            outdata = output[start:start + self.blocksize]
+            began = timer()
+            callback(indata, outdata, self.blocksize,
+                     DeviceTime(seconds, seconds + budget, seconds), status)
+            status = DeviceStatus(output_underflow=timer() - began > budget)
+        return output
+
+
+class ScriptedPeer(object):
+    """ Replay (seconds, path, value) OSC messages in to a StretchIO """
+    def __init__(self, osc_io, events):
+        self.osc_io    = osc_io
+        self.events    = sorted(events, key=lambda event: event[0])
+        self.delivered = 0
+
+    def deliver(self, now):
+        """ Pass on every message due at or before <now> """
+        events = self.events
+        while self.delivered < len(events) and events[self.delivered][0] <= now:
+            seconds, path, value = events[self.delivered]
+            self.osc_io.osc_handler(path, ',f', [value], ('127.0.0.1', 0))
+            self.delivered += 1
+
+
+def activations(voices, start=1., spacing=1.):
+    """ Messages that turn on voices 1 to <voices>, <spacing> seconds apart """
+    return [(start + i * spacing, '/1/toggle{0}'.format(i + 1), 1.) for i in range(voices)]
+
+
+def storm(rate, seconds, controls=4, seed=0):
+    """ <rate> random fader messages per second, for <seconds> """
+    random = np.random.RandomState(seed)
+    count = int(rate * seconds)
+    return [(float(t), '/1/fader{0}'.format(fader), float(value)) for t, fader, value in zip(
+        np.sort(random.uniform(0., seconds, count)),
+        random.randint(1, controls + 1, count),
+        random.uniform(1., 16., count))]
+
+
+def load_script(path):
+    with open(path) as f:
+        return [(float(seconds), str(address), float(value)) for seconds, address, value in json.load(f)]
+
+
+def synthetic(kind, seconds, samplerate=44100, seed=0, dtype='float32'):
+    """ <seconds> of 'noise', a 'sine' sweep, or noise with 'clicks' (one
+    transient every half second)
+    """
+    random = np.random.RandomState(seed)
+    n = int(seconds * samplerate)
+    t = np.arange(n) / float(samplerate)
+    if kind == 'noise':
+        signal = 0.1 * random.randn(n)
+    elif kind == 'sine':
+        # a slow logarithmic sweep from 110 to 1760 Hz and back
+        frequency = 110. * 2 ** (4. * (0.5 - 0.5 * np.cos(2 * np.pi * t / max(seconds, 1.))))
+        signal = 0.3 * np.sin(2 * np.pi * np.cumsum(frequency) / samplerate)
+    elif kind == 'clicks':
+        signal = 0.02 * random.randn(n)
+        for start in range(0, n, samplerate // 2):
+            length = min(2048, n - start)
+            signal[start:start + length] += random.randn(length) * np.exp(-np.arange(length) / 256.)
+    else:
+        raise ValueError('unknown signal: {0}'.format(kind))
+    return signal.astype(dtype)
+
+
+def simulate(source, events, voices=4, blocksize=512, samplerate=44100, threads=0,
+             exponent=14, min_exponent=None, lead=2**13, stagger=True, verbose=False,
+             output_writer=None, stem_writer=None, input_reader=None):
+    """ Play <source> through an Engine set up like run.py, with a peer
+    sending <events>. Returns (engine, output, seconds of wall time).
+    The SinkWriters, if given, are started and closed here, and so is the
+    TapReader <input_reader>, which reads the input from the ring of its
+    tap.
+    """
+    # Keep the whole input, as the live ring keeps hours of it
+    num_blocks = -(-(len(source) + 2 ** exponent) // 512)
+    input_buffer = AnnotatedRing(num_blocks, 512, dtype=source.dtype)
+    osc_io = StretchIO(None)
+    stretch_group = StretchGroup(input_buffer, osc_io, voices, threads=threads,
+                                 exponent=exponent, min_exponent=min_exponent, lead=lead,
+                                 stagger=stagger)
+    callback_stats = CallbackStats(['osc', 'append', 'stretch'],
+                                   budget=float(blocksize) / samplerate)
+    capture = input_reader.tap.ring if input_reader is not None else None
+    engine = Engine(input_buffer, stretch_group, osc_io, blocksize, callback_stats,
+                    status=DeviceStatus(), verbose=verbose,
+                    output_writer=output_writer, stem_writer=stem_writer, capture=capture)
+    writers = [writer for writer in [output_writer, stem_writer, input_reader] if writer is not None]
+    peer = ScriptedPeer(osc_io, events)
+    device = FakeDevice(source, blocksize, samplerate=samplerate)
+
+    began = timer()
+    for writer in writers:
+        writer.start()
+    try:
+        output = device.run(engine.audio_callback, peer.deliver)
+    finally:
+        stretch_group.close()
+        for writer in writers:
+            writer.close()
+    return engine, output, timer() - began
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the audio path without a sound card or controller.')
+    parser.add_argument('--input', help='a wav file to play (the first channel)')
+    parser.add_argument('--signal', default='clicks', choices=['noise', 'sine', 'clicks'],
+                        help='the synthetic input to use without --input')
+    parser.add_argument('--seconds', type=float, default=20., help='length of the synthetic input')
+    parser.add_argument('--output', help='write the stretched output to this wav file')
+    parser.add_argument('--record', help='write the output to this wav file through a SinkWriter, '
+                        'as run.py does')
+    parser.add_argument('--record-input', help='write the input to this wav file, read from a '
+                        'ConcurrentRing on another thread, as run.py does')
+    parser.add_argument('--stems', help='write each voice to a wav file named by this pattern, '
+                        'for example voice{0}.wav')
+    parser.add_argument('--voices', type=int, default=4)
+    parser.add_argument('--blocksize', type=int, default=512)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--exponent', type=int, default=14)
+    parser.add_argument('--min-exponent', type=int, default=None)
+    parser.add_argument('--lead', type=int, default=2**13)
+    parser.add_argument('--no-stagger', dest='stagger', action='store_false')
+    parser.add_argument('--script', help='a JSON list of [seconds, path, value] OSC messages')
+    parser.add_argument('--storm', type=float, default=0.,
+                        help='add this many random fader messages per second')
+    parser.add_argument('--verbose', action='store_true', help='print voice activations')
+    args = parser.parse_args(argv)
+
+    if args.input:
+        samplerate, audio = read_wav(args.input)
+        source = audio[:, 0]
+    else:
+        samplerate = 44100
+        source = synthetic(args.signal, args.seconds, samplerate)
+    seconds = len(source) / float(samplerate)
+
+    events = load_script(args.script) if args.script else activations(args.voices)
+    if args.storm:
+        events += storm(args.storm, seconds)
+
+    output_writer = SinkWriter([WavSink(args.record, samplerate, 2, source.dtype)], 2,
+                               dtype=source.dtype) if args.record else None
+    stem_writer = SinkWriter([stem_sinks(args.stems, samplerate, args.voices, source.dtype)],
+                             args.voices, dtype=source.dtype) if args.stems else None
+    input_reader = TapReader(ConcurrentRing(samplerate, source.dtype).create_tap(),
+                             [WavSink(args.record_input, samplerate, 1, source.dtype)]
+                             ) if args.record_input else None
+
+    engine, output, elapsed = simulate(
+        source, events, voices=args.voices, blocksize=args.blocksize, samplerate=samplerate,
+        threads=args.threads, exponent=args.exponent, min_exponent=args.min_exponent,
+        lead=args.lead, stagger=args.stagger, verbose=args.verbose,
+        output_writer=output_writer, stem_writer=stem_writer, input_reader=input_reader)
+
+    print(engine.callback_stats.format())
+    load = engine.stretch_group.load
+    print('hops per callback: worst {0} ({1:.2f} of a full window), mean {2:.3f}'.format(
+        load['worst'], load['worst_work'], load['mean']))
+    print('{0:.1f} s of audio in {1:.1f} s ({2:.1f}x real time), {3} OSC messages'.format(
+        seconds, elapsed, seconds / elapsed, len(events)))
+    for writer in [output_writer, stem_writer]:
+        if writer is not None:
+            print(writer.format(samplerate))
+    if input_reader is not None:
+        print('input: {0} samples recorded, {1} dropped'.format(input_reader.read, input_reader.dropped))
+
+    if args.output:
+        from scipy.io import wavfile
+        wavfile.write(args.output, samplerate, output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,338 @@
+"""
+Record or rebroadcast the output of the audio callback.
+
+The audio thread hands its output to a SinkWriter, which only copies it in
+to a preallocated chunk. Full chunks go on a queue that a background thread
+drains, writing each chunk to every sink. The audio thread never opens
+files, touches a socket, allocates or waits for a lock.
+
+    writer = SinkWriter([WavSink('out.wav', 44100, 2)], channels=2)
+    writer.start()
+    ...
+    writer.write(outdata)       # in the audio callback
+    ...
+    writer.close()
+
+Chunks are returned to a free pool once written. When the pool runs dry
+(the sinks cannot keep up) new audio is dropped and counted rather than
+blocking the callback. report() shows the backlog: how much audio has been
+handed over but not yet written.
+
+Sinks are objects with write(frames) and close() methods, called on the
+writer thread. frames is a (frames, channels) array.
+"""
+import collections
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+# WAVE format tags
+WAVE_FORMAT_PCM        = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+
+class SinkWriter(object):
+    """ Batch audio in to chunks of <chunk> frames, and write them to
+    <sinks> on a background thread. At most <chunks> chunks are queued.
+    """
+    def __init__(self, sinks, channels, chunk=2**16, chunks=16, dtype='float32', interval=0.01):
+        """
+        interval (float): how long the writer thread sleeps when there is
+                          nothing to write
+        """
+        self.sinks    = list(sinks)
+        self.channels = channels
+        self.chunk    = chunk
+        self.interval = interval
+        self.errors   = []
+
+        # Each deque is shared between the audio thread and the writer
+        # thread without a lock (see the toggle queue in stretch_io.py)
+        self.__chunks = chunks
+        self.__free = collections.deque(np.zeros((chunk, channels), dtype) for i in range(chunks))
+        self.__full = collections.deque()
+
+        # The chunk the audio thread is filling, and how much of it is filled
+        self.__current = None
+        self.__filled  = 0
+
+        # Each counter is written by one thread only
+        self.__queued      = 0    # frames handed to write (audio thread)
+        self.__dropped     = 0    # frames lost for lack of a chunk (audio thread)
+        self.__max_backlog = 0    # (audio thread)
+        self.__written     = 0    # frames written to the sinks (writer thread)
+
+        self.__thread  = None
+        self.__running = False
+
+    def start(self):
+        """ Begin writing on a background thread """
+        if self.__thread is not None:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__serve, name='SinkWriter')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def write(self, frames):
+        """ Queue (frames, channels) of audio. Call this from the audio
+        thread.
+        """
+        count = len(frames)
+        offset = 0
+        while offset < count:
+            if self.__current is None:
+                if not self.__free:
+                    self.__dropped += count - offset
+                    break
+                self.__current = self.__free.popleft()
+                self.__filled = 0
+            number = min(count - offset, self.chunk - self.__filled)
+            self.__current[self.__filled:self.__filled + number] = frames[offset:offset + number]
+            self.__filled += number
+            offset += number
+            if self.__filled == self.chunk:
+                self.__full.append((self.__current, self.__filled))
+                self.__current = None
+        self.__queued += offset
+        backlog = self.__queued - self.__written
+        if backlog > self.__max_backlog:
+            self.__max_backlog = backlog
+
+    def flush(self):
+        """ Queue the partly filled chunk. Call this from the audio thread,
+        or once the audio has stopped.
+        """
+        if self.__current is not None and self.__filled > 0:
+            self.__full.append((self.__current, self.__filled))
+            self.__current = None
+
+    def __serve(self):
+        while self.__running:
+            if not self.__drain():
+                time.sleep(self.interval)
+
+    def __drain(self):
+        """ Write every full chunk. Returns False if there were none. """
+        full = self.__full
+        if not full:
+            return False
+        while full:
+            chunk, count = full.popleft()
+            for sink in list(self.sinks):
+                try:
+                    sink.write(chunk[:count])
+                except Exception as e:
+                    # Keep the other sinks going
+                    self.errors.append((sink, e))
+                    self.sinks.remove(sink)
+            self.__free.append(chunk)
+            self.__written += count
+        return True
+
+    def close(self):
+        """ Write everything that is queued, stop the writer thread and close
+        the sinks. Call this after the audio has stopped.
+        """
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+        self.__drain()
+        for sink in self.sinks:
+            sink.close()
+
+    @property
+    def backlog(self):
+        """ Frames handed over but not yet written """
+        return self.__queued - self.__written
+
+    def report(self):
+        """ The 'backlog' and 'max_backlog' in frames, the 'capacity' of the
+        chunk pool in frames, and the frames 'written' and 'dropped' so far
+        """
+        return {
+            'backlog': self.backlog,
+            'max_backlog': self.__max_backlog,
+            'capacity': self.chunk * self.__chunks,
+            'written': self.__written,
+            'dropped': self.__dropped,
+        }
+
+    def format(self, samplerate):
+        report = self.report()
+        return 'sinks: backlog {0:.2f} s (max {1:.2f} s of {2:.2f} s), {3} frames dropped'.format(
+            report['backlog'] / float(samplerate), report['max_backlog'] / float(samplerate),
+            report['capacity'] / float(samplerate), report['dropped'])
+
+
+class WavSink(object):
+    """ Write a wav file, a chunk at a time. float32 and float64 audio is
+    written as IEEE float, integer audio as PCM. Float frames written to an
+    integer sink are scaled from -1..1 to the full range of the integer
+    type, and clipped. The header is rewritten with the final length when
+    the sink is closed.
+
+    The sizes in a wav header are 32 bit, so a file holds at most 4 GiB of
+    audio (about 3.4 hours of stereo float32 at 44.1 kHz). Past that the
+    header records the largest whole number of frames that fits, and
+    readers ignore the rest.
+    """
+    max_size = 0xFFFFFFFF
+
+    def __init__(self, path, samplerate, channels, dtype='float32'):
+        self.dtype    = np.dtype(dtype).newbyteorder('<')
+        self.channels = channels
+        self.frames   = 0
+        self.__file   = open(path, 'wb')
+
+        float_format = self.dtype.kind == 'f'
+        block_align  = channels * self.dtype.itemsize
+        fmt = struct.pack('<HHIIHH', WAVE_FORMAT_IEEE_FLOAT if float_format else WAVE_FORMAT_PCM,
+                          channels, int(samplerate), int(samplerate) * block_align,
+                          block_align, 8 * self.dtype.itemsize)
+        header = b'WAVE'
+        if float_format:
+            # Non-PCM formats have a (zero length) extension, and a fact chunk
+            # with the number of frames
+            header += b'fmt ' + struct.pack('<I', len(fmt) + 2) + fmt + struct.pack('<H', 0)
+            self.__fact_offset = 8 + len(header) + 8
+            header += b'fact' + struct.pack('<II', 4, 0)
+        else:
+            header += b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+            self.__fact_offset = None
+        header += b'data' + struct.pack('<I', 0)
+        self.__header_size = 8 + len(header)
+        self.__block_align = block_align
+        self.__file.write(b'RIFF' + struct.pack('<I', 0) + header)
+
+        if self.dtype.kind in 'iu':
+            # 8 bit wav is unsigned, centred on 128
+            info = np.iinfo(self.dtype)
+            self.__middle = (int(info.min) + int(info.max) + 1) // 2
+            self.__scale  = int(info.max) - self.__middle
+            self.__range  = (info.min, info.max)
+
+    def write(self, frames):
+        frames = np.asarray(frames)
+        if frames.dtype.kind == 'f' and self.dtype.kind in 'iu':
+            frames = np.clip(np.rint(frames * self.__scale + self.__middle), *self.__range)
+        elif not (frames.dtype.kind == 'f' and self.dtype.kind == 'f') and \
+                frames.dtype.newbyteorder('<') != self.dtype:
+            # Integer samples have no common scale, so converting them
+            # would change the level
+            raise TypeError('cannot write {0} frames to a {1} wav file'.format(
+                frames.dtype, self.dtype))
+        np.ascontiguousarray(frames, self.dtype).tofile(self.__file)
+        self.frames += len(frames)
+
+    def close(self):
+        if self.__file.closed:
+            return
+        try:
+            # The largest whole number of frames the 32 bit sizes can hold
+            frames = min(self.frames, (self.max_size - (self.__header_size - 8)) // self.__block_align)
+            data_size = frames * self.__block_align
+            self.__file.seek(4)
+            self.__file.write(struct.pack('<I', self.__header_size - 8 + data_size))
+            if self.__fact_offset is not None:
+                self.__file.seek(self.__fact_offset)
+                self.__file.write(struct.pack('<I', frames))
+            self.__file.seek(self.__header_size - 4)
+            self.__file.write(struct.pack('<I', data_size))
+        finally:
+            self.__file.close()
+
+
+def read_wav(path, dtype='float32'):
+    """ Read a wav file as a (num_samples, channels) array and its rate.
+    PCM samples are scaled back to -1..1 the way WavSink scales them up, so
+    a recording reads back at the level it was written.
+    """
+    from scipy.io import wavfile
+    samplerate, audio = wavfile.read(path)
+    if audio.ndim == 1:
+        audio = audio[:, np.newaxis]
+    if audio.dtype.kind in 'iu':
+        info   = np.iinfo(audio.dtype)
+        middle = (int(info.min) + int(info.max) + 1) // 2
+        audio  = (audio - float(middle)) / (int(info.max) - middle)
+    return samplerate, audio.astype(dtype)
+
+
+class SoundFileSink(object):
+    """ Write any format libsndfile supports, such as FLAC, with the
+    soundfile library. <format> defaults to the one for the file extension.
+    """
+    def __init__(self, path, samplerate, channels, format=None, subtype=None):
+        import soundfile
+        self.__file = soundfile.SoundFile(path, 'w', int(samplerate), channels,
+                                          format=format, subtype=subtype)
+
+    def write(self, frames):
+        self.__file.write(frames)
+
+    def close(self):
+        self.__file.close()
+
+
+class SocketSink(object):
+    """ Stream raw interleaved samples to a TCP (host, port) address, or a
+    UNIX socket path. If the connection fails the sink stops sending and
+    keeps the error, and counts the frames it could not send.
+    """
+    def __init__(self, address, dtype='float32', timeout=1.):
+        self.dtype   = np.dtype(dtype)
+        self.error   = None
+        self.dropped = 0
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.__socket = socket.socket(family, socket.SOCK_STREAM)
+        # Only blocks the writer thread, but a stalled reader should not
+        # stall the other sinks for long
+        self.__socket.settimeout(timeout)
+        self.__socket.connect(address)
+
+    def write(self, frames):
+        if self.__socket is None:
+            self.dropped += len(frames)
+            return
+        try:
+            self.__socket.sendall(np.ascontiguousarray(frames, self.dtype).tobytes())
+        except (socket.error, socket.timeout) as e:
+            self.error = e
+            self.dropped += len(frames)
+            self.close()
+
+    def close(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+
+class StemSink(object):
+    """ Write each channel to its own sink, for example the voices of
+    StretchGroup.voice_output to one wav file per voice:
+
+        StemSink([WavSink('voice{0}.wav'.format(i), 44100, 1) for i in range(4)])
+    """
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def write(self, frames):
+        for i, sink in enumerate(self.sinks):
+            sink.write(frames[:, i:i + 1])
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def stem_sinks(pattern, samplerate, voices, dtype='float32'):
+    """ A StemSink of wav files named <pattern>.format(voice number), with
+    voices numbered from one like the TouchOSC controls
+    """
+    return StemSink([WavSink(pattern.format(i + 1), samplerate, 1, dtype) for i in range(voices)])
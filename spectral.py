@@ -0,0 +1,162 @@
+"""
+Spectral annotation for AnnotatedRing.
+
+Every block gets a short-time spectrum, summarised in to mel spaced bands
+and stored as float16 levels in dB, in an array parallel to the ring's other
+metadata. Spectral flux (how much the band levels rose since the previous
+block) finds onsets that the broadband energy jump of a transient misses,
+like a new note at the same loudness.
+
+The blocks crossed by one append are transformed together with one batched
+rfft. At most <budget> blocks are analysed per append. Blocks beyond the
+budget wait for the following appends, so a large append never stalls the
+audio callback, and blocks that were overwritten before their turn are
+skipped.
+"""
+import numpy as np
+
+from ring_index import BlockPositions
+
+eps = np.finfo(float).eps
+
+
+def hz_to_mel(hz):
+    return 2595. * np.log10(1. + hz / 700.)
+
+
+def mel_to_hz(mel):
+    return 700. * (10. ** (mel / 2595.) - 1.)
+
+
+def band_edges(blocksize, bands, samplerate=44100.):
+    """ The first rfft bin of each of <bands> mel spaced bands, followed by
+    the end of the last band. DC is skipped, and every band gets at least
+    one bin, so low bands are wider than the mel scale asks for when the
+    blocks are short.
+    """
+    bins = blocksize // 2 + 1
+    if bands > bins - 1:
+        raise ValueError('{0} bands do not fit in {1} bins'.format(bands, bins - 1))
+    mels = np.linspace(hz_to_mel(samplerate / blocksize), hz_to_mel(samplerate / 2.), bands + 1)
+    edges = np.round(mel_to_hz(mels) * blocksize / samplerate).astype(int)
+    edges[0] = 1
+    edges[-1] = bins
+    for i in range(1, bands):
+        edges[i] = min(max(edges[i], edges[i - 1] + 1), bins - bands + i)
+    return edges
+
+
+class SpectralAnnotator(object):
+    """ Band levels, spectral flux and onsets for the blocks of an
+    AnnotatedRing, stored with the ring's <storage>.
+
+    Onsets are the blocks where the flux (the mean rise of the band levels
+    in dB) first reaches <threshold>.
+    """
+    def __init__(self, num_blocks, blocksize, storage, bands=24, budget=32,
+                 threshold=6., floor_db=-100., samplerate=44100.):
+        self.num_blocks = num_blocks
+        self.blocksize  = blocksize
+        self.budget     = int(budget)
+        self.threshold  = float(threshold)
+        self.floor_db   = float(floor_db)
+
+        self.edges   = band_edges(blocksize, bands, samplerate)
+        self.__width = np.diff(self.edges).astype(float)
+        self.__window = np.hanning(blocksize)
+
+        self.bands  = storage.allocate('bands', (num_blocks, bands), 'float16')
+        self.flux   = storage.allocate('flux', num_blocks, 'float32')
+        self.onsets = storage.allocate('onsets', num_blocks, 'bool')
+        # The absolute block number of the next block to analyse, mirrored
+        # in to storage like the ring's index
+        self.__stored_done = storage.allocate('spectral_done', 1, 'int64')
+
+        # The band levels of the last block we analysed, and its position
+        self.__previous          = None
+        self.__previous_position = None
+        self.__positions         = BlockPositions(num_blocks)
+
+    @property
+    def done(self):
+        """ How many blocks have been analysed (or skipped) """
+        return int(self.__stored_done[0])
+
+    def resume(self, block_position, blocks_done):
+        """ Rebuild the onset index from stored onsets, after the ring was
+        reopened. <block_position> maps a block_index to its absolute block
+        number.
+
+        The ring stores its <blocks_done>, so our stored count cannot be
+        ahead of it, except in files written before the ring stored it.
+        Then we carry on from the ring's count, rather than waiting for the
+        ring to catch up with ours.
+        """
+        if self.done > blocks_done:
+            self.__stored_done[0] = blocks_done
+        self.__positions.extend(
+            sorted(block_position(i) for i in np.nonzero(self.onsets)[0]
+                   if 0 <= block_position(i) < self.done),
+            blocks_done)
+
+    def analyse(self, blocks, blocks_done):
+        """ Analyse up to <budget> of the blocks that have been completed but
+        not yet analysed. <blocks> is the ring's (num_blocks, blocksize) view
+        and <blocks_done> is the number of complete blocks in the ring.
+
+        Returns the number of blocks analysed.
+        """
+        n = self.num_blocks
+        done = self.done
+        # The oldest block that has not been partly overwritten. The block
+        # being filled shares a block_index with blocks_done - n.
+        oldest = blocks_done - n + 1
+        if done < oldest:
+            done = oldest
+        count = max(0, min(blocks_done - done, self.budget))
+        if count == 0:
+            return 0
+
+        positions = np.arange(done, done + count)
+        indices = positions % n
+
+        # One batched transform for every block, wrapping around the ring
+        spectrum = np.fft.rfft(blocks[indices] * self.__window, axis=1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        energy = np.add.reduceat(power, self.edges[:-1], axis=1)
+        levels = 10. * np.log10(eps + energy / (self.__width * self.blocksize))
+        np.maximum(levels, self.floor_db, out=levels)
+
+        # The flux of each block is measured against the block before it.
+        # After a gap (or for the very first block) there is nothing to
+        # compare with, so the block is its own reference.
+        previous = np.empty_like(levels)
+        previous[1:] = levels[:-1]
+        if self.__previous_position == done - 1:
+            previous[0] = self.__previous
+        else:
+            previous[0] = levels[0]
+        flux = np.mean(np.maximum(levels - previous, 0.), axis=1)
+
+        above = flux >= self.threshold
+        above_before = np.empty_like(above)
+        above_before[1:] = above[:-1]
+        above_before[0] = (self.__previous_position == done - 1 and
+                           self.flux[(done - 1) % n] >= self.threshold)
+        onsets = above & ~above_before
+
+        self.bands[indices] = levels
+        self.flux[indices] = flux
+        self.onsets[indices] = onsets
+
+        self.__previous = levels[-1]
+        self.__previous_position = done + count - 1
+        self.__stored_done[0] = done + count
+        self.__positions.extend(positions[onsets].tolist(), blocks_done)
+        return count
+
+    def next_onset_position(self, position):
+        """ The absolute block number of the first onset at or after
+        <position>, or None
+        """
+        return self.__positions.first_at_or_after(position)
@@ -0,0 +1,164 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+class MemoryStorage(object):
+    """ Storage decides where the arrays of a Ring live. MemoryStorage is the
+    default, and simply keeps every array in RAM.
+
+    Every storage implements allocate(name, shape, dtype). A Ring asks its
+    storage for each of its arrays by name, so a storage that already holds
+    an array with that name (for example a file from a previous run) can
+    hand back the existing contents.
+    """
+    def allocate(self, name, shape, dtype=None):
+        return np.zeros(shape, dtype)
+
+    def flush(self):
+        pass
+
+
+class FileStorage(object):
+    """ Keep the arrays of a Ring in a single file on disk with np.memmap.
+
+    The file begins with a fixed size header that records the name, offset,
+    shape and dtype of each array. Arrays are appended to the file the first
+    time they are allocated. When an existing file is opened, allocate
+    returns the stored array, so a Ring created with the same arguments will
+    pick up with its audio, metadata and index intact.
+
+    Long histories are then limited by disk space rather than RAM, because
+    the operating system only keeps the recently used pages in memory.
+    """
+    magic       = b'RINGFILE'
+    header_size = 4096
+    # Each array starts on a page boundary
+    alignment   = 4096
+
+    def __init__(self, path):
+        self.path     = path
+        self.__arrays = []
+
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                header = f.read(self.header_size)
+            if header[:len(self.magic)] != self.magic:
+                raise IOError('{0} is not a ring file'.format(path))
+            length = int(np.frombuffer(header[8:16], dtype='<u8')[0])
+            self.__layout = json.loads(header[16:16 + length].decode('utf-8'))
+        else:
+            self.__layout = {}
+            with open(path, 'wb') as f:
+                f.write(b'\0' * self.header_size)
+            self.__write_header()
+
+    def allocate(self, name, shape, dtype=None):
+        dtype = np.dtype(dtype)
+        shape = tuple(np.atleast_1d(shape).tolist())
+
+        if name in self.__layout:
+            region = self.__layout[name]
+            if tuple(region['shape']) != shape or region['dtype'] != dtype.str:
+                raise ValueError('{0} stores {1} with shape {2} and dtype {3}'.format(
+                    self.path, name, tuple(region['shape']), region['dtype']))
+        else:
+            end = max([self.header_size] + [
+                r['offset'] + int(np.prod(r['shape'])) * np.dtype(r['dtype']).itemsize
+                for r in self.__layout.values()])
+            offset = -(-end // self.alignment) * self.alignment
+            region = {'offset': offset, 'shape': list(shape), 'dtype': dtype.str}
+            self.__layout[name] = region
+            self.__write_header()
+
+        # np.memmap grows the file when the region extends past its end. The
+        # new space reads as zeros, just like np.zeros in MemoryStorage.
+        array = np.memmap(self.path, dtype=dtype, mode='r+',
+                          offset=region['offset'], shape=shape)
+        self.__arrays.append(array)
+        # Return a plain ndarray view, so that arithmetic on the ring's
+        # contents does not produce more memmap instances
+        return array.view(np.ndarray)
+
+    def __contains__(self, name):
+        """ Whether the file already stores an array called <name> """
+        return name in self.__layout
+
+    def flush(self):
+        """ Write any modified pages back to disk """
+        for array in self.__arrays:
+            array.flush()
+
+    def close(self):
+        """ Forget our arrays. The file stays mapped until the arrays we
+        returned (and the ring using them) are deleted.
+        """
+        del self.__arrays[:]
+
+    def __write_header(self):
+        table = json.dumps(self.__layout, sort_keys=True).encode('utf-8')
+        if 16 + len(table) > self.header_size:
+            raise ValueError('too many arrays for the ring file header')
+        with open(self.path, 'r+b') as f:
+            f.write(self.magic)
+            f.write(np.array([len(table)], dtype='<u8').tobytes())
+            f.write(table)
+
+
+class SharedStorage(FileStorage):
+    """ Keep the arrays of a Ring in shared memory, so that other processes
+    can attach to it by name.
+
+    This is a FileStorage in a memory backed directory (/dev/shm where there
+    is one). Every process maps the same file, so they all see the same
+    pages, and nothing is written to disk. The process that creates the
+    storage starts a new file. A process that attaches with create=False
+    opens the existing file instead, and a ring built on it with the same
+    arguments sees the same audio and counters. The creator must allocate
+    every array before other processes attach.
+
+    ConcurrentRing keeps its sequence counters and tap cursors in storage
+    arrays, so a capture process and several reader processes can share one
+    ConcurrentRing without locks. A crashing reader only loses its own
+    mapping.
+
+    close() forgets this process's arrays. The mapping is released once
+    they (and the ring using them) are deleted. unlink() removes the file
+    once every process is done with it, and should be called once, by the
+    creator.
+    """
+    def __init__(self, name, create=True, directory=None):
+        if directory is None:
+            directory = shared_directory()
+        self.name   = name
+        self.create = create
+        path = os.path.join(directory, name)
+        if create and os.path.exists(path):
+            # Start from zeros, like MemoryStorage, not from an old ring
+            os.remove(path)
+        elif not create and not os.path.exists(path):
+            raise IOError('no shared storage named {0} in {1}'.format(name, directory))
+        super(SharedStorage, self).__init__(path)
+
+    def allocate(self, name, shape, dtype=None):
+        # Only the creator may add arrays, because adding one rewrites the
+        # header that the other processes read
+        if not self.create and name not in self:
+            raise KeyError('shared storage {0} has no array named {1}'.format(self.name, name))
+        return super(SharedStorage, self).allocate(name, shape, dtype)
+
+    def unlink(self):
+        """ Remove the file, once every process has attached """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def shared_directory():
+    """ A directory whose files live in memory, or the temporary directory
+    on systems without one
+    """
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
@@ -1,45 +1,140 @@
 import sys
 import re
 import types
+import threading
+import collections
 
-from time import sleep
+from time import sleep, time
 
-from OSC import OSCServer, OSCClient, OSCMessage, OSCClientError
+try:
+    from OSC import OSCServer, OSCClient, OSCMessage, OSCClientError
+except ImportError:
+    # Only needed to talk to a real controller (see StretchIO's send)
+    OSCServer = OSCClient = OSCMessage = OSCClientError = None
 
 
 class StretchIO(object):
+    """ Talk to the TouchOSC controller.
 
-    def __init__(self, send, listen=("0.0.0.0", 12340)):
-        self.server = OSCServer(listen)
-        self.server.timeout = 0.0
-        self.server.timed_out = False
+    The OSC server and client run on their own thread (see .start), so that
+    network traffic never blocks the audio callback. The two threads only
+    share:
 
-        def timeout(self):
-            self.timed_out = True
-        self.server.handle_timeout = types.MethodType(timeout, self.server)
+    - fader state, written by the network thread and read by the audio thread
+    - LED values, written by the audio thread (.led) and sent by the network
+      thread at most once every <led_interval> seconds, and only if changed
+    - a queue of toggle events and a changed flag for each fader, set by
+      the network thread and handled by the audio thread in .step, so that
+      handlers registered with set_toggle_handler and set_fader_handler
+      always run on the audio thread
 
-        self.client = OSCClient()
-        self.client.connect(send)
+    Without a <send> address no sockets are opened. Messages for the
+    controller are dropped, and messages from it can be passed straight to
+    .osc_handler, as the simulation does (see simulate.py).
+    """
 
-        self.__fader_state = [8, 8, 8, 8]
+    # The stretch amount of voices without a fader
+    default_fader = 8
+
+    def __init__(self, send, listen=("0.0.0.0", 12340), led_interval=0.05, controls=4):
+        """
+        send ((str, int)): the controller's address, or None to run offline
+        controls (int): the number of toggle, fader and LED sets on the
+                        TouchOSC layout. Voices beyond these use default_fader
+                        and have no LED.
+        """
+        self.server = None
+        self.client = None
+        if send is not None:
+            if OSCServer is None:
+                raise ImportError('pyOSC is needed to talk to a controller')
+            self.server = OSCServer(listen)
+            # handle_request blocks for at most this long, so the network
+            # thread also wakes up often enough to send LED updates
+            self.server.timeout = led_interval
+            self.server.timed_out = False
+
+            def timeout(self):
+                self.timed_out = True
+            self.server.handle_timeout = types.MethodType(timeout, self.server)
+
+            self.client = OSCClient()
+            self.client.connect(send)
+
+        self.__fader_state = [self.default_fader] * controls
+        self.__led_state   = [0.] * controls
+        self.__led_sent    = [0.] * controls
+        self.__led_interval = led_interval
+
+        # deque.append and deque.popleft are atomic, so this is safe to share
+        # between one producer and one consumer without a lock. Toggles are
+        # never dropped. They come from a finger, so the queue stays short.
+        self.__toggles = collections.deque()
+        # A burst of fader messages only needs the latest value of each
+        # fader, which is already in __fader_state. The network thread sets
+        # a fader's flag after the value, and the audio thread clears it
+        # before reading the value, so no change is missed.
+        self.__fader_changed = [False] * controls
 
         self.__fader_cb = None
         self.__toggle_cb = None
 
-        for i in range(1, 5):
-            self.led(i, 0.)
+        self.__thread  = None
+        self.__running = False
+
+        for i in range(1, controls + 1):
+            self.send_led(i, 0.)
             self.toggle(i, 0.)
             self.fader(i, self.__fader_state[i-1])
-            self.server.addMsgHandler('/1/toggle' + str(i), self.osc_handler)
-            self.server.addMsgHandler('/1/fader' + str(i), self.osc_handler)
+            if self.server is not None:
+                self.server.addMsgHandler('/1/toggle' + str(i), self.osc_handler)
+                self.server.addMsgHandler('/1/fader' + str(i), self.osc_handler)
 
+    def start(self):
+        """ Begin serving OSC on a background thread """
+        if self.__thread is not None or self.server is None:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__serve, name='StretchIO')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __serve(self):
+        last_flush = 0.
+        while self.__running:
+            self.server.handle_request()
+            now = time()
+            if now - last_flush >= self.__led_interval:
+                self.__flush_leds()
+                last_flush = now
+
+    def __flush_leds(self):
+        """ Send the LED values that changed since we last sent them """
+        for i, value in enumerate(self.__led_state):
+            if value != self.__led_sent[i]:
+                self.send_led(i + 1, value)
+                self.__led_sent[i] = value
 
     def step(self):
-        self.server.timed_out = False
-        while not self.server.timed_out:
-            self.server.handle_request()
+        """ Run the handlers for events received since the last call to step.
+        Call this from the audio thread.
+        """
+        toggles = self.__toggles
+        while toggles:
+            num, state = toggles.popleft()
+            if self.__toggle_cb is not None:
+                self.__toggle_cb(num, state)
+        # Each fader that moved, once, with its latest value
+        changed = self.__fader_changed
+        for i in range(len(changed)):
+            if changed[i]:
+                changed[i] = False
+                if self.__fader_cb is not None:
+                    self.__fader_cb(i + 1, self.__fader_state[i])
 
     def send(self, m):
+        if self.client is None:
+            return
         try:
             self.client.send(m)
         except OSCClientError:
@@ -48,7 +143,12 @@ class StretchIO(object):
 
 
     def close(self):
-        self.server.close()
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        if self.server is not None:
+            self.server.close()
 
     def set_toggle_handler(self, cb):
         """ Register the function to be called when we press the toggle.
@@ -85,25 +185,33 @@ class StretchIO(object):
 
         if name == 'fader':
             self.__fader_state[num-1] = state
-
-        if name == 'toggle' and self.__toggle_cb is not None:
-            self.__toggle_cb(num, state)
-        elif name == 'fader' and self.__fader_cb is not None:
-            self.__fader_cb(num, state)
-
+            self.__fader_changed[num-1] = True
+        elif name == 'toggle':
+            self.__toggles.append((num, state))
 
 
     def led(self, led_num, value):
-        m = OSCMessage('/1/led{0:d}'.format(led_num))
-        m.append(value)
+        """ Set an LED. The value is sent by the network thread """
+        if led_num > len(self.__led_state):
+            return
         if value > 1.0: value = 1.0
         if value < 0.0: value = 0.0
+        self.__led_state[led_num-1] = float(value)
+    def send_led(self, led_num, value):
+        if self.client is None:
+            return
+        m = OSCMessage('/1/led{0:d}'.format(led_num))
+        m.append(value)
         self.send(m)
     def toggle(self, toggle_num, value):
+        if self.client is None:
+            return
         m = OSCMessage('/1/toggle{0:d}'.format(toggle_num))
         m.append(1 if value else 0)
         self.send(m)
     def fader(self, fader_num, value):
+        if self.client is None:
+            return
         m = OSCMessage('/1/fader{0:d}'.format(fader_num))
         m.append(float(value))
         self.send(m)
@@ -112,6 +220,8 @@ class StretchIO(object):
         """
         <i> is the index from zero (unlike the setters, that index from 1)
         """
+        if i >= len(self.__fader_state):
+            return self.default_fader
         return self.__fader_state[i]
 
 
@@ -120,8 +230,9 @@ if __name__ == '__main__':
     def f(a, b):
         print 'handler', a, b
 
-    server = StretchIO()
-    server.register_toggle_handler(f)
+    server = StretchIO(("127.0.0.1", 12341))
+    server.set_toggle_handler(f)
+    server.start()
 
     while True:
         server.step()
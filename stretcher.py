@@ -1,16 +1,21 @@
 import numpy as np
-from numpy import fft
+import itertools
 import sys
 
+import fft_backend
+from phase import PhaseGenerator
 from ring import Ring, AnnotatedRing
+from workers import WorkerPool
+from fft_backend import complex_dtype
 
 class StretchWindow(object):
-    def __init__(self, size):
+    def __init__(self, size, dtype=None):
         if not float(np.log2(size)).is_integer():
             raise RuntimeError('StretchWindow size must be a power of two')
 
-        self.size = int(size)
-        self.half = int(size / 2.)
+        self.size  = int(size)
+        self.half  = int(size / 2.)
+        self.dtype = np.dtype(dtype)
 
         # The hann window function and tremelo compensation (hinv_buf) are copied
         # directly from paulstretch
@@ -35,33 +40,162 @@ class StretchWindow(object):
         # each half of the audio snippit separately.
         self.double_hinv_buf = np.concatenate((self.hinv_buf, self.hinv_buf))
 
+        # The tremelo compensation and the opening window are always applied
+        # together, so we combine them in to one table, and make one pass over
+        # the audio instead of two.
+        self.open_hinv = self.double_hinv_buf * self.open_window
+
+        # The tables are calculated in double precision, and then stored in
+        # the precision of the audio, so that applying them does not upcast
+        for name in ['hinv_buf', 'window', 'half_ones', 'open_window',
+                     'close_window', 'double_hinv_buf', 'open_hinv']:
+            setattr(self, name, getattr(self, name).astype(self.dtype))
 
     def hopsize(self, stretch_amount):
         return int(np.floor(self.size * 0.5 / stretch_amount))
 
 stretches = {}
-def get_strech(windowsize):
-    if windowsize not in stretches:
-        stretches[windowsize] = StretchWindow(windowsize)
-    return stretches[windowsize]
+def get_strech(windowsize, dtype=None):
+    key = (windowsize, np.dtype(dtype))
+    if key not in stretches:
+        stretches[key] = StretchWindow(windowsize, dtype)
+    return stretches[key]
+
+class ResizeGains(object):
+    """ The gains that join a hop with a half window of <previous_half> to
+    a hop with a half window of <half> (see Stretcher.overlap_add).
+
+    In the steady state both halves of every hop carry the tremolo
+    compensation hinv_buf, and the overlapping windows add up to a level of
+    about -3 dB. Across a resize the windows cross fade over the shorter of
+    the two halves, with the compensation of a window that size:
+
+    pass_through: scales the part of a longer previous tail before the
+                  cross fade down to the steady state level at its phase
+    close: closes the previous tail over the cross fade, swapping its
+           compensation for the cross fade's
+    open: opens the new hop over the cross fade, with the cross fade's
+          compensation
+    """
+    def __init__(self, previous_half, half, dtype=None):
+        overlap  = min(previous_half, half)
+        previous = StretchWindow(2 * previous_half)
+        fade     = StretchWindow(2 * overlap)
+        dtype    = np.dtype(dtype)
+
+        # The power of the two overlapping windows at each phase of the
+        # previous window, as in the steady state
+        steady = previous.close_window ** 2 + previous.window[:previous_half] ** 2
+        self.pass_through = np.sqrt(steady[:previous_half - overlap]).astype(dtype)
+        self.close = (fade.close_window * fade.hinv_buf /
+                      previous.hinv_buf[previous_half - overlap:]).astype(dtype)
+        self.open  = (fade.open_window[:overlap] * fade.hinv_buf).astype(dtype)
+
+resize_gains = {}
+def get_resize_gains(previous_half, half, dtype=None):
+    key = (previous_half, half, np.dtype(dtype))
+    if key not in resize_gains:
+        resize_gains[key] = ResizeGains(previous_half, half, dtype)
+    return resize_gains[key]
 
 fade_outs = {}
-def get_fade_out(size):
-    if size not in fade_outs:
-        fade_outs[size] = np.logspace(1, np.finfo(float).eps, size, base=10.) / 10
-    return fade_outs[size]
+def get_fade_out(size, dtype=None):
+    """ A curve that falls exponentially from 1 to 0 over <size> samples """
+    key = (size, np.dtype(dtype))
+    if key not in fade_outs:
+        curve = np.logspace(1, np.finfo(float).eps, size, base=10.) / 10
+        fade_outs[key] = ((curve - curve[-1]) / (1. - curve[-1])).astype(dtype)
+    return fade_outs[key]
+
+def stretch_frames(sw, frames, phasors, plans=None):
+    """ Run the spectral part of paulstretch on every row of <frames> at once.
+
+    Each row of the 2-D <frames> array is one input window of sw.size samples.
+    All the rows are windowed, transformed, phase randomized and transformed
+    back together, with one rfft and one irfft per batch of rows, so the cost
+    of a callback does not grow with the python overhead of one fft call per
+    hop.
+
+    <phasors> holds a row of random unit phasors (sw.half + 1 bins) for each
+    row of <frames>. Stretcher.read_frames fills them.
+
+    <plans> (fft_backend.Plans) holds plans made ahead of time, and the rows
+    are transformed in the batches it has plans for. Without it, this
+    thread's plan for the whole of <frames> is used, and made if needed.
+
+    The output is written over <frames>, which is returned.
+    """
+    if plans is None:
+        batches = [(0, len(frames))]
+        get_plan = fft_backend.get_plan
+    else:
+        batches = plans.batches(len(frames))
+        get_plan = plans.get_plan
+
+    frames *= sw.window
+    for first, count in batches:
+        rows = slice(first, first + count)
+        plan = get_plan((count, sw.size), sw.dtype)
+        spectrum = plan.rfft(frames[rows])
+        # Magnitude spectrum of windowed samples
+        mX = np.abs(spectrum)
+        # Randomise the phases for each bin by multiplying the magnitude
+        # spectrum with unit phasors distributed randomly around the circle.
+        np.multiply(mX, phasors[rows], out=spectrum)
+        # Get the audio samples with randomized phase. When we randomized the
+        # phase, we changed the waveform so it no longer starts and ends at
+        # zero. We will need to apply another window -- however do not know
+        # the size of the next window, so instead of applying the full window
+        # to our audio samples, we will close the window from the previous
+        # step, and open the window on our current samples.
+        frames[rows] = plan.irfft(spectrum)
+    return frames
+
+# Stretchers are stamped with the next value of a counter when they are
+# activated, so we can tell which active voice is the oldest. This one is
+# shared by stretchers that are not given their own.
+activations = itertools.count()
 
 class Stretcher(object):
     """ Given a tap pointer in a Ring buffer, generate the stretched audio
     """
 
-    def __init__(self, tap):
+    def __init__(self, tap, dtype=None, seed=None, phase_tables=0, ready_size=2**17,
+                 counter=None):
         """
         tap (RingPosition): the starting point where our stretch begins
+        dtype: precision of the output. Defaults to the dtype of the tap's ring
+        seed (int): seed the random phases, for a reproducible stretch
+        phase_tables (int): draw phases from this many precomputed tables
+                            instead of computing them (see phase.py)
+        ready_size (int): room for this many finished samples waiting to be
+                            taken (see queue)
+        counter (itertools.count): stamps our activations (see activated).
+                            Defaults to the module's shared counter.
         """
+        if dtype is None:
+            dtype = tap.get_ring().raw.dtype
         self.__in_tap     = tap
-        self.__buffer     = Ring(2**16)
+        self.__dtype      = np.dtype(dtype)
+        self.__buffer     = Ring(2**16, self.__dtype)
         self.__fading_out = False
+        # How many samples of the fade out have been played
+        self.__faded      = 0
+        self.__activated  = -1
+        self.__counter    = activations if counter is None else counter
+        self.__phases     = PhaseGenerator(seed, phase_tables)
+        # Scratch space for the closing tail of the previous window. The
+        # largest window that fits in our buffer is 2**16, so the largest
+        # half window is 2**15
+        self.__tail       = np.zeros(2**15, self.__dtype)
+        # The second half of the most recent hop is still open, waiting to
+        # be closed by the next hop. __pending is its length, or None
+        # before the first hop.
+        self.__pending    = None
+        self.__window     = None
+        # Finished output that has not been taken yet (see queue and take)
+        self.__ready      = np.zeros(ready_size, self.__dtype)
+        self.__ready_len  = 0
 
 
     def step(self, windowsize, *args, **kwargs):
@@ -73,61 +207,162 @@ class Stretcher(object):
         """
         Run paulstretch once from the current location of the tap point
         """
-        sw = get_strech(windowsize)
-        audio_in = self.__in_tap.get_samples(sw.size)
-
-        # Magnitude spectrum of windowed samples
-        mX = np.abs(fft.rfft(audio_in * sw.window))
-        # Randomise the phases for each bin between 0 and 2pi
-        pX = np.random.uniform(0, 2 * np.pi, len(mX)) * 1j
-        # use e^x to Convert our array of random values from 0 to 2pi to an
-        # array of cartesian style real+imag vales distributed around the unit
-        # circle. Then multiply with magnitude spectrum to rotate the magnitude
-        # spectrum around the circle.
-        freq = mX * np.exp(pX)
-        # Get the audio samples with randomized phase. When we randomized the
-        # phase, we changed the waveform so it no longer starts and ends at
-        # zero. We will need to apply another window -- however do not know the
-        # size of the next window, so instead of applying the full window to
-        # our audio samples, we will close the window from the previous step,
-        # and open the window on our current samples.
-        audio_phased = fft.irfft(freq)
-        # counter the tremelo for both halves of the audio snippet
-        audio_phased *= sw.double_hinv_buf
-        # Open the window to the newly generated audio sample
-        audio_phased *= sw.open_window
-
-        # Next we will do the overlap/add with the tail of our local buffer.
-        # First, retrive the the samples, apply the closing window
-        previous = self.__buffer.recent(sw.half) * sw.close_window
-
-        # overlap add this the newly generated audio with the closing tail of
-        # the previous signal
-        audio_phased[:sw.half] += previous
-        # replace the tail end of the output buffer with the new signal
-        self.__buffer.rewind(sw.half)
-        self.__buffer.append(audio_phased)
-        # The last <sw.half> samples are not valid (the window has not yet
-        # been closed). These will be closed the next time we call step.
-
-        # Advance our input tap
-        self.__in_tap.advance(sw.hopsize(stretch_amount))
-
-        # append the audio output to our output buffer
-        self.__buffer.append(audio_phased)
+        sw = get_strech(windowsize, self.__dtype)
+        frames = np.empty((1, sw.size), self.__dtype)
+        phasors = np.empty((1, sw.half + 1), complex_dtype(self.__dtype))
+        self.read_frames(sw, stretch_amount, frames, phasors)
+        # copy, because overlap_add may return our scratch space, which the
+        # next hop reuses
+        return self.overlap_add(sw, stretch_frames(sw, frames, phasors)[0]).copy()
+
+    def read_frames(self, sw, stretch_amount, frames, phasors):
+        """ Copy one input window per row of <frames>, advancing the input tap
+        by one hop after each window, and fill the matching rows of <phasors>
+        with this stretcher's random phases. This is the input half of
+        .stretch, split out so that StretchGroup can batch the FFT work of
+        many hops and many stretchers together.
+        """
+        self.__phases.fill(phasors)
+        for frame in frames:
+            self.__in_tap.get_samples(sw.size, out=frame)
+            # Advance our input tap
+            self.__in_tap.advance(sw.hopsize(stretch_amount))
+
+    def overlap_add(self, sw, audio_phased):
+        """ Window a phase randomized frame (the output of stretch_frames),
+        and overlap/add it with the tail of our output buffer. Returns the
+        samples that are now complete: the open tail of the previous hop,
+        which is <sw.half> samples long unless the window size changed.
+        """
+        previous_half = self.__pending
+        self.__pending = sw.half
+        self.__window = sw.size
+        if previous_half is not None and previous_half != sw.half:
+            return self.__resize_overlap_add(sw, audio_phased, previous_half)
+
+        # counter the tremelo for both halves of the audio snippet, and open
+        # the window to the newly generated audio sample
+        audio_phased *= sw.open_hinv
+
+        # Next we will do the overlap/add with the tail of our local buffer,
+        # in place in the buffer's storage. The tail is one slice, or two when
+        # it wraps around the end of the buffer. Apply the closing window,
+        # add the first half of the new audio, and copy the finished samples
+        # back for the caller.
+        first = 0
+        for tail in self.__buffer.recent_views(sw.half):
+            end = first + len(tail)
+            tail *= sw.close_window[first:end]
+            tail += audio_phased[first:end]
+            audio_phased[first:end] = tail
+            first = end
+
+        # Only the second half is new. It is not valid yet (the window has
+        # not been closed), and will be closed the next time we call step.
+        self.__buffer.append(audio_phased[sw.half:])
 
         return audio_phased[:sw.half]
 
+    def __resize_overlap_add(self, sw, audio_phased, previous_half):
+        """ overlap_add, when the previous hop used a different window size.
+
+        The windows cross fade over the shorter of the two half windows. The
+        longer tail of a larger previous window passes through until the
+        cross fade, at the level the steady state overlap would have. When
+        the new window is larger, the part of its first half before the
+        cross fade is dropped. See ResizeGains.
+        """
+        overlap = min(previous_half, sw.half)
+        gains = get_resize_gains(previous_half, sw.half, self.__dtype)
+
+        # The second half stays open, waiting for the next hop
+        audio_phased[sw.half:] *= sw.hinv_buf
+        opening = audio_phased[sw.half - overlap:sw.half]
+        opening *= gains.open
+
+        # The finished samples are not the same length as the new half
+        # window, so they are built in our scratch space. The buffer only
+        # needs to keep the open half.
+        previous = self.__buffer.recent(previous_half, out=self.__tail[:previous_half])
+        previous[:previous_half - overlap] *= gains.pass_through
+        previous[previous_half - overlap:] *= gains.close
+        previous[previous_half - overlap:] += opening
+
+        self.__buffer.append(audio_phased[sw.half:])
+        return previous
+
+    def queue(self, samples):
+        """ Keep finished <samples> until they are taken """
+        end = self.__reserve(len(samples))
+        self.__ready[self.__ready_len:end] = samples
+        self.__ready_len = end
+
+    def delay(self, number):
+        """ Queue <number> samples of silence """
+        end = self.__reserve(number)
+        self.__ready[self.__ready_len:end] = 0.
+        self.__ready_len = end
+
+    def __reserve(self, number):
+        """ Make room to queue <number> more samples, and return the end of
+        the queue once they are added. StretchGroup sizes the queue so that
+        this only grows it for steps longer than a window.
+        """
+        end = self.__ready_len + number
+        if end > len(self.__ready):
+            grown = np.zeros(2 * end, self.__dtype)
+            grown[:self.__ready_len] = self.__ready[:self.__ready_len]
+            self.__ready = grown
+        return end
+
+    def take(self, out):
+        """ Fill <out> with the oldest queued samples """
+        number = len(out)
+        if number > self.__ready_len:
+            raise BufferError('{0} samples are ready, {1} were taken'.format(self.__ready_len, number))
+        out[:] = self.__ready[:number]
+        self.__ready[:self.__ready_len - number] = self.__ready[number:self.__ready_len]
+        self.__ready_len -= number
+        return out
+
+    def release(self, out):
+        """ Copy what we would still play if we stopped hopping now in to
+        <out>: the queued samples, followed by the closed tail of the most
+        recent hop, which fades to silence over a half window. Returns the
+        number of samples copied.
+        """
+        number = min(self.__ready_len, len(out))
+        out[:number] = self.__ready[:number]
+        if self.__pending is not None:
+            sw = get_strech(self.__window, self.__dtype)
+            tail = self.__buffer.recent(sw.half, out=self.__tail[:sw.half])
+            tail *= sw.close_window
+            count = min(sw.half, len(out) - number)
+            out[number:number + count] = tail[:count]
+            number += count
+        return number
+
+    def close(self, sw):
+        """ Close the window of the most recent hop, and return the final
+        <sw.half> samples of output. Use this to finish a render that will
+        not be followed by another hop.
+        """
+        return self.__buffer.recent(sw.half) * sw.close_window
+
     def fade_out(self):
         """Begin fading the stretch with each .step() .step should deactivate
     
         Caution: fade_out is currently implemeted in StretchGroup. See:
         https://github.com/CharlesHolbrow/realtime-fft-experiment/issues/4
         """
+        if not self.__fading_out:
+            self.__faded = 0
         self.__fading_out = True
 
     def activate(self):
         self.__fading_out = False
+        self.__faded      = 0
+        self.__activated  = next(self.__counter)
         self.tap.activate()
 
     def deactivate(self):
@@ -142,15 +377,101 @@ class Stretcher(object):
     def fading_out(self, val):
         self.__fading_out = bool(val)
 
+    @property
+    def faded(self):
+        """ How many samples of the fade out have been played """
+        return self.__faded
+
+    @faded.setter
+    def faded(self, val):
+        self.__faded = int(val)
+
     @property
     def tap(self):
         return self.__in_tap
 
+    @property
+    def dtype(self):
+        return self.__dtype
+
+    @property
+    def activated(self):
+        """ Larger values were activated more recently. -1 until the first
+        activation.
+        """
+        return self.__activated
+
+    @property
+    def pending(self):
+        """ How many samples the next hop will complete, or None before the
+        first hop
+        """
+        return self.__pending
+
+    @property
+    def ready(self):
+        """ How many queued samples are waiting to be taken """
+        return self.__ready_len
+
+    @property
+    def capacity(self):
+        """ How many samples can be queued before the queue has to grow """
+        return len(self.__ready)
+
+    @property
+    def window_size(self):
+        """ The window size of the most recent hop """
+        return self.__window
+
     def clear(self):
         self.__buffer.raw.fill(0.)
+        self.__pending   = None
+        self.__window    = None
+        self.__ready_len = 0
+
+def default_routing(voices):
+    """ A (voices, 2) matrix that spreads voices across a stereo output.
+
+    The first voice is only on the left, the last voice is only on the
+    right, and the voices in between are on both sides.
+    """
+    routing = np.zeros((voices, 2))
+    for i in range(voices):
+        routing[i, 0] = i < voices - 1 or voices == 1
+        routing[i, 1] = i > 0 or voices == 1
+    return routing
 
 class StretchGroup(object):
-    def __init__(self, ring, osc_io):
+    def __init__(self, ring, osc_io, voices=4, routing=None, threads=0, parallel_threshold=3,
+                 seed=None, phase_tables=0, exponent=14, min_exponent=None, lead=0, ahead_hops=None,
+                 stagger=False, fade_length=2**13):
+        """
+        ring (AnnotatedRing): the input audio
+        osc_io (StretchIO): supplies stretch amounts, and displays voice levels
+                       (see assign)
+        voices (int): how many stretchers to preallocate
+        routing: a (voices, 2) gain matrix from each voice to the stereo output
+        threads (int): render voices on this many worker threads. With 0,
+                       everything renders on the calling thread.
+        parallel_threshold (int): use the workers only when at least this
+                       many voices are active. Handing work to other threads
+                       costs more than it saves for one or two voices.
+        seed (int): seed the voices' random phases. Voice i uses seed + i.
+        phase_tables (int): see Stretcher
+        exponent (int): voices use windows of 2 ** exponent samples
+        min_exponent (int): if given, each voice picks its window size for
+                       every hop, down to 2 ** min_exponent samples near
+                       transients (see window_size)
+        lead (int): render ahead, so that each voice has up to this many
+                       samples ready beyond the current step (see schedule)
+        ahead_hops (int): the number of hops a step may render, across all
+                       the voices. Defaults to the active voices divided by
+                       the steps per hop, rounded up (see schedule).
+        stagger (bool): hold back newly activated voices for a step when
+                       the step already has its share of hops
+        fade_length (int): voices fade out over this many samples, across
+                       as many steps as that takes
+        """
 
         if not isinstance(ring, AnnotatedRing):
             raise TypeError('Stretch Group requires annotated Ring')
@@ -159,20 +480,81 @@ class StretchGroup(object):
         self.__active_taps   = ring.active_taps
         self.__inactive_taps = ring.inactive_taps
         self.__io            = osc_io
+        # All our buffers use the precision of the input ring
+        self.__dtype         = ring.raw.dtype
         self.stretches       = {}
         self.stretches_list  = []
 
-        self.create_stretcher()
-        self.create_stretcher()
-        self.create_stretcher()
-        self.create_stretcher()
-
-
-    def create_stretcher(self):
+        self.exponent     = int(exponent)
+        self.min_exponent = None if min_exponent is None else int(min_exponent)
+        self.lead         = int(lead)
+        self.ahead_hops   = None if ahead_hops is None else int(ahead_hops)
+        self.stagger      = bool(stagger)
+        self.fade_length  = int(fade_length)
+        # Our voices count their activations together, so the order we steal
+        # them in does not depend on any other group
+        self.__activations = itertools.count()
+
+        for i in range(voices):
+            self.create_stretcher(None if seed is None else seed + i, phase_tables)
+
+        # The control (a fader and LED, numbered from one) of each voice, or
+        # None. Voice i starts with control i + 1. A voice without a control
+        # keeps the stretch amount it had last.
+        self.__controls      = list(range(1, voices + 1))
+        self.__stretch_amts  = [osc_io.fader_state(i) for i in range(voices)]
+
+        if routing is None:
+            routing = default_routing(voices)
+        self.routing = np.asarray(routing, self.__dtype)
+        if self.routing.shape != (voices, 2):
+            raise ValueError('routing must have shape ({0}, 2)'.format(voices))
+
+        # The output of each voice for one step, allocated when the size of
+        # the step changes
+        self.__voice_output  = np.zeros((voices, 0), self.__dtype)
+
+        # When a playing voice is stolen, the rest of what it would have
+        # played (see Stretcher.release) is mixed in to its output over the
+        # next steps, so it ends with its window closing instead of a click
+        release_size             = self.lead + 2 ** (self.exponent + 1) + 2 ** (self.exponent - 1)
+        self.__release           = np.zeros((voices, release_size), self.__dtype)
+        self.__release_scratch   = np.zeros(release_size, self.__dtype)
+        self.__release_len       = [0] * voices
+
+        # The most hops rendered in any one step, and the totals (see load)
+        self.__worst_hops = 0
+        self.__worst_work = 0.
+        self.__hops       = 0
+        self.__steps      = 0
+
+        self.__pool               = WorkerPool(threads) if threads > 0 else None
+        self.__parallel_threshold = parallel_threshold
+        # Plans for every window size we use, for each worker, made now so
+        # that the audio callback never waits for the fft planner. The last
+        # entry is used when we render on the calling thread.
+        sizes = [2 ** e for e in range(self.exponent if self.min_exponent is None else self.min_exponent,
+                                       self.exponent + 1)]
+        self.__plans              = [fft_backend.Plans(sizes, self.__dtype, voices)
+                                     for i in range(threads + 1)]
+        # Input frames and phasors for each worker, keyed by window size,
+        # with a row for every hop of that size in a step of up to a whole
+        # window. Each step renders in to row slices of them.
+        self.__scratch            = [dict((size, self.__frames(size, self.__frame_rows(size, voices)))
+                                          for size in sizes)
+                                     for i in range(threads + 1)]
+
+
+    def create_stretcher(self, seed=None, phase_tables=0):
         tap = self.ring.create_tap()
         tap.deactivate()
 
-        stretch = Stretcher(tap)
+        # Before a step is taken, a voice holds less than the step, the
+        # lead and one half window. Room for steps up to a whole window
+        # means the queue never grows in the audio callback.
+        stretch = Stretcher(tap, seed=seed, phase_tables=phase_tables,
+                            ready_size=self.lead + 2 ** (self.exponent + 1),
+                            counter=self.__activations)
         self.stretches[tap.name] = stretch
         self.stretches_list.append(stretch)
         return stretch
@@ -180,48 +562,316 @@ class StretchGroup(object):
     def step(self, num_samples):
         """ take a step num_samples long
 
-        num samples must be a in integer multiple of the halfwindowsize calculated here
+        Each voice renders as many hops as it needs to have at least
+        <num_samples> of output ready, and perhaps some more ahead of time
+        (see schedule). Output beyond <num_samples> waits in the voice's
+        queue for the next step, so any step size works with any window
+        size.
         """
-        exponent = 14 # raise 2 to this power to get windowsize
-        windowsize = 2 ** exponent
-        num_strech_steps = num_samples / (windowsize / 2)
-
-        results = np.zeros((num_samples, 2)) # should dtype be set explicitly?
-
-        for i, stretcher in enumerate(self.stretches_list):
-            tap = stretcher.tap
-            name = tap.name
-            # make sure that this tap is active before we try to stretch it
-            if name not in self.__active_taps:
-                continue
-
-            # Get the current position of the fader from touchosc
-            stretch_amt = self.__io.fader_state(i)
-            answer = np.concatenate([stretcher.step(windowsize, stretch_amt) for j in range(num_strech_steps)])
-
+        if self.__voice_output.shape[1] != num_samples:
+            self.__voice_output = np.zeros((len(self.stretches_list), num_samples), self.__dtype)
+        voice_output = self.__voice_output
+        voice_output.fill(0.)
+
+        # make sure that each tap is active before we try to stretch it
+        active = [(i, stretcher) for i, stretcher in enumerate(self.stretches_list)
+                  if stretcher.tap.name in self.__active_taps]
+        plans = self.schedule(active, num_samples)
+        self.__record_load(plans)
+
+        if self.__pool is not None and len(active) >= self.__parallel_threshold:
+            # Deal the voices out to the workers like cards
+            workers = min(len(self.__pool), len(plans))
+            shards = [plans[w::workers] for w in range(workers)]
+            self.__pool.run(lambda worker, shard: self.__render(
+                shard, num_samples, worker), shards)
+        elif len(active) > 0:
+            self.__render(plans, num_samples, -1)
+
+        # Deactivating a tap changes the ring's tap dictionaries, so fading out
+        # happens here, on the calling thread, after the workers are finished
+        # The fade lasts <fade_length> samples, however many steps that takes
+        for i, stretcher in active:
             if stretcher.fading_out:
+                fade = get_fade_out(self.fade_length, self.__dtype)
+                faded = stretcher.faded
+                count = max(0, min(num_samples, self.fade_length - faded))
+                voice_output[i, :count] *= fade[faded:faded + count]
+                voice_output[i, count:] = 0.
+                stretcher.faded = faded + num_samples
+                if stretcher.faded < self.fade_length:
+                    self.__led(i, stretcher.tap.energy_unit())
+                    continue
                 stretcher.fading_out = False
-                answer *= get_fade_out(len(answer))
                 stretcher.deactivate()
-                self.__io.led(i + 1, 0)
+                self.__led(i, 0)
             else:
-                self.__io.led(i + 1, tap.energy_unit())
-
-            if i in [0, 1, 2]:
-                results[:, 0] += answer
-            if i in [1, 2, 3]:
-                results[:, 1] += answer
+                self.__led(i, stretcher.tap.energy_unit())
+
+        for i, remaining in enumerate(self.__release_len):
+            if remaining:
+                count = min(remaining, num_samples)
+                release = self.__release[i]
+                voice_output[i, :count] += release[:count]
+                release[:remaining - count] = release[count:remaining]
+                release[remaining - count:remaining] = 0.
+                self.__release_len[i] = remaining - count
+
+        # Mix every voice in to the stereo output with one matrix multiply
+        return np.dot(voice_output.T, self.routing)
+
+    def window_size(self, tap, offset, previous):
+        """ The window size for a hop that begins <offset> samples after
+        <tap>, following a hop of size <previous> (or None).
+
+        Without min_exponent every hop uses 2 ** exponent. Otherwise we use
+        the largest window that ends before the next transient, so that the
+        transient is not smeared across a long window, but no smaller than
+        2 ** min_exponent. Windows shrink at once, but only double on each
+        hop, so sustained material returns to long windows smoothly.
+        """
+        size = 2 ** self.exponent
+        if self.min_exponent is None:
+            return size
+        distance = tap.samples_to_transient_after(offset)
+        if distance is not None:
+            while size > 2 ** self.min_exponent and size > distance:
+                size //= 2
+        if previous is not None:
+            size = min(size, 2 * previous)
+        return size
+
+    def plan(self, stretcher, stretch_amt, num_samples):
+        """ The hops <stretcher> would render to have <num_samples> of
+        output ready, as a list of (window size, samples ready before the
+        hop) pairs. Each hop completes the open half of the hop before it.
+
+        A voice stretching by less than one reads faster than the input
+        arrives. Hops whose window has not been written yet are left out.
+        """
+        ready     = stretcher.ready
+        pending   = stretcher.pending
+        size      = stretcher.window_size
+        available = stretcher.tap.valid_buffer_length
+        offset    = 0
+        hops      = []
+        while ready < num_samples:
+            size = self.window_size(stretcher.tap, offset, size)
+            if offset + size > available:
+                break
+            hops.append((size, ready))
+            ready += size // 2 if pending is None else pending
+            pending = size // 2
+            offset += get_strech(size, self.__dtype).hopsize(stretch_amt)
+        return hops
+
+    def schedule(self, active, num_samples):
+        """ Decide which hops each of the (voice_number, stretcher) pairs in
+        <active> renders in this step. Returns a list of (voice_number,
+        stretcher, stretch_amt, window sizes).
+
+        Every voice renders the hops it needs for this step. When the step
+        is much shorter than a hop, most steps need no hops at all, and the
+        steps that do would pay for every voice at once. With a <lead>, the
+        voices that are closest to running out render hops early, until the
+        step has rendered <ahead_hops> hops. That staggers the hops of the
+        voices, so that in steady state no step renders more than
+        ceil(voices / steps per hop) hops.
+
+        Voices activated together would still all need their first hop in
+        the same step. With <stagger>, a new voice whose first hop does not
+        fit in the step waits for a later step, and plays silence for this
+        one. Its window sizes are then None.
+        """
+        budget = self.ahead_hops
+        if budget is None:
+            steps_per_hop = max(1, 2 ** (self.exponent - 1) // num_samples)
+            budget = -(-len(active) // steps_per_hop)
+
+        plans = []
+        ahead = []
+        rendering = 0
+        # Voices that are already playing come first, because they cannot wait
+        for i, stretcher in sorted(active, key=lambda voice: voice[1].pending is None):
+            # Get the current position of the fader from touchosc
+            control = self.__controls[i]
+            if control is not None:
+                self.__stretch_amts[i] = self.__io.fader_state(control - 1)
+            stretch_amt = self.__stretch_amts[i]
+            hops = self.plan(stretcher, stretch_amt, num_samples + self.lead)
+            needed = len([ready for size, ready in hops if ready < num_samples])
+            if self.stagger and stretcher.pending is None and rendering + needed > budget:
+                plans.append([i, stretcher, stretch_amt, None, hops])
+                continue
+            rendering += needed
+            # How much output the voice will have left after this step, before
+            # each of the hops it could render early
+            ahead.extend((ready - num_samples, len(plans)) for size, ready in hops[needed:])
+            plans.append([i, stretcher, stretch_amt, needed, hops])
+
+        for spare, n in sorted(ahead)[:max(0, budget - rendering)]:
+            plans[n][3] += 1
+        return [(voice, voice_stretcher, amt, None if count is None else [hop[0] for hop in voice_hops[:count]])
+                for voice, voice_stretcher, amt, count, voice_hops in sorted(plans, key=lambda plan: plan[0])]
+
+    def __frame_rows(self, size, voices):
+        """ The most hops of <size> that <voices> voices can render in one
+        step of up to a whole window. Each hop completes half a window of the
+        hop before it, so a voice renders at most one more hop of <size>
+        than there are half windows of <size> in the step and the lead.
+        """
+        return voices * ((2 ** self.exponent + self.lead) // (size // 2) + 2)
+
+    def __frames(self, size, rows):
+        """ Scratch input frames and phasors for <rows> hops of <size> """
+        return (np.empty((rows, size), self.__dtype),
+                np.empty((rows, size // 2 + 1), complex_dtype(self.__dtype)))
+
+    def __record_load(self, plans):
+        hops = 0
+        work = 0.
+        for i, stretcher, stretch_amt, sizes in plans:
+            for size in sizes or []:
+                hops += 1
+                # relative to a transform of the largest window
+                work += size * np.log2(size) / (2 ** self.exponent * self.exponent)
+        self.__worst_hops = max(self.__worst_hops, hops)
+        self.__worst_work = max(self.__worst_work, work)
+        self.__hops  += hops
+        self.__steps += 1
 
-        return results
+    @property
+    def load(self):
+        """ How many hops (each an FFT pair) the steps have rendered: the
+        worst step, the mean per step, and the worst step's FFT work in
+        hops of the largest window
+        """
+        return {
+            'steps': self.__steps,
+            'worst': self.__worst_hops,
+            'mean': self.__hops / float(max(self.__steps, 1)),
+            'worst_work': self.__worst_work,
+        }
+
+    def __render(self, plans, num_samples, worker):
+        """ Render the hops of each (voice_number, stretcher, stretch_amt,
+        window sizes) plan in to the voice's queue, and take its output for
+        this step, using the scratch space of <worker>
+        """
+        # Give each hop a row in the frames of its window size. Consecutive
+        # hops of one voice with the same size are read together, as a run
+        # of rows.
+        rows = {}
+        voices = []
+        for i, stretcher, stretch_amt, sizes in plans:
+            if sizes is None:
+                # A staggered voice waits, and plays silence for this step
+                stretcher.delay(num_samples)
+                sizes = []
+            runs = []
+            for size in sizes:
+                if runs and runs[-1][0] == size:
+                    runs[-1][2] += 1
+                else:
+                    runs.append([size, rows.get(size, 0), 1])
+                rows[size] = rows.get(size, 0) + 1
+            voices.append((i, stretcher, stretch_amt, runs))
+
+        # Gather the input windows for every hop of every active stretcher in
+        # to one 2-D array per window size, so that we can run the fft for
+        # all of them in a few batched calls per size.
+        scratch = self.__scratch[worker]
+        frames = {}
+        for size, count in rows.items():
+            voice_frames, phasors = scratch[size]
+            if count > len(voice_frames):
+                # Only steps longer than a window get here
+                scratch[size] = voice_frames, phasors = self.__frames(size, count)
+            frames[size] = (voice_frames[:count], phasors[:count])
+
+        for i, stretcher, stretch_amt, runs in voices:
+            for size, first, count in runs:
+                voice_frames, phasors = frames[size]
+                stretcher.read_frames(get_strech(size, self.__dtype), stretch_amt,
+                                      voice_frames[first:first + count], phasors[first:first + count])
+
+        stretched = {}
+        for size, (voice_frames, phasors) in frames.items():
+            stretched[size] = stretch_frames(get_strech(size, self.__dtype), voice_frames, phasors,
+                                             self.__plans[worker])
+
+        for i, stretcher, stretch_amt, runs in voices:
+            for size, first, count in runs:
+                sw = get_strech(size, self.__dtype)
+                for row in stretched[size][first:first + count]:
+                    stretcher.queue(stretcher.overlap_add(sw, row))
+            # A voice that caught up with the input plays silence until
+            # there is enough input for its next hop
+            if stretcher.ready < num_samples:
+                stretcher.delay(num_samples - stretcher.ready)
+            stretcher.take(self.__voice_output[i])
 
     def get_inactive_stretcher(self):
-        """ Return an unused stretcher from this group if one exists. If all
-        stretchers are in use, return None.
+        """ Return the first unused stretcher from this group if one exists.
+        If all stretchers are in use, steal the voice that was activated
+        longest ago.
+        """
+        for stretcher in self.stretches_list:
+            if stretcher.tap.name in self.__inactive_taps:
+                return stretcher
+        oldest = min(self.stretches_list, key=lambda stretcher: stretcher.activated)
+        self.__release_voice(self.stretches_list.index(oldest))
+        oldest.deactivate()
+        return oldest
+
+    def assign(self, stretcher, control):
+        """ Let <control> (numbered from one) set the stretch amount of
+        <stretcher>, and show its level. Any other voice with that control
+        loses it, and keeps the stretch amount it had.
+        """
+        for i, other in enumerate(self.__controls):
+            if other == control:
+                self.__controls[i] = None
+        self.__controls[self.stretches_list.index(stretcher)] = control
+
+    def control(self, stretcher):
+        """ The control number of <stretcher>, or None """
+        return self.__controls[self.stretches_list.index(stretcher)]
+
+    def __led(self, i, value):
+        if self.__controls[i] is not None:
+            self.__io.led(self.__controls[i], value)
+
+    def __release_voice(self, i):
+        """ Keep the rest of what voice <i> would play, to be mixed in to
+        its output over the next steps, on top of anything left from an
+        earlier release
         """
-        if len(self.__inactive_taps) == 0:
-            return None
-        name = self.__inactive_taps.iterkeys().next()
-        return self.stretches[name]
+        stretcher = self.stretches_list[i]
+        scratch = self.__release_scratch
+        count = stretcher.release(scratch)
+        if stretcher.fading_out:
+            # carry on with the fade, where it got to
+            fade = get_fade_out(self.fade_length, self.__dtype)[stretcher.faded:]
+            count = min(count, len(fade))
+            scratch[:count] *= fade[:count]
+        self.__release[i, :count] += scratch[:count]
+        self.__release_len[i] = max(self.__release_len[i], count)
+
+    def close(self):
+        """ Stop the worker threads, if we have any """
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool = None
+
+    @property
+    def voices(self):
+        return len(self.stretches_list)
+
+    @property
+    def voice_output(self):
+        """ The (voices, num_samples) output of each voice in the last step """
+        return self.__voice_output
 
     @property
     def ring(self):
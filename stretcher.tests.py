@@ -0,0 +1,737 @@
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import traceback
+
+import numpy as np
+from scipy.io import wavfile
+
+import fft_backend
+import render
+import simulate
+import telemetry
+from concurrent_ring import ConcurrentRing, TapReader
+from engine import Engine
+from phase import PhaseGenerator
+from ring import Ring, AnnotatedRing
+from sinks import SinkWriter, WavSink, SocketSink, read_wav, stem_sinks
+from stretch_io import StretchIO
+from stretcher import Stretcher, StretchGroup, default_routing, get_strech, stretch_frames
+from workers import WorkerPool
+
+
+class FakeIO(object):
+    """ Stand in for StretchIO, so we can stretch without a network """
+    def fader_state(self, i):
+        return 4
+
+    def led(self, led_num, value):
+        pass
+
+
+class FakeStatus(object):
+    """ Stand in for sd.CallbackFlags """
+    def __init__(self, **flags):
+        for flag in telemetry.xrun_flags:
+            setattr(self, flag, bool(flags.get(flag, False)))
+
+
+def render_group(dtype, callbacks=4, blocksize=2**14):
+    """ Stretch a seeded noise burst and return the output of StretchGroup """
+    source = np.random.RandomState(0).randn(2**17) * np.hanning(2**17)
+    ring = AnnotatedRing(2**17 // 512, 512, dtype=dtype)
+    ring.append(source.astype(dtype))
+    group = StretchGroup(ring, FakeIO(), seed=1)
+    stretcher = group.stretches_list[1]
+    stretcher.tap.index = 0
+    stretcher.activate()
+
+    return np.concatenate([group.step(blocksize) for i in range(callbacks)])
+
+
+def test_float32_quality():
+    reference = render_group('float64')
+    single = render_group('float32')
+
+    # no hidden upcasts on the way through
+    assert single.dtype == np.float32
+
+    # float32 rounding should be far below anything audible
+    noise = np.sum((single - reference) ** 2)
+    snr = 10 * np.log10(np.sum(reference ** 2) / noise)
+    assert snr > 100., snr
+
+
+def test_render_segments():
+    """ Stitched segments should match an unsegmented render """
+    audio = np.random.RandomState(0).randn(20000, 1)
+
+    def stretch(segment_hops):
+        jobs = render.segment_jobs(audio, 2**10, 4, segment_hops)
+        return render.stitch([render.render_segment(job) for c, job in jobs], 2**9)
+
+    # Zero the random phases, so that the two renders are comparable
+    fill = PhaseGenerator.fill
+    PhaseGenerator.fill = lambda self, out: out.fill(1.)
+    try:
+        whole = stretch(10**6)
+        segmented = stretch(5)
+    finally:
+        PhaseGenerator.fill = fill
+
+    assert len(whole) == len(segmented)
+    assert np.allclose(whole, segmented)
+
+
+def test_callback_stats():
+    """ Percentiles, budget overruns and xruns from known callback times """
+    now = [0.]
+    timer = telemetry.timer
+    telemetry.timer = lambda: now[0]
+    try:
+        stats = telemetry.CallbackStats(['osc', 'stretch'], budget=0.002)
+        assert stats.percentile('osc', 50) is None
+        for i in range(100):
+            stats.begin()
+            now[0] += 1e-4
+            stats.mark('osc')
+            # one callback in ten takes 3 ms instead of 1 ms
+            now[0] += 3e-3 if i % 10 == 9 else 1e-3
+            stats.mark('stretch')
+            status = FakeStatus(output_underflow=i % 10 == 9, input_overflow=i == 50)
+            stats.end(status)
+        report = stats.report()
+    finally:
+        telemetry.timer = timer
+
+    assert report['callbacks'] == 100
+    assert report['over_budget'] == 10
+    assert report['xruns'] == {'input_underflow': 0, 'input_overflow': 1,
+                               'output_underflow': 10, 'output_overflow': 0}
+    # percentiles are the upper edge of a bin, within about 6% above
+    stretch = report['sections']['stretch']
+    assert 1e-3 * 0.99 < stretch['p50'] < 1e-3 * 1.07
+    assert 1e-3 * 0.99 < stretch['p90'] < 1e-3 * 1.07
+    assert 3e-3 * 0.99 < stretch['p99'] < 3e-3 * 1.07
+    assert abs(stretch['max'] - 3e-3) < 1e-9
+    total = report['sections']['total']
+    assert 1.1e-3 * 0.99 < total['p50'] < 1.1e-3 * 1.07
+    assert abs(total['max'] - 3.1e-3) < 1e-9
+    assert 1e-4 * 0.99 < report['sections']['osc']['p99'] < 1e-4 * 1.07
+
+    # the counts are for the interval since the last report
+    report = stats.report()
+    assert report['callbacks'] == 0 and report['over_budget'] == 0
+    assert not any(report['xruns'].values())
+    assert report['sections']['stretch']['max'] == stretch['max']
+
+
+def test_overlap_add():
+    """ The in place overlap add matches windowing each frame and adding the
+    closed tail of the frame before
+    """
+    sw = get_strech(2**10)
+    ring = Ring(2**12)
+    stretcher = Stretcher(ring.create_tap())
+    rs = np.random.RandomState(0)
+    tail = np.zeros(sw.half)
+    for i in range(3):
+        frame = rs.randn(sw.size)
+        expected = frame * sw.open_hinv
+        expected[:sw.half] += tail * sw.close_window
+        tail = expected[sw.half:]
+        assert np.allclose(stretcher.overlap_add(sw, frame), expected[:sw.half])
+    assert np.allclose(stretcher.close(sw), tail * sw.close_window)
+
+
+def test_batched_stretch():
+    """ Reading and stretching several hops at once, as StretchGroup does,
+    gives the same samples as Stretcher.stretch one hop at a time, given the
+    same phase seed
+    """
+    source = np.random.RandomState(0).randn(2**16)
+    sw = get_strech(2**12, 'float64')
+    hops = 6
+
+    def stretcher(ring):
+        ring.append(source)
+        stretcher = Stretcher(ring.create_tap(), seed=5)
+        stretcher.tap.index = 0
+        return stretcher
+
+    # the tap only keeps a weak reference to its ring
+    ring = Ring(2**16, 'float64')
+    single = stretcher(ring)
+    per_hop = np.concatenate([single.stretch(sw.size, 4) for i in range(hops)])
+
+    # with and without plans, which split the rows in to smaller batches
+    for plans in [None, fft_backend.Plans([sw.size], 'float64', 2)]:
+        batch_ring = Ring(2**16, 'float64')
+        batch = stretcher(batch_ring)
+        frames = np.empty((hops, sw.size))
+        phasors = np.empty((hops, sw.half + 1), 'complex128')
+        batch.read_frames(sw, 4, frames, phasors)
+        frames = stretch_frames(sw, frames, phasors, plans)
+        batched = np.concatenate([batch.overlap_add(sw, row).copy() for row in frames])
+        np.testing.assert_allclose(batched, per_hop, rtol=1e-9, atol=1e-12)
+
+
+def test_voice_pool():
+    # the default routing for four voices matches the original hard coded
+    # channel assignment
+    assert np.all(default_routing(4) == [[1, 0], [1, 1], [1, 1], [0, 1]])
+
+    ring = AnnotatedRing(64, 512)
+    ring.append(np.random.RandomState(0).randn(2**15))
+    group = StretchGroup(ring, FakeIO(), voices=6)
+    assert group.voices == 6
+
+    order = []
+    for i in range(6):
+        stretcher = group.get_inactive_stretcher()
+        stretcher.tap.index = 0
+        stretcher.activate()
+        order.append(stretcher)
+
+    # when every voice is busy, the oldest is stolen
+    oldest = order[0]
+    assert group.get_inactive_stretcher() is oldest
+    assert oldest.tap.name not in ring.active_taps
+
+    # a voice that takes a control takes it away from the voice that had it
+    group.assign(oldest, 2)
+    assert group.control(oldest) == 2
+    assert group.control(order[1]) is None
+
+    results = group.step(2**13)
+    assert results.shape == (2**13, 2)
+    assert np.allclose(results, np.dot(group.voice_output.T, group.routing))
+    assert not np.any(group.voice_output[group.stretches_list.index(oldest)])
+
+
+def test_voice_steal():
+    """ A stolen voice plays on until its last window has closed, instead
+    of stopping dead
+    """
+    ring = AnnotatedRing(64, 512)
+    ring.append(np.random.RandomState(0).randn(2**15))
+    group = StretchGroup(ring, FakeIO(), voices=2, seed=1)
+    for stretcher in group.stretches_list:
+        stretcher.tap.index = 0
+        stretcher.activate()
+    for i in range(3):
+        group.step(4096)
+    before = group.voice_output[0].copy()
+    # what it has queued, then its open half window
+    left = group.stretches_list[0].ready + 2**13
+
+    assert group.get_inactive_stretcher() is group.stretches_list[0]
+    after = []
+    for i in range(3):
+        group.step(4096)
+        after.append(group.voice_output[0].copy())
+    after = np.concatenate(after)
+    rms = lambda x: np.sqrt(np.mean(x ** 2))
+    assert 0.5 < rms(after[:256]) / rms(before[-256:]) < 2.
+    # the closing window ends in silence, and then nothing is left
+    assert rms(after[left - 256:left]) < 0.05 * rms(before)
+    assert np.any(after[left - 2]) and not np.any(after[left:])
+
+
+def test_worker_threads():
+    """ Rendering on worker threads should match rendering serially """
+    def stretch(threads):
+        ring = AnnotatedRing(64, 512)
+        ring.append(np.random.RandomState(0).randn(2**15))
+        group = StretchGroup(ring, FakeIO(), voices=5, threads=threads, seed=7)
+        for i, stretcher in enumerate(group.stretches_list):
+            stretcher.tap.index = i * 512
+            stretcher.activate()
+        try:
+            return np.concatenate([group.step(2**13) for i in range(2)])
+        finally:
+            group.close()
+
+    # Each voice has its own seeded phases, so the thread it renders on
+    # makes no difference
+    serial = stretch(0)
+    parallel = stretch(3)
+    assert np.any(serial)
+    assert np.allclose(serial, parallel)
+
+    # an error in a worker is raised with the worker's traceback
+    def fail(worker, shard):
+        raise ValueError(shard)
+    pool = WorkerPool(2)
+    try:
+        pool.run(fail, ['a', 'b'])
+    except ValueError:
+        assert traceback.extract_tb(sys.exc_info()[2])[-1][2] == 'fail'
+    else:
+        assert False
+    finally:
+        pool.close()
+
+
+def test_planned_ffts():
+    """ StretchGroup makes every fft plan it needs up front, so a changing
+    number of voices and window sizes plans nothing during a step
+    """
+    plans = fft_backend.Plans([2**10], 'float64', 5)
+    assert plans.max_rows == 8
+    assert plans.batches(13) == [(0, 8), (8, 4), (12, 1)]
+
+    made = []
+
+    class Counting(fft_backend.NumpyFFT):
+        def __init__(self, shape, dtype):
+            made.append(shape)
+            super(Counting, self).__init__(shape, dtype)
+
+    t = np.arange(2**18) / 44100.
+    source = 0.02 * np.sin(2 * np.pi * 220 * t)
+    source[2**17:] += 0.5 * np.sin(2 * np.pi * 330 * t[2**17:])
+    ring = AnnotatedRing(2**18 // 512, 512)
+    ring.append(source)
+
+    default = fft_backend.default_backend
+    fft_backend.default_backend = Counting
+    try:
+        group = StretchGroup(ring, FakeIO(), voices=3, seed=1, min_exponent=10)
+        planned = len(made)
+        windows = set()
+        for i, stretcher in enumerate(group.stretches_list):
+            stretcher.tap.index = 2**17 - 20000 + i * 3000
+            stretcher.activate()
+            for size in [1000, 2**13, 3000]:
+                group.step(size)
+                windows.update(s.window_size for s in group.stretches_list)
+    finally:
+        fft_backend.default_backend = default
+    assert len(windows) > 2
+    assert len(made) == planned
+
+
+def test_window_sizes():
+    """ Callbacks of any size are filled exactly, and adaptive voices use
+    short windows around a transient
+    """
+    t = np.arange(2**18) / 44100.
+    source = 0.02 * np.sin(2 * np.pi * 220 * t)
+    source[2**17:] += 0.5 * np.sin(2 * np.pi * 330 * t[2**17:])
+
+    def stretch(sizes, min_exponent=None):
+        ring = AnnotatedRing(2**18 // 512, 512)
+        ring.append(source)
+        group = StretchGroup(ring, FakeIO(), voices=1, seed=1, min_exponent=min_exponent)
+        stretcher = group.stretches_list[0]
+        stretcher.tap.index = 2**17 - 20000
+        stretcher.activate()
+        windows = []
+        output = []
+        for size in sizes:
+            output.append(group.step(size))
+            assert output[-1].shape == (size, 2)
+            windows.append(stretcher.window_size)
+        return np.concatenate(output), windows
+
+    # Output left over from one step is used by the next, so uneven steps
+    # give the same audio as steps of whole hops
+    whole, windows = stretch([2**13] * 4)
+    uneven, windows = stretch([1000, 3000, 12384, 500, 15884])
+    assert np.allclose(whole, uneven)
+
+    output, windows = stretch([2000] * 60, min_exponent=10)
+    assert windows[0] == 2**14
+    assert min(windows) == 2**10
+    assert windows[-1] == 2**14
+    assert np.all(np.isfinite(output))
+    # the windows shrink on the way in to the transient
+    shrinking = windows[:windows.index(2**10) + 1]
+    assert shrinking == sorted(shrinking, reverse=True)
+
+
+def test_resize_level():
+    """ The output level stays at the steady state level when the window
+    size changes, in either direction. Each hop is fed unit noise, and the
+    power is averaged over many voices.
+    """
+    rs = np.random.RandomState(3)
+    ring = AnnotatedRing(8, 512)
+    sizes = [8192] * 3 + [4096] * 3 + [1024] * 6 + [2048, 4096, 8192, 8192]
+    power = 0.
+    trials = 200
+    for i in range(trials):
+        stretcher = Stretcher(ring.create_tap(), dtype='float64')
+        output = [stretcher.overlap_add(get_strech(size, 'float64'), rs.randn(size)).copy()
+                  for size in sizes]
+        # the first hop only opens its window
+        power = power + np.concatenate(output[1:]) ** 2 / trials
+    level = 10 * np.log10(np.convolve(power, np.ones(256) / 256., 'valid'))
+    # the steady state overlap varies between about -3.1 and -2.6 dB
+    assert level.min() > -3.6 and level.max() < -2.1, (level.min(), level.max())
+
+
+def test_engine_voices():
+    """ Toggles take voices from the pool, and steal the oldest when every
+    voice is playing. Each toggle's fader follows the voice it turned on.
+    """
+    rs = np.random.RandomState(0)
+    outdata = np.zeros((512, 2))
+
+    def start(voices, controls):
+        ring = AnnotatedRing(2**18 // 512, 512)
+        osc_io = StretchIO(None, controls=controls)
+        group = StretchGroup(ring, osc_io, voices=voices, seed=1)
+        engine = Engine(ring, group, osc_io, 512, telemetry.CallbackStats(['osc', 'append', 'stretch']),
+                        verbose=False)
+
+        def callback(*messages):
+            for path, value in messages:
+                osc_io.osc_handler(path, ',f', [value], None)
+            engine.audio_callback(rs.randn(512, 1), outdata, 512, None, None)
+        for i in range(40):
+            callback()
+        return engine, group.stretches_list, callback
+
+    engine, (first, second, third), callback = start(3, 4)
+    callback(('/1/toggle1', 1.), ('/1/toggle2', 1.), ('/1/toggle3', 1.))
+    assert engine.voices == {1: first, 2: second, 3: third}
+    # every voice plays, so toggle 4 steals the oldest
+    callback(('/1/toggle4', 1.), ('/1/fader4', 2.), ('/1/fader1', 16.))
+    assert engine.voices == {2: second, 3: third, 4: first}
+    assert engine.stretch_group.control(first) == 4
+    assert engine.stretch_group.schedule([(0, first)], 512)[0][2] == 2.
+    # the stolen voice's old toggle no longer fades it out
+    callback(('/1/toggle1', 0.))
+    assert not first.fading_out
+    callback(('/1/toggle4', 0.))
+    assert first.fading_out
+    engine.stretch_group.close()
+
+    # with more voices than toggles, a toggle turned off and on again plays
+    # a new voice while the old one fades out
+    engine, (first, second, third), callback = start(3, 2)
+    callback(('/1/toggle1', 1.), ('/1/toggle2', 1.))
+    callback(('/1/toggle1', 0.))
+    callback(('/1/toggle1', 1.))
+    assert engine.voices == {1: third, 2: second}
+    assert first.fading_out
+    callback()
+    assert np.any(engine.stretch_group.voice_output[2])
+    engine.stretch_group.close()
+
+
+def test_osc_events():
+    """ A storm of fader messages between two steps loses no toggles, and
+    each fader's handler runs once, with its latest value
+    """
+    osc_io = StretchIO(None)
+    toggles = []
+    faders = []
+    osc_io.set_toggle_handler(lambda num, state: toggles.append((num, state)))
+    osc_io.set_fader_handler(lambda num, state: faders.append((num, state)))
+    for i in range(1000):
+        osc_io.osc_handler('/1/fader{0}'.format(i % 3 + 1), ',f', [float(i)], None)
+        if i % 100 == 0:
+            osc_io.osc_handler('/1/toggle{0}'.format(i // 100 % 4 + 1), ',f', [i // 100 % 2], None)
+    osc_io.step()
+    assert toggles == [(i % 4 + 1, i % 2) for i in range(10)]
+    assert faders == [(1, 999.), (2, 997.), (3, 998.)]
+    assert osc_io.fader_state(0) == 999.
+    del faders[:]
+    osc_io.step()
+    assert faders == []
+
+
+def test_render_ahead():
+    """ Short steps with a lead spread the hops of the voices out, without
+    changing the audio
+    """
+    def stretch(lead):
+        ring = AnnotatedRing(2**18 // 512, 512)
+        ring.append(np.random.RandomState(0).randn(2**18))
+        group = StretchGroup(ring, FakeIO(), voices=4, seed=1, lead=lead)
+        for i, stretcher in enumerate(group.stretches_list):
+            stretcher.tap.index = i * 1000
+            stretcher.activate()
+        active = list(enumerate(group.stretches_list))
+        hops = []
+        output = []
+        for i in range(64):
+            hops.append(sum(len(sizes) for i, s, a, sizes in group.schedule(active, 512)))
+            output.append(group.step(512))
+        return np.concatenate(output), hops
+
+    just_in_time, hops = stretch(0)
+    # every voice needs a hop in the same step
+    assert max(hops) == 4
+    ahead, hops = stretch(2**13)
+    assert np.allclose(just_in_time, ahead)
+    # after the first step, no step renders more than one hop
+    assert max(hops[1:]) == 1
+    assert sum(hops) == 4 * 5
+
+
+def test_render_ahead_of_input():
+    """ A voice that reads as fast as the input arrives never plans a hop
+    whose input has not been written, even with a lead
+    """
+    class NoStretch(FakeIO):
+        def fader_state(self, i):
+            return 1
+
+    rs = np.random.RandomState(1)
+    ring = AnnotatedRing(2**18 // 512, 512)
+    ring.append(rs.randn(2**15))
+    group = StretchGroup(ring, NoStretch(), voices=1, seed=1, lead=2**13)
+    stretcher = group.stretches_list[0]
+    stretcher.tap.index = ring.index - 2**14
+    stretcher.activate()
+    silent = 0
+    for i in range(200):
+        ring.append(rs.randn(512))
+        for size, ready in group.plan(stretcher, 1, 512 + group.lead):
+            assert stretcher.tap.valid_buffer_length >= size
+        output = group.step(512)
+        silent += not np.any(output)
+    # it plays, with gaps while it waits for input
+    assert silent < 200
+
+
+def test_fade_out():
+    """ A fade out lasts fade_length samples, even with short steps """
+    ring = AnnotatedRing(2**18 // 512, 512)
+    ring.append(np.random.RandomState(0).randn(2**18))
+    group = StretchGroup(ring, FakeIO(), voices=1, seed=1)
+    stretcher = group.stretches_list[0]
+    stretcher.tap.index = 0
+    stretcher.activate()
+    group.step(2**14)
+    stretcher.fade_out()
+    output = []
+    for i in range(2**13 // 64):
+        assert stretcher.tap.name in ring.active_taps
+        output.append(group.step(64)[:, 0])
+    assert stretcher.tap.name not in ring.active_taps
+    output = np.concatenate(output)
+    # the level falls steadily to silence
+    rms = np.sqrt(np.mean(output.reshape(16, -1) ** 2, axis=1))
+    assert np.all(np.diff(rms) < 0) and rms[0] > 10 * rms[-1]
+    assert abs(output[-1]) < 1e-3 * rms[0]
+    assert not np.any(group.step(64))
+
+
+def test_stagger():
+    """ Voices activated together start a step apart, so that even the first
+    steps render one hop each
+    """
+    ring = AnnotatedRing(2**18 // 512, 512)
+    ring.append(np.random.RandomState(0).randn(2**18))
+    group = StretchGroup(ring, FakeIO(), voices=4, seed=1, lead=2**13, stagger=True)
+    for i, stretcher in enumerate(group.stretches_list):
+        stretcher.tap.index = i * 1000
+        stretcher.activate()
+    # the queues are sized up front, so delaying and queueing never grow
+    # them in the callback
+    capacities = [stretcher.capacity for stretcher in group.stretches_list]
+    for i in range(64):
+        group.step(512)
+    assert [stretcher.capacity for stretcher in group.stretches_list] == capacities
+    load = group.load
+    assert load['steps'] == 64
+    assert load['worst'] == 1, load
+    assert abs(load['worst_work'] - 1.) < 1e-9
+    # every voice started, one step after the other
+    assert all(stretcher.pending is not None for stretcher in group.stretches_list)
+
+
+def test_simulation():
+    """ Play noise through the live callback, with a controller that turns
+    on every voice and then slams the faders, down to no stretch at all
+    """
+    events = simulate.activations(4, start=0.5, spacing=0.25)
+    events += simulate.storm(200, 4., seed=1)
+    events += [(2., '/1/fader{0}'.format(i), 1.) for i in range(1, 5)]
+    source = simulate.synthetic('clicks', 4.)
+    engine, output, elapsed = simulate.simulate(source, events)
+    assert output.shape == (len(source) // 512 * 512, 2)
+    assert np.all(np.isfinite(output))
+    # every voice played
+    assert np.abs(output[-2**14:]).max() > 0
+    assert all(s.activated >= 0 for s in engine.stretch_group.stretches_list)
+    # each group counts its own activations, in the order of the toggles
+    assert [s.activated for s in engine.stretch_group.stretches_list] == [0, 1, 2, 3]
+    assert engine.frames_elapsed == len(source) // 512
+    report = engine.callback_stats.report()
+    assert report['callbacks'] == engine.frames_elapsed
+    assert engine.stretch_group.load['worst'] == 1
+
+
+def test_sinks():
+    """ Record the simulated output, its stems and a TCP stream through
+    SinkWriters, and check that they hold exactly what was played
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+
+        def receive():
+            connection, address = server.accept()
+            while True:
+                data = connection.recv(2**16)
+                if not data:
+                    break
+                received.append(data)
+            connection.close()
+        thread = threading.Thread(target=receive)
+        thread.start()
+
+        record = os.path.join(directory, 'out.wav')
+        # small chunks, so the writer thread has many to write
+        output_writer = SinkWriter([WavSink(record, 44100, 2), SocketSink(server.getsockname())],
+                                   2, chunk=2**12, chunks=64)
+        stem_writer = SinkWriter([stem_sinks(os.path.join(directory, 'voice{0}.wav'), 44100, 4)], 4)
+        record_input = os.path.join(directory, 'in.wav')
+        input_reader = TapReader(ConcurrentRing(2**18, 'float32').create_tap(),
+                                 [WavSink(record_input, 44100, 1)])
+        source = simulate.synthetic('noise', 3.)
+        engine, output, elapsed = simulate.simulate(
+            source, simulate.activations(4, start=0.5, spacing=0.25),
+            output_writer=output_writer, stem_writer=stem_writer, input_reader=input_reader)
+        thread.join()
+        server.close()
+
+        assert output_writer.report()['dropped'] == 0
+        assert output_writer.backlog == 0
+        samplerate, recorded = wavfile.read(record)
+        assert samplerate == 44100 and recorded.dtype == np.float32
+        assert np.array_equal(recorded, output)
+        streamed = np.frombuffer(b''.join(received), 'float32').reshape(-1, 2)
+        assert np.array_equal(streamed, output)
+        stems = np.array([wavfile.read(os.path.join(directory, 'voice{0}.wav'.format(i)))[1]
+                          for i in range(1, 5)])
+        assert np.allclose(np.dot(stems.T, engine.stretch_group.routing), output, atol=1e-6)
+        # the input, read from the capture ring on the reader's thread
+        assert input_reader.dropped == 0
+        assert np.array_equal(wavfile.read(record_input)[1], source[:len(output)])
+    finally:
+        shutil.rmtree(directory)
+
+    # Without a writer thread the chunks run out, and audio is dropped
+    # instead of blocking
+    writer = SinkWriter([], 2, chunk=1024, chunks=2)
+    writer.write(np.zeros((3000, 2), 'float32'))
+    assert writer.report()['dropped'] == 3000 - 2048
+    assert writer.backlog == 2048
+
+
+def test_wav_sink():
+    """ Float audio written as PCM keeps its level, and the header stays
+    readable past 4 GiB
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'pcm.wav')
+        sink = WavSink(path, 44100, 2, 'int16')
+        frames = np.array([[0., 0.5], [-1., 1.], [2., -2.]], 'float32')
+        sink.write(frames)
+        sink.write(np.array([[1, -1]], 'int16'))
+        for wrong in [np.zeros((1, 2), 'int32'), np.zeros((1, 2), 'uint8')]:
+            try:
+                sink.write(wrong)
+            except TypeError:
+                pass
+            else:
+                assert False
+        sink.close()
+        samplerate, recorded = wavfile.read(path)
+        assert recorded.dtype == np.int16
+        assert np.array_equal(recorded, [[0, 16384], [-32767, 32767], [32767, -32768], [1, -1]])
+        samplerate, audio = read_wav(path)
+        assert samplerate == 44100 and audio.dtype == np.float32
+        assert np.allclose(audio[:3], np.clip(frames, -1, 1), atol=1. / 32767)
+
+        path = os.path.join(directory, 'unsigned.wav')
+        sink = WavSink(path, 44100, 1, 'uint8')
+        sink.write(np.array([[-1.], [0.], [1.]], 'float32'))
+        sink.close()
+        assert np.array_equal(wavfile.read(path)[1], [1, 128, 255])
+        assert np.array_equal(read_wav(path)[1], [[-1.], [0.], [1.]])
+
+        path = os.path.join(directory, 'long.wav')
+        sink = WavSink(path, 44100, 2, 'float32')
+        sink.write(np.zeros((4, 2), 'float32'))
+        # as if we had recorded 8 GiB
+        sink.frames = 2**30
+        sink.close()
+        with open(path, 'rb') as f:
+            header = f.read(58)
+        riff_size, = struct.unpack('<I', header[4:8])
+        fact_frames, = struct.unpack('<I', header[46:50])
+        data_size, = struct.unpack('<I', header[54:58])
+        assert header[50:54] == b'data'
+        assert riff_size == 50 + data_size <= 0xFFFFFFFF
+        assert data_size == fact_frames * 8 > 0xFFFFFFFF - 8 - 50
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_phase_decorrelation():
+    """ Paulstretch depends on the phases of every bin being independent and
+    uniform, so that each hop is uncorrelated with the last. Check both the
+    computed and the table based phases.
+    """
+    sw = get_strech(2**12)
+    source = np.random.RandomState(2).randn(sw.size)
+
+    for tables in [0, 16]:
+        phases = PhaseGenerator(seed=3, tables=tables)
+        phasors = phases.fill(np.empty((64, sw.half + 1), 'complex128'))
+        assert np.allclose(np.abs(phasors), 1.)
+        # the mean of n uniform unit phasors has a magnitude of about 1/sqrt(n)
+        assert np.abs(phasors.mean()) < 4. / np.sqrt(phasors.size)
+
+        # every hop stretches the same window, so any correlation between
+        # consecutive outputs comes from the phases
+        frames = np.tile(source, (64, 1))
+        output = stretch_frames(sw, frames, phasors)
+        correlation = [np.corrcoef(output[i], output[i + 1])[0, 1] for i in range(63)]
+        assert np.max(np.abs(correlation)) < 0.15, (tables, np.max(np.abs(correlation)))
+        assert abs(np.mean(correlation)) < 0.02, (tables, np.mean(correlation))
+
+    # the same seed gives the same phases
+    a = PhaseGenerator(seed=5, tables=16).fill(np.empty((4, 100), 'complex64'))
+    b = PhaseGenerator(seed=5, tables=16).fill(np.empty((4, 100), 'complex64'))
+    assert np.all(a == b)
+
+
+if __name__ == '__main__':
+    test_float32_quality()
+    test_render_segments()
+    test_overlap_add()
+    test_batched_stretch()
+    test_callback_stats()
+    test_voice_pool()
+    test_voice_steal()
+    test_worker_threads()
+    test_planned_ffts()
+    test_window_sizes()
+    test_resize_level()
+    test_engine_voices()
+    test_osc_events()
+    test_render_ahead()
+    test_render_ahead_of_input()
+    test_fade_out()
+    test_stagger()
+    test_simulation()
+    test_sinks()
+    test_wav_sink()
+    test_phase_decorrelation()
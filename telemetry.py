@@ -0,0 +1,147 @@
+import bisect
+import timeit
+
+import numpy as np
+
+# The most accurate wall clock available on this platform
+timer = timeit.default_timer
+
+# Flags on sd.CallbackFlags that mean we dropped or lost audio
+xrun_flags = ['input_underflow', 'input_overflow', 'output_underflow', 'output_overflow']
+
+
+class CallbackStats(object):
+    """ Timing and xrun statistics for the audio callback.
+
+    The audio thread calls .begin() at the top of the callback, .mark(name)
+    after each section of work, and .end(status) when it is done. All
+    storage is allocated up front and only written by the audio thread, so
+    recording takes no locks and creates no new arrays.
+
+    Any other thread may call .report() to pull percentiles of the recorded
+    times, and the number of xruns since its previous .report().
+
+    Times are kept in histograms with logarithmically spaced bins, so
+    percentiles are accurate to about 5% (the ratio of neighbouring bin
+    edges) no matter how many callbacks we record.
+    """
+    def __init__(self, sections, budget=None, min_time=1e-5, max_time=10., bins=240):
+        """
+        sections ([str]): names of the sections we time, in callback order
+        budget (float): seconds available per callback, (blocksize / samplerate)
+        """
+        self.sections = list(sections) + ['total']
+        self.budget   = budget
+        self.__lookup = dict((name, i) for i, name in enumerate(self.sections))
+
+        # bisect on a python list is faster than np.searchsorted for a single
+        # value, and does not create a numpy scalar.
+        self.__edges  = list(np.logspace(np.log10(min_time), np.log10(max_time), bins))
+        self.__counts = np.zeros((len(self.sections), bins + 1), dtype='int64')
+        self.__max    = np.zeros(len(self.sections))
+        self.__xruns  = np.zeros(len(xrun_flags), dtype='int64')
+        self.__callbacks = 0
+        self.__over_budget = 0
+
+        self.__start = 0.
+        self.__last  = 0.
+
+        # Totals at the time of the last .report(), used to count per interval
+        self.__reported_xruns = np.zeros(len(xrun_flags), dtype='int64')
+        self.__reported_callbacks = 0
+        self.__reported_over_budget = 0
+
+    def begin(self):
+        self.__start = self.__last = timer()
+
+    def mark(self, name):
+        """ Record the time since the previous .mark() (or .begin()) as the
+        duration of section <name>
+        """
+        now = timer()
+        self.__record(self.__lookup[name], now - self.__last)
+        self.__last = now
+
+    def end(self, status=None):
+        """ Record the total callback time, and count xruns in <status>
+        (an sd.CallbackFlags)
+        """
+        elapsed = timer() - self.__start
+        self.__record(len(self.sections) - 1, elapsed)
+        self.__callbacks += 1
+        if self.budget is not None and elapsed > self.budget:
+            self.__over_budget += 1
+        if status:
+            for i, flag in enumerate(xrun_flags):
+                if getattr(status, flag, False):
+                    self.__xruns[i] += 1
+
+    def __record(self, section, elapsed):
+        self.__counts[section, bisect.bisect(self.__edges, elapsed)] += 1
+        if elapsed > self.__max[section]:
+            self.__max[section] = elapsed
+
+    def percentile(self, name, q):
+        """ Approximate the <q>th percentile (0 to 100) of section <name> in
+        seconds. Returns None if nothing was recorded.
+        """
+        counts = self.__counts[self.__lookup[name]].copy()
+        total = counts.sum()
+        if total == 0:
+            return None
+        b = int(np.searchsorted(np.cumsum(counts), total * q / 100.))
+        # Report the upper edge of the bin, so we never under estimate
+        if b >= len(self.__edges):
+            return float(self.__max[self.__lookup[name]])
+        return min(self.__edges[b], float(self.__max[self.__lookup[name]]))
+
+    def report(self):
+        """ Pull the statistics collected so far.
+
+        Returns a dict. 'sections' maps each section name (and 'total') to
+        its p50, p90, p99 and max time in seconds. The 'xruns', 'callbacks'
+        and 'over_budget' counts are for the interval since the previous
+        call to .report().
+        """
+        xruns = self.__xruns.copy()
+        callbacks = self.__callbacks
+        over_budget = self.__over_budget
+
+        sections = {}
+        for i, name in enumerate(self.sections):
+            sections[name] = {
+                'p50': self.percentile(name, 50),
+                'p90': self.percentile(name, 90),
+                'p99': self.percentile(name, 99),
+                'max': float(self.__max[i]),
+            }
+
+        report = {
+            'sections': sections,
+            'budget': self.budget,
+            'callbacks': callbacks - self.__reported_callbacks,
+            'over_budget': over_budget - self.__reported_over_budget,
+            'xruns': dict(zip(xrun_flags, (xruns - self.__reported_xruns).tolist())),
+        }
+
+        self.__reported_xruns = xruns
+        self.__reported_callbacks = callbacks
+        self.__reported_over_budget = over_budget
+        return report
+
+    def format(self, report=None):
+        """ Format a report as a small table of milliseconds """
+        if report is None:
+            report = self.report()
+        lines = ['{0:>10} {1:>9} {2:>9} {3:>9} {4:>9}'.format('ms', 'p50', 'p90', 'p99', 'max')]
+        for name in self.sections:
+            s = report['sections'][name]
+            lines.append('{0:>10} {1:>9} {2:>9} {3:>9} {4:>9}'.format(name, *[
+                '-' if s[k] is None else '{0:.3f}'.format(s[k] * 1000.)
+                for k in ['p50', 'p90', 'p99', 'max']]))
+        if report['budget'] is not None:
+            lines.append('budget: {0:.3f} ms, over budget: {1} of {2} callbacks'.format(
+                report['budget'] * 1000., report['over_budget'], report['callbacks']))
+        lines.append('xruns: ' + ', '.join(
+            '{0}={1}'.format(flag, report['xruns'][flag]) for flag in xrun_flags))
+        return '\n'.join(lines)
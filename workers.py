@@ -0,0 +1,74 @@
+import sys
+import threading
+
+
+class WorkerPool(object):
+    """ A fixed set of threads that stay alive between audio callbacks.
+
+    .run hands one shard of work to each worker and blocks until every
+    worker has finished, so each call acts as a barrier. Starting threads is
+    far too slow to do once per callback, and a persistent worker can keep
+    its own scratch buffers between calls.
+
+    numpy releases the GIL inside its FFT and most array operations, so
+    workers running FFT heavy code really do run on several cores.
+    """
+    def __init__(self, threads):
+        self.__size    = int(threads)
+        self.__tasks   = [None] * self.__size
+        self.__errors  = [None] * self.__size
+        self.__start   = [threading.Semaphore(0) for i in range(self.__size)]
+        self.__done    = threading.Semaphore(0)
+        self.__threads = []
+
+        for i in range(self.__size):
+            thread = threading.Thread(target=self.__work, args=(i,), name='Worker-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def __len__(self):
+        return self.__size
+
+    def __work(self, worker):
+        while True:
+            self.__start[worker].acquire()
+            task = self.__tasks[worker]
+            if task is None:
+                return
+            fn, shard = task
+            try:
+                fn(worker, shard)
+            except Exception:
+                self.__errors[worker] = sys.exc_info()
+            self.__tasks[worker] = None
+            self.__done.release()
+
+    def run(self, fn, shards):
+        """ Call fn(worker_index, shard) for each shard, each on its own
+        worker, and wait for all of them to finish. There may not be more
+        shards than workers. An exception raised by a worker is raised again
+        here, with the worker's traceback.
+        """
+        if len(shards) > self.__size:
+            raise ValueError('{0} shards for {1} workers'.format(len(shards), self.__size))
+
+        for i, shard in enumerate(shards):
+            self.__tasks[i] = (fn, shard)
+            self.__start[i].release()
+        for i in range(len(shards)):
+            self.__done.acquire()
+
+        errors = [e for e in self.__errors if e is not None]
+        self.__errors = [None] * self.__size
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+
+    def close(self):
+        """ Stop the worker threads """
+        for i in range(self.__size):
+            self.__tasks[i] = None
+            self.__start[i].release()
+        for thread in self.__threads:
+            thread.join()